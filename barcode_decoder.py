@@ -0,0 +1,245 @@
+import time
+from collections import deque
+
+from book_isbn import validate_and_convert
+
+#   OpenCV and zbar are imported by the functions that use them, so the
+#   decode modes can be listed without loading either
+#
+#   Book barcodes are EAN-13, so zbar doesn't need to look for anything else.
+#   Names of pyzbar's ZBarSymbol values.
+isbn_symbols = ("EAN13", "ISBN13", "ISBN10")
+#   Decode modes a scanner can use. "full" decodes every full resolution
+#   colour frame, "fast" uses BarcodeDecoder's cheaper passes.
+decode_modes = ("fast", "full")
+
+
+def decode_isbns(image, symbols: list = None) -> list[tuple[str, tuple]]:
+    """
+        Decodes every valid ISBN barcode in an image.
+
+    Args:
+        image: Grayscale or BGR image.
+        symbols (list, optional): zbar symbologies to look for. Defaults to isbn_symbols.
+
+    Returns:
+        list[tuple[str, tuple]]: (ISBN-13, (left, top, width, height)) pairs.
+    """
+    from pyzbar import pyzbar
+    from pyzbar.pyzbar import ZBarSymbol
+    found = []
+    symbols = symbols or [getattr(ZBarSymbol, name) for name in isbn_symbols]
+    for barcode in pyzbar.decode(image, symbols=symbols):
+        isbn = validate_and_convert(barcode.data.decode("utf-8"))
+        if isbn != None:
+            found.append((isbn, tuple(barcode.rect)))
+    return found
+
+
+class BarcodeDecoder:
+    """
+        Decodes ISBN barcodes from video frames using the cheapest pass that
+        works. Frames are converted to grayscale and decoded at a reduced
+        scale first. Once a barcode is found its region is tracked and only
+        that crop is decoded on later frames, falling back to the whole frame
+        after a miss.
+
+        Per-frame decode latency is recorded so the scanner can report how
+        many frames per second it can keep up with.
+    """
+    scale: float
+    roi_margin: float
+    track: bool
+    roi: tuple | None
+    last_pass: str | None
+    latencies: deque
+    pass_counts: dict[str, int]
+
+    def __init__(self, scale: float = 0.5, roi_margin: float = 0.5, track: bool = True,
+                 history: int = 300):
+        """
+        Args:
+            scale (float, optional): Scale of the downscaled pass. Defaults to 0.5.
+            roi_margin (float, optional): Padding added around a found barcode,
+            as a fraction of its size. Defaults to 0.5.
+            track (bool, optional): Decode only the last barcode region on
+            later frames. Defaults to True.
+            history (int, optional): Number of latencies kept for stats. Defaults to 300.
+        """
+        self.scale = scale
+        self.roi_margin = roi_margin
+        self.track = track
+        self.roi = None
+        self.last_pass = None
+        self.latencies = deque(maxlen=history)
+        self.pass_counts = {"roi": 0, "downscaled": 0, "full": 0, "miss": 0}
+
+    def _expand(self, rect: tuple, shape: tuple) -> tuple:
+        #   Pad a (left, top, width, height) rect and clip it to the frame
+        left, top, width, height = rect
+        padX = int(width * self.roi_margin)
+        padY = int(height * self.roi_margin)
+        x0 = max(0, left - padX)
+        y0 = max(0, top - padY)
+        x1 = min(shape[1], left + width + padX)
+        y1 = min(shape[0], top + height + padY)
+        return (x0, y0, x1, y1)
+
+    def _decode_roi(self, gray) -> tuple[str, tuple] | None:
+        x0, y0, x1, y1 = self.roi
+        found = decode_isbns(gray[y0:y1, x0:x1])
+        if not found:
+            return None
+        isbn, (left, top, width, height) = found[0]
+        return isbn, (left + x0, top + y0, width, height)
+
+    def _decode_scaled(self, gray) -> tuple[str, tuple] | None:
+        import cv2
+        small = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        found = decode_isbns(small)
+        if not found:
+            return None
+        isbn, rect = found[0]
+        return isbn, tuple(int(v / self.scale) for v in rect)
+
+    def decode(self, frame) -> str | None:
+        """
+            Decodes the first valid ISBN in a frame.
+
+        Args:
+            frame: BGR or grayscale frame.
+
+        Returns:
+            str | None: The ISBN-13 or None if no valid ISBN barcode was found.
+        """
+        start = time.perf_counter()
+        import cv2
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        found = None
+        self.last_pass = "miss"
+        if self.roi != None:
+            found = self._decode_roi(gray)
+            if found != None:
+                self.last_pass = "roi"
+            else:
+                self.roi = None
+        if found == None and self.scale < 1:
+            found = self._decode_scaled(gray)
+            if found != None:
+                self.last_pass = "downscaled"
+        if found == None:
+            found = decode_isbns(gray)
+            found = found[0] if found else None
+            if found != None:
+                self.last_pass = "full"
+        if found != None and self.track:
+            self.roi = self._expand(found[1], gray.shape)
+        self.pass_counts[self.last_pass] += 1
+        self.latencies.append(time.perf_counter() - start)
+        return found[0] if found != None else None
+
+    def stats(self) -> dict:
+        """
+            Summarises recent decode latencies.
+
+        Returns:
+            dict: Frame count, mean/p50/p95/max latency in milliseconds, the
+            frame rate those latencies allow and how often each pass hit.
+        """
+        if not self.latencies:
+            return {"frames": 0}
+        ordered = sorted(self.latencies)
+        mean = sum(ordered) / len(ordered)
+        return {
+            "frames": len(ordered),
+            "mean_ms": mean * 1000,
+            "p50_ms": ordered[len(ordered) // 2] * 1000,
+            "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+            "max_ms": ordered[-1] * 1000,
+            "max_fps": 1 / mean if mean > 0 else float("inf"),
+            "passes": dict(self.pass_counts),
+        }
+
+
+def decode_image_file(path: str) -> tuple[str, list[str]]:
+    """
+        Decodes every ISBN barcode in an image file. Runs in worker processes
+        so it only takes and returns plain values.
+
+    Args:
+        path (str): Full filepath to the image.
+
+    Returns:
+        tuple[str, list[str]]: The path and the ISBN-13s found in it.
+    """
+    import cv2
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return path, []
+    isbns = []
+    for isbn, _ in decode_isbns(image):
+        if isbn not in isbns:
+            isbns.append(isbn)
+    return path, isbns
+
+
+def video_segments(path: str, segments: int, step: int = 1) -> list[tuple[str, int, int, int]]:
+    """
+        Splits a video into contiguous frame ranges for decode_video_segment.
+
+    Args:
+        path (str): Full filepath to the video.
+        segments (int): Number of ranges to split it into.
+        step (int, optional): Decode every step-th frame. Defaults to 1.
+
+    Returns:
+        list[tuple[str, int, int, int]]: (path, start, end, step) tasks.
+    """
+    import cv2
+    cap = cv2.VideoCapture(path)
+    frameCount = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if frameCount <= 0:
+        #   Unknown length, decode the whole stream in one task
+        return [(path, 0, -1, step)]
+    size = -(-frameCount // max(1, segments))
+    return [(path, start, min(start + size, frameCount), step) for start in range(0, frameCount, size)]
+
+
+def decode_video_segment(path: str, start: int, end: int, step: int = 1) -> list[tuple[int, str]]:
+    """
+        Decodes ISBN barcodes from a range of video frames. Frames that aren't
+        decoded are only grabbed, not converted, and the barcode region is
+        tracked between frames.
+
+    Args:
+        path (str): Full filepath to the video.
+        start (int): First frame index.
+        end (int): Frame index to stop before, or -1 for the end of the video.
+        step (int, optional): Decode every step-th frame. Defaults to 1.
+
+    Returns:
+        list[tuple[int, str]]: (frame index, ISBN-13) for every decoded barcode.
+    """
+    import cv2
+    cap = cv2.VideoCapture(path)
+    if start > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    decoder = BarcodeDecoder()
+    hits = []
+    index = start
+    while end < 0 or index < end:
+        if (index - start) % step != 0:
+            if not cap.grab():
+                break
+            index += 1
+            continue
+        ret, frame = cap.read()
+        if not ret:
+            break
+        isbn = decoder.decode(frame)
+        if isbn != None:
+            hits.append((index, isbn))
+        index += 1
+    cap.release()
+    return hits
@@ -0,0 +1,884 @@
+#   Benchmarks for the parsing, OCR, database and metadata paths
+#
+#   Builds a synthetic corpus, runs every stage in a fresh process so peak
+#   memory can be measured per stage, and writes the results as json so runs
+#   can be compared:
+#       python benchmark.py --output before.json
+#       python benchmark.py --output after.json --compare before.json
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+from typing import Callable
+from urllib.parse import parse_qs, urlparse
+
+#   resource is only available on unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#   Stages in the order they run
+stage_names = ("isbn_text", "pdf_text", "pdf_ocr", "ocr_pytesseract", "ocr_tesserocr", "epub", "scan", "barcode",
+               "db_store", "db_bulk", "db_lookup", "index_lookup", "meta_single", "meta_batch")
+
+fillerWords = ("the", "library", "of", "chapter", "press", "edition", "printed", "in",
+               "and", "rights", "reserved", "university", "book", "first", "published",
+               "cover", "design", "all", "no", "part", "may", "be", "reproduced")
+
+#   EAN-13 digit encodings and the parity pattern picked by the first digit
+eanLeftOdd = ("0001101", "0011001", "0010011", "0111101", "0100011",
+              "0110001", "0101111", "0111011", "0110111", "0001011")
+eanRight = tuple("".join("1" if b == "0" else "0" for b in code) for code in eanLeftOdd)
+eanLeftEven = tuple(code[::-1] for code in eanRight)
+eanParity = ("LLLLLL", "LLGLGG", "LLGGLG", "LLGGGL", "LGLLGG",
+             "LGGLLG", "LGGGLL", "LGLGLG", "LGLGGL", "LGGLGL")
+
+
+class StageResult:
+    """
+        Measurements of a single benchmark stage. Built in the stage's worker
+        process so it only holds plain values.
+    """
+    name: str
+    unit: str
+    items: int
+    isbns: int
+    seconds: float
+    latencies: [float]
+    peakRss: int
+    peakChildRss: int
+    skipped: str | None
+
+    def __init__(self, name: str, unit: str = "files", skipped: str = None):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.isbns = 0
+        self.seconds = 0.0
+        self.latencies = []
+        self.peakRss = 0
+        self.peakChildRss = 0
+        self.skipped = skipped
+
+    def summary(self) -> dict:
+        """
+            Summarises the stage for printing and saving.
+
+        Returns:
+            dict: Throughput, latency percentiles in milliseconds and peak
+            resident memory in megabytes.
+        """
+        if self.skipped != None:
+            return {"skipped": self.skipped}
+        ordered = sorted(self.latencies)
+        res = {
+            "unit": self.unit,
+            "items": self.items,
+            "isbns": self.isbns,
+            "seconds": self.seconds,
+            "items_per_s": self.items / self.seconds if self.seconds > 0 else 0.0,
+            "isbns_per_s": self.isbns / self.seconds if self.seconds > 0 else 0.0,
+            "peak_rss_mb": self.peakRss / 1024,
+            "peak_child_rss_mb": self.peakChildRss / 1024,
+        }
+        #   Stages whose results arrive out of order only measure throughput
+        if ordered:
+            for pct in (50, 90, 99):
+                res[f"p{pct}_ms"] = percentile(ordered, pct) * 1000
+            res["max_ms"] = ordered[-1] * 1000
+        return res
+
+
+def percentile(ordered: [float], pct: float) -> float:
+    """
+        Nearest rank percentile of an already sorted list, 0 if it's empty.
+    """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def peak_rss() -> tuple[int, int]:
+    """
+        Returns the peak resident memory in KiB of this process and of its
+        largest finished child, like poppler or tesseract.
+    """
+    if resource == None:
+        return 0, 0
+    scale = 1024 if sys.platform == "darwin" else 1
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale
+    #   Linux carries ru_maxrss over from the parent through fork and exec,
+    #   VmHWM only counts this process
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    peak = int(line.split()[1])
+    except OSError:
+        pass
+    return peak, children
+
+
+def time_each(result: StageResult, items: list, fn: Callable) -> None:
+    """
+        Calls fn on every item, recording its latency. fn returns the number
+        of ISBNs it found.
+    """
+    start = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        result.isbns += fn(item)
+        result.latencies.append(time.perf_counter() - t)
+        result.items += 1
+    result.seconds += time.perf_counter() - start
+
+
+#   Corpus generators
+def random_isbn(rng: random.Random) -> str:
+    """
+        Generates a random checksum-valid ISBN-13.
+    """
+    digits = "978" + "".join(str(rng.randrange(10)) for _ in range(9))
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+    return digits + str((10 - total % 10) % 10)
+
+
+def hyphenate(isbn: str) -> str:
+    return f"{isbn[:3]}-{isbn[3]}-{isbn[4:7]}-{isbn[7:12]}-{isbn[12]}"
+
+
+def filler_lines(rng: random.Random, count: int, width: int = 70) -> [str]:
+    """
+        Generates lines of prose with the odd number in them, like page
+        numbers, years and phone numbers, which the ISBN search has to skip.
+    """
+    lines: [str] = []
+    for _ in range(count):
+        line: [str] = []
+        while sum(len(w) + 1 for w in line) < width:
+            roll = rng.random()
+            if roll < 0.03:
+                line.append(str(rng.randrange(1900, 2030)))
+            elif roll < 0.04:
+                line.append(f"{rng.randrange(100, 999)}-{rng.randrange(100, 999)}-{rng.randrange(1000, 9999)}")
+            else:
+                line.append(rng.choice(fillerWords))
+        lines.append(" ".join(line))
+    return lines
+
+
+def copyright_lines(rng: random.Random, isbn: str) -> [str]:
+    return (filler_lines(rng, 4)
+            + [f"Copyright {rng.randrange(1950, 2024)} by the author", "All rights reserved",
+               f"ISBN {hyphenate(isbn)}"]
+            + filler_lines(rng, 4))
+
+
+def book_pages(rng: random.Random, isbn: str | None, numPages: int, linesPerPage: int = 30) -> [[str]]:
+    #   Pages of filler with the copyright page, if there is an ISBN, on one
+    #   of the first four pages
+    pages = [filler_lines(rng, linesPerPage) for _ in range(numPages)]
+    if isbn != None:
+        pages[rng.randrange(min(4, numPages))] = copyright_lines(rng, isbn)
+    return pages
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_text_pdf(path: str, pages: [[str]], title: str = "") -> None:
+    """
+        Writes a pdf with a real text layer using the built in Helvetica font.
+
+    Args:
+        path (str): Path to write the pdf to.
+        pages ([[str]]): Lines of text on each page.
+        title (str, optional): Document info title. Defaults to "".
+    """
+    objects: [bytes] = [b"<< /Type /Catalog /Pages 2 0 R >>", b"",
+                        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+                        f"<< /Title ({_pdf_escape(title)}) >>".encode("latin-1")]
+    kids: [str] = []
+    for lines in pages:
+        stream = "BT /F1 11 Tf 14 TL 72 740 Td " + " ".join(f"({_pdf_escape(l)}) Tj T*" for l in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode("latin-1"))
+        objects.append(f"""<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792]
+/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>""".encode("latin-1"))
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>".encode("latin-1")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets: [int] = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n".encode("latin-1") + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R /Info 4 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def page_images(pages: [[str]], dpi: int = 100) -> list:
+    """
+        Draws lines of text on letter sized grayscale pages.
+
+    Args:
+        pages ([[str]]): Lines of text drawn on each page.
+        dpi (int, optional): Resolution of the page images. Defaults to 100.
+
+    Returns:
+        [Image]: The pages.
+    """
+    from PIL import Image, ImageDraw, ImageFont
+    font = ImageFont.load_default(size=max(10, dpi * 11 // 72))
+    lineHeight = dpi * 14 // 72
+    images = []
+    for lines in pages:
+        image = Image.new("L", (dpi * 17 // 2, dpi * 11), 255)
+        draw = ImageDraw.Draw(image)
+        for i, line in enumerate(lines):
+            draw.text((dpi, dpi + i * lineHeight), line, fill=0, font=font)
+        images.append(image)
+    return images
+
+
+def write_image_pdf(path: str, pages: [[str]], dpi: int = 100) -> None:
+    """
+        Writes a pdf of page images without a text layer, like a scanned book.
+
+    Args:
+        path (str): Path to write the pdf to.
+        pages ([[str]]): Lines of text drawn on each page.
+        dpi (int, optional): Resolution of the page images. Defaults to 100.
+    """
+    images = page_images(pages, dpi)
+    images[0].save(path, "PDF", resolution=dpi, save_all=True, append_images=images[1:])
+
+
+def write_epub(path: str, rng: random.Random, isbn: str | None, where: str = "opf",
+               chapters: int = 12) -> None:
+    """
+        Writes a minimal epub.
+
+    Args:
+        path (str): Path to write the epub to.
+        rng (random.Random): Source of the filler text.
+        isbn (str | None): ISBN of the book, None for a book without one.
+        where (str, optional): Where the ISBN is: "opf" for the package
+        identifier, "copyright" for a copyright page or "chapter" for the
+        middle of the book. Defaults to "opf".
+        chapters (int, optional): Number of chapters. Defaults to 12.
+    """
+    identifier = f"urn:isbn:{isbn}" if isbn != None and where == "opf" else f"urn:uuid:{rng.getrandbits(128):032x}"
+    docs: [tuple[str, [str]]] = [(f"chapter{i:02d}.xhtml", filler_lines(rng, 60)) for i in range(chapters)]
+    if isbn != None and where == "copyright":
+        docs.insert(1, ("copyright.xhtml", copyright_lines(rng, isbn)))
+    elif isbn != None and where == "chapter":
+        docs[chapters // 2] = (docs[chapters // 2][0], copyright_lines(rng, isbn))
+
+    manifest = "\n".join(f'<item id="d{i}" href="{name}" media-type="application/xhtml+xml"/>'
+                         for i, (name, _) in enumerate(docs))
+    spine = "\n".join(f'<itemref idref="d{i}"/>' for i in range(len(docs)))
+    opf = f"""<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="id">{identifier}</dc:identifier>
+<dc:title>Benchmark</dc:title><dc:language>en</dc:language>
+</metadata>
+<manifest>{manifest}</manifest>
+<spine>{spine}</spine>
+</package>"""
+    container = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+    with zipfile.ZipFile(path, "w") as epubZip:
+        #   mimetype has to be the first entry and stored uncompressed
+        epubZip.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        epubZip.writestr("META-INF/container.xml", container, compress_type=zipfile.ZIP_DEFLATED)
+        epubZip.writestr("OEBPS/content.opf", opf, compress_type=zipfile.ZIP_DEFLATED)
+        for name, lines in docs:
+            body = "".join(f"<p>{line}</p>" for line in lines)
+            doc = f'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{name}</title></head><body>{body}</body></html>'
+            epubZip.writestr(f"OEBPS/{name}", doc, compress_type=zipfile.ZIP_DEFLATED)
+
+
+def ean13_modules(isbn: str) -> str:
+    """
+        Encodes an ISBN-13 as EAN-13 bar modules, "1" for a bar.
+    """
+    parity = eanParity[int(isbn[0])]
+    left = "".join((eanLeftOdd if p == "L" else eanLeftEven)[int(d)] for p, d in zip(parity, isbn[1:7]))
+    right = "".join(eanRight[int(d)] for d in isbn[7:])
+    return "101" + left + "01010" + right + "101"
+
+
+def write_barcode_image(path: str, rng: random.Random, isbn: str, size: tuple = (1280, 720),
+                        module: int = 3) -> None:
+    """
+        Writes a noisy photo-sized image with an EAN-13 barcode somewhere in it.
+
+    Args:
+        path (str): Path to write the image to.
+        rng (random.Random): Source of the barcode position and noise.
+        isbn (str): ISBN-13 to encode.
+        size (tuple, optional): Width and height of the image. Defaults to 1280x720.
+        module (int, optional): Width of one bar module in pixels. Defaults to 3.
+    """
+    import cv2
+    import numpy as np
+    noise = np.random.default_rng(rng.getrandbits(32))
+    image = noise.integers(90, 170, (size[1], size[0]), dtype=np.uint8)
+    bars = np.array([0 if m == "1" else 255 for m in ean13_modules(isbn)], dtype=np.uint8)
+    barcode = np.repeat(bars, module)
+    #   White quiet zone around the bars
+    quiet = 12 * module
+    height = 40 * module
+    label = np.full((height + 2 * quiet, barcode.size + 2 * quiet), 255, dtype=np.uint8)
+    label[quiet:quiet + height, quiet:quiet + barcode.size] = barcode
+    x = rng.randrange(0, size[0] - label.shape[1])
+    y = rng.randrange(0, size[1] - label.shape[0])
+    image[y:y + label.shape[0], x:x + label.shape[1]] = label
+    cv2.imwrite(path, image)
+
+
+class Corpus:
+    """
+        Paths of the generated benchmark files and the ISBNs in them.
+    """
+    directory: str
+    files: dict[str, [tuple[str, str | None]]]
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files = {}
+
+    def add(self, kind: str, path: str, isbn: str | None) -> None:
+        self.files.setdefault(kind, []).append((path, isbn))
+
+    def paths(self, kind: str) -> [str]:
+        return [path for path, _ in self.files.get(kind, [])]
+
+
+def build_corpus(directory: str, kinds: [str], count: int, numPages: int, seed: int) -> Corpus:
+    """
+        Generates count files of each kind. One in ten files has no ISBN so
+        the miss path, which reads every page, is measured too.
+
+    Args:
+        directory (str): Directory to write the files to.
+        kinds ([str]): Any of "pdf_text", "pdf_image", "epub" and "barcode".
+        count (int): Files of each kind.
+        numPages (int): Pages in each pdf.
+        seed (int): Seed for the random generator.
+
+    Returns:
+        Corpus: The generated files.
+    """
+    rng = random.Random(seed)
+    corpus = Corpus(directory)
+    for kind in kinds:
+        os.makedirs(os.path.join(directory, kind), exist_ok=True)
+        for i in range(count):
+            isbn = random_isbn(rng) if i % 10 != 9 or kind == "barcode" else None
+            if kind == "pdf_text":
+                path = os.path.join(directory, kind, f"book{i:05d}.pdf")
+                write_text_pdf(path, book_pages(rng, isbn, numPages))
+            elif kind == "pdf_image":
+                path = os.path.join(directory, kind, f"book{i:05d}.pdf")
+                write_image_pdf(path, book_pages(rng, isbn, numPages))
+            elif kind == "epub":
+                path = os.path.join(directory, kind, f"book{i:05d}.epub")
+                write_epub(path, rng, isbn, ("opf", "opf", "copyright", "copyright", "chapter")[i % 5])
+            elif kind == "barcode":
+                path = os.path.join(directory, kind, f"shelf{i:05d}.png")
+                write_barcode_image(path, rng, isbn)
+            else:
+                raise ValueError(f"Unknown corpus kind: {kind}")
+            corpus.add(kind, path, isbn)
+    return corpus
+
+
+def build_catalogue(dbPath: str, count: int, seed: int, batchSize: int = 10000) -> StageResult:
+    """
+        Fills a database with count books using store_books.
+
+    Args:
+        dbPath (str): Database to create.
+        count (int): Number of books.
+        seed (int): Seed for the random generator.
+        batchSize (int, optional): Books per transaction. Defaults to 10000.
+
+    Returns:
+        StageResult: Latency of each batch.
+    """
+    import book_db
+    from book import Book
+    book_db.conn_string = dbPath
+    book_db.create_table()
+    rng = random.Random(seed)
+    result = StageResult("db_bulk", "rows")
+    start = time.perf_counter()
+    for offset in range(0, count, batchSize):
+        books = [Book(f"Title {offset + i}", random_isbn(rng), "Benchmark Press;", "2001",
+                      f"/books/{offset + i}.pdf") for i in range(min(batchSize, count - offset))]
+        t = time.perf_counter()
+        result.isbns += book_db.store_books(books)
+        result.latencies.append(time.perf_counter() - t)
+        result.items += len(books)
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+class StubOpenLibrary:
+    """
+        Local stand-in for the OpenLibrary /api/books endpoint with a fixed
+        latency per request. Whether an ISBN is known depends only on the
+        ISBN so runs are repeatable.
+    """
+    latency: float
+    knownRatio: float
+    requests: int
+
+    def __init__(self, latency: float = 0.02, knownRatio: float = 0.9):
+        """
+        Args:
+            latency (float, optional): Seconds each response is delayed. Defaults to 0.02.
+            knownRatio (float, optional): Share of ISBNs that have metadata. Defaults to 0.9.
+        """
+        self.latency = latency
+        self.knownRatio = knownRatio
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                query = parse_qs(urlparse(self.path).query)
+                data = {}
+                for key in query.get("bibkeys", [""])[0].split(","):
+                    isbn = key.removeprefix("ISBN:")
+                    if isbn and int(isbn[-6:]) % 1000 < stub.knownRatio * 1000:
+                        data[key] = {"title": f"Book {isbn}", "publish_date": "2001",
+                                     "publishers": [{"name": "Benchmark Press"}]}
+                time.sleep(stub.latency)
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="stub-openlibrary", daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> str:
+        self.thread.start()
+        return self.url
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+#   Stages. Each runs in its own process and gets the corpus and options.
+def _missing_tools(*tools: str) -> str | None:
+    missing = [tool for tool in tools if shutil.which(tool) == None]
+    return f"missing {', '.join(missing)}" if missing else None
+
+
+def bench_isbn_text(corpus: Corpus, options: dict) -> StageResult:
+    from book_isbn import find_isbn_in_text
+    rng = random.Random(options["seed"])
+    texts = []
+    for i in range(options["texts"]):
+        lines = filler_lines(rng, 30)
+        if i % 2 == 0:
+            lines[rng.randrange(len(lines))] += f" ISBN {hyphenate(random_isbn(rng))}"
+        texts.append("\n".join(lines))
+    result = StageResult("isbn_text", "texts")
+    time_each(result, texts, lambda text: find_isbn_in_text(text) != None)
+    return result
+
+
+def _bench_files(name: str, paths: [str], textLayer: bool = True) -> StageResult:
+    from book_parser import parse_file
+    result = StageResult(name)
+    time_each(result, paths, lambda path: parse_file(path, textLayer=textLayer).isbn != None)
+    return result
+
+
+def bench_pdf_text(corpus: Corpus, options: dict) -> StageResult:
+    missing = _missing_tools("pdfinfo", "pdftotext")
+    if missing != None:
+        return StageResult("pdf_text", skipped=missing)
+    return _bench_files("pdf_text", corpus.paths("pdf_text"))
+
+
+def bench_pdf_ocr(corpus: Corpus, options: dict) -> StageResult:
+    missing = _missing_tools("pdfinfo", "pdftoppm", "tesseract")
+    if missing != None:
+        return StageResult("pdf_ocr", skipped=missing)
+    return _bench_files("pdf_ocr", corpus.paths("pdf_image"))
+
+
+def _bench_ocr_backend(name: str, options: dict) -> StageResult:
+    #   OCRs copyright pages with the first OCR pass, straight from memory so
+    #   only the backend is timed and not pdf rendering
+    from book_isbn import isbn_candidates
+    from book_ocr import backend_available, default_passes, get_backend, preprocess
+    stage = "ocr_" + name
+    missing = None if backend_available(name) else f"missing {name}"
+    if name == "pytesseract":
+        missing = missing or _missing_tools("tesseract")
+    if missing != None:
+        return StageResult(stage, skipped=missing)
+    ocrPass = default_passes[0]
+    rng = random.Random(options["seed"])
+    pages = [copyright_lines(rng, random_isbn(rng)) for _ in range(options["ocr_pages"])]
+    images = [preprocess(image, ocrPass.mode) for image in page_images(pages, ocrPass.dpi)]
+    #   Started before timing, a scan starts it once per worker
+    backend = get_backend(name)
+    result = StageResult(stage, "pages")
+    time_each(result, images, lambda image: len(isbn_candidates(
+        backend.image_to_string(image, ocrPass.config), labelledOnly=ocrPass.labelledOnly)) > 0)
+    return result
+
+
+def bench_ocr_pytesseract(corpus: Corpus, options: dict) -> StageResult:
+    return _bench_ocr_backend("pytesseract", options)
+
+
+def bench_ocr_tesserocr(corpus: Corpus, options: dict) -> StageResult:
+    return _bench_ocr_backend("tesserocr", options)
+
+
+def bench_epub(corpus: Corpus, options: dict) -> StageResult:
+    return _bench_files("epub", corpus.paths("epub"))
+
+
+def bench_scan(corpus: Corpus, options: dict) -> StageResult:
+    #   End to end parsing with the worker pool. Results arrive out of order
+    #   so only throughput is measured.
+    from book_parser import scan_files
+    paths = corpus.paths("epub")
+    if _missing_tools("pdfinfo", "pdftotext") == None:
+        paths += corpus.paths("pdf_text")
+    result = StageResult("scan")
+    start = time.perf_counter()
+    for res in scan_files(paths, options["workers"], options["page_chunk"]):
+        result.items += 1
+        result.isbns += res.isbn != None
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def bench_barcode(corpus: Corpus, options: dict) -> StageResult:
+    try:
+        from barcode_decoder import decode_image_file
+    except ImportError as e:
+        return StageResult("barcode", "images", skipped=str(e))
+    result = StageResult("barcode", "images")
+    time_each(result, corpus.paths("barcode"), lambda path: len(decode_image_file(path)[1]))
+    return result
+
+
+def bench_db_store(corpus: Corpus, options: dict) -> StageResult:
+    #   One transaction per book, like the barcode scanner
+    import book_db
+    from book import Book
+    book_db.conn_string = os.path.join(corpus.directory, "store.db")
+    book_db.create_table()
+    rng = random.Random(options["seed"])
+    books = [Book(None, random_isbn(rng), None, None, f"/books/{i}.pdf") for i in range(options["stores"])]
+    result = StageResult("db_store", "rows")
+    time_each(result, books, lambda book: book_db.store_book(book))
+    return result
+
+
+def bench_db_bulk(corpus: Corpus, options: dict) -> StageResult:
+    path = os.path.join(corpus.directory, "catalogue.db")
+    if os.path.exists(path):
+        os.remove(path)
+    return build_catalogue(path, options["catalogue"], options["seed"], options["batch_size"])
+
+
+def _lookup_isbns(corpus: Corpus, options: dict) -> [str]:
+    #   Opens the catalogue and returns ISBNs to look up, half of them stored
+    import book_db
+    path = os.path.join(corpus.directory, "catalogue.db")
+    if not os.path.exists(path):
+        build_catalogue(path, options["catalogue"], options["seed"], options["batch_size"])
+    book_db.conn_string = path
+    #   Same seed as the catalogue, so the first ISBNs are stored ones
+    rng = random.Random(options["seed"])
+    known = [random_isbn(rng) for _ in range(min(options["lookups"], options["catalogue"]))]
+    missRng = random.Random(options["seed"] + 1)
+    return [isbn if i % 2 == 0 else random_isbn(missRng) for i, isbn in enumerate(known)]
+
+
+def bench_db_lookup(corpus: Corpus, options: dict) -> StageResult:
+    import book_db
+    isbns = _lookup_isbns(corpus, options)
+    result = StageResult("db_lookup", "lookups")
+    time_each(result, isbns, lambda isbn: book_db.isbn_exists(isbn))
+    time_each(result, isbns, lambda isbn: book_db.get_book(isbn) != None)
+    return result
+
+
+def bench_index_lookup(corpus: Corpus, options: dict) -> StageResult:
+    import book_db
+    isbns = _lookup_isbns(corpus, options)
+    #   Loaded up front so only lookups are timed, its size shows in peak memory
+    book_db.library_index()
+    result = StageResult("index_lookup", "lookups")
+    time_each(result, isbns, book_db.is_catalogued)
+    return result
+
+
+def _stub_provider(options: dict, batchSize: int = 50):
+    from book_meta import OpenLibraryProvider
+    return OpenLibraryProvider(options["stub_url"], batchSize=batchSize, maxConcurrency=options["concurrency"])
+
+
+def _meta_isbns(options: dict) -> [str]:
+    rng = random.Random(options["seed"] + 2)
+    return [random_isbn(rng) for _ in range(options["fetches"])]
+
+
+def bench_meta_single(corpus: Corpus, options: dict) -> StageResult:
+    provider = _stub_provider(options)
+    result = StageResult("meta_single", "isbns")
+    time_each(result, _meta_isbns(options), lambda isbn: provider.fetch_book(isbn) != None)
+    return result
+
+
+def bench_meta_batch(corpus: Corpus, options: dict) -> StageResult:
+    provider = _stub_provider(options)
+    isbns = _meta_isbns(options)
+    result = StageResult("meta_batch", "isbns")
+    start = time.perf_counter()
+    books = provider.fetch_books(isbns)
+    result.seconds = time.perf_counter() - start
+    result.latencies.append(result.seconds)
+    result.items = len(isbns)
+    result.isbns = len(books)
+    return result
+
+
+stages: dict[str, Callable[[Corpus, dict], StageResult]] = {
+    "isbn_text": bench_isbn_text,
+    "pdf_text": bench_pdf_text,
+    "pdf_ocr": bench_pdf_ocr,
+    "ocr_pytesseract": bench_ocr_pytesseract,
+    "ocr_tesserocr": bench_ocr_tesserocr,
+    "epub": bench_epub,
+    "scan": bench_scan,
+    "barcode": bench_barcode,
+    "db_store": bench_db_store,
+    "db_bulk": bench_db_bulk,
+    "db_lookup": bench_db_lookup,
+    "index_lookup": bench_index_lookup,
+    "meta_single": bench_meta_single,
+    "meta_batch": bench_meta_batch,
+}
+
+#   Corpus files each stage needs
+stage_corpus: dict[str, [str]] = {
+    "pdf_text": ["pdf_text"],
+    "pdf_ocr": ["pdf_image"],
+    "epub": ["epub"],
+    "scan": ["epub", "pdf_text"],
+    "barcode": ["barcode"],
+}
+
+
+def run_stage(name: str, corpus: Corpus, options: dict) -> StageResult:
+    """
+        Runs a stage and records the peak memory of the process. Meant to be
+        called in a fresh process, since peak memory can't be reset.
+    """
+    try:
+        result = stages[name](corpus, options)
+    except Exception as e:
+        result = StageResult(name, skipped=f"failed: {e!r}")
+    result.peakRss, result.peakChildRss = peak_rss()
+    return result
+
+
+def run_benchmarks(names: [str], corpus: Corpus, options: dict) -> dict[str, dict]:
+    """
+        Runs each stage in its own freshly spawned process.
+
+    Returns:
+        dict[str, dict]: Stage summaries keyed by stage name.
+    """
+    results: dict[str, dict] = {}
+    context = get_context("spawn")
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_stage, name, corpus, options).result()
+        results[name] = result.summary()
+        print_stage(name, results[name])
+    return results
+
+
+def print_header() -> None:
+    print(f"{'stage':12s}{'items':>8s}{'items/s':>10s}{'isbns/s':>10s}{'p50 ms':>9s}"
+          f"{'p90 ms':>9s}{'p99 ms':>9s}{'max ms':>9s}{'peak MB':>9s}")
+
+
+def print_stage(name: str, res: dict) -> None:
+    if "skipped" in res:
+        print(f"{name:12s}  skipped: {res['skipped']}")
+        return
+    latencies = "".join(f"{res[key]:9.2f}" if key in res else f"{'-':>9s}"
+                        for key in ("p50_ms", "p90_ms", "p99_ms", "max_ms"))
+    print(f"{name:12s}{res['items']:8d}{res['items_per_s']:10.1f}{res['isbns_per_s']:10.1f}"
+          f"{latencies}{res['peak_rss_mb']:9.1f}")
+
+
+def compare_results(old: dict, new: dict, threshold: float) -> int:
+    """
+        Prints the change of every stage between two runs.
+
+    Args:
+        old (dict): Results of the baseline run.
+        new (dict): Results of this run.
+        threshold (float): Relative change counted as a regression, e.g. 0.1
+        for a 10% drop in throughput or rise in p90 latency.
+
+    Returns:
+        int: Number of stages that regressed.
+    """
+    regressions = 0
+    print(f"\n{'stage':12s}{'items/s':>18s}{'p90 ms':>18s}{'peak MB':>18s}")
+    for name, res in new["stages"].items():
+        base = old["stages"].get(name)
+        if base == None or "skipped" in base or "skipped" in res:
+            continue
+
+        def change(key: str) -> float:
+            if not base.get(key) or key not in res:
+                return 0.0
+            return (res[key] - base[key]) / base[key]
+
+        regressed = change("items_per_s") < -threshold or change("p90_ms") > threshold
+        regressions += regressed
+        print(f"{name:12s}"
+              + "".join(f"{res.get(key, 0.0):10.1f} {change(key):+6.1%}" for key in ("items_per_s", "p90_ms", "peak_rss_mb"))
+              + ("  REGRESSED" if regressed else ""))
+    return regressions
+
+
+def git_revision() -> str | None:
+    try:
+        res = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                             check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return res.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark librarian's parsing, OCR, database and metadata paths.")
+    parser.add_argument("--stages", default=",".join(stage_names),
+                        help=f"Comma separated stages to run. Default: all of {', '.join(stage_names)}.")
+    parser.add_argument("--files", type=int, default=20, help="Files of each kind in the corpus.")
+    parser.add_argument("--pages", type=int, default=10, help="Pages in each generated pdf.")
+    parser.add_argument("--ocr-pages", type=int, default=20, help="Pages OCR'd by each ocr_<backend> stage.")
+    parser.add_argument("--texts", type=int, default=2000, help="Text snippets searched by isbn_text.")
+    parser.add_argument("--stores", type=int, default=2000, help="Books stored one at a time by db_store.")
+    parser.add_argument("--catalogue", type=int, default=200000, help="Books in the db_bulk catalogue.")
+    parser.add_argument("--lookups", type=int, default=20000, help="ISBN lookups made by db_lookup.")
+    parser.add_argument("--fetches", type=int, default=200, help="ISBNs looked up by the metadata stages.")
+    parser.add_argument("--latency", type=float, default=20, help="Milliseconds the stub OpenLibrary waits per request.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Metadata requests in flight at once.")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Books per transaction in db_bulk.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes used by the scan stage.")
+    parser.add_argument("--page-chunk", type=int, default=0, help="Pdf pages per task in the scan stage.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated corpus.")
+    parser.add_argument("--corpus", help="Directory to generate the corpus in and keep. Default: a temporary directory.")
+    parser.add_argument("--output", help="Write the results as json to this file.")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative slowdown counted as a regression. Default: 0.1.")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    names = [name for name in args.stages.split(",") if name]
+    unknown = [name for name in names if name not in stages]
+    if unknown:
+        print(f"Unknown stages: {', '.join(unknown)}")
+        return 2
+
+    directory = args.corpus or tempfile.mkdtemp(prefix="librarian-bench-")
+    os.makedirs(directory, exist_ok=True)
+    stub = StubOpenLibrary(args.latency / 1000)
+    options = {key: value for key, value in vars(args).items()}
+    options["stub_url"] = stub.start()
+    try:
+        kinds = sorted({kind for name in names for kind in stage_corpus.get(name, [])})
+        start = time.perf_counter()
+        corpus = build_corpus(directory, kinds, args.files, args.pages, args.seed)
+        print(f"Generated {args.files} files of {', '.join(kinds) or 'no kind'} in "
+              f"{time.perf_counter() - start:.1f}s at {directory}\n")
+        print_header()
+        results = {
+            "meta": {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "options": {key: value for key, value in options.items()
+                            if key not in ("output", "compare", "corpus", "stub_url")},
+            },
+            "stages": run_benchmarks(names, corpus, options),
+        }
+    finally:
+        stub.stop()
+        if args.corpus == None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.output}")
+    if args.compare != None:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), results, args.threshold)
+        if regressions:
+            print(f"\n{regressions} stages regressed by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,316 @@
 #   Sql database
+import os
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from logging import Logger
+from typing import Callable, Iterable, Iterator
 
 from book import Book
+from book_index import LibraryIndex
 
 conn_string: str = "data/isbn_database.db"
 
-def create_table() -> None:
+#   Pragmas applied to every new connection. WAL lets readers and the writer
+#   work at the same time and NORMAL sync is safe in WAL mode.
+connection_pragmas: [str] = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+]
+
+#   Each thread keeps its own connection since sqlite3 connections
+#   can't be shared between threads by default.
+_local = threading.local()
+
+#   Columns that can be selected when listing books
+book_columns: tuple = ("id", "isbn", "title", "publishers", "pubDate", "path")
+#   Publish dates from OpenLibrary are free text like "March 3, 2005"
+_yearRegex = re.compile(r"\b(\d{4})\b")
+
+
+def _pub_year(pubDate: str | None) -> int | None:
+    #   The year in a publish date, available to queries as pub_year()
+    if pubDate == None:
+        return None
+    match = _yearRegex.search(pubDate)
+    return int(match.group(1)) if match else None
+
+
+def _open_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(conn_string, isolation_level=None)
+    for pragma in connection_pragmas:
+        conn.execute(pragma)
+    conn.create_function("pub_year", 1, _pub_year, deterministic=True)
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+        Returns the cached connection for the calling thread, opening one if
+        needed. A new connection is opened if conn_string changed or the
+        process was forked since the last call.
+
+    Returns:
+        sqlite3.Connection: Connection to conn_string in autocommit mode.
     """
-        Creates a sqlite3 database if none exists.
+    conn = getattr(_local, "conn", None)
+    if (conn is None or _local.path != conn_string or _local.pid != os.getpid()):
+        conn = _open_connection()
+        _local.conn = conn
+        _local.path = conn_string
+        _local.pid = os.getpid()
+        _local.depth = 0
+        _local.onCommit = []
+    return conn
+
+
+def close_connection() -> None:
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(conn_string)
-    c = conn.cursor()
+        Closes the calling thread's cached connection if there is one.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+@contextmanager
+def connection():
+    """
+        Context manager that yields the calling thread's connection.
+
+        Usage:
+            with connection() as conn:
+                conn.execute(...)
+    """
+    yield get_connection()
+
+
+@contextmanager
+def transaction(immediate: bool = False):
+    """
+        Context manager that wraps its body in a single transaction. The
+        transaction is committed on exit and rolled back on an exception.
+        Nested calls join the outermost transaction.
+
+    Args:
+        immediate (bool, optional): Take the write lock when the transaction
+        starts instead of on the first write. Defaults to False.
+
+        Usage:
+            with transaction() as conn:
+                conn.execute(...)
+                conn.execute(...)
+    """
+    conn = get_connection()
+    if _local.depth > 0:
+        _local.depth += 1
+        try:
+            yield conn
+        finally:
+            _local.depth -= 1
+        return
+
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    _local.depth = 1
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        try:
+            conn.execute("COMMIT")
+        except BaseException:
+            #   A failed COMMIT, e.g. SQLITE_BUSY, can leave the transaction
+            #   open and the next BEGIN would fail
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        for callback in _local.onCommit:
+            callback()
+    finally:
+        _local.depth = 0
+        _local.onCommit.clear()
+
+
+def _in_transaction() -> bool:
+    #   Whether the calling thread is inside transaction(). Helpers that log
+    #   and swallow their errors re-raise them there instead, so the outer
+    #   transaction rolls back as a whole rather than committing without them.
+    return getattr(_local, "conn", None) != None and _local.depth > 0
+
+
+def _after_commit(callback: Callable[[], None]) -> None:
+    #   Runs callback once the calling thread's transaction commits, or now
+    #   if there isn't one. Nothing runs if it's rolled back.
+    get_connection()
+    if _local.depth > 0:
+        _local.onCommit.append(callback)
+    else:
+        callback()
+
+
+_insert_book: str = """INSERT OR IGNORE
+                        INTO books (isbn, path, title, publishers, pubDate)
+                        VALUES (?, ?, ?, ?, ?)"""
+
+
+def _book_row(book: Book) -> tuple:
+    return (book.isbn, book.path, book.title, book.publishers, book.publish_date)
+
+
+def _migrate_books_indexes(conn: sqlite3.Connection) -> None:
+    #   Older versions wrote missing metadata as the string "None"
+    for column in ("title", "publishers", "pubDate"):
+        conn.execute(f"UPDATE books SET {column}=NULL WHERE {column}='None'")
+    #   Drop duplicate ISBNs, keeping the first row that has metadata
+    conn.execute("""DELETE FROM books WHERE id IN
+                    (SELECT id FROM
+                        (SELECT id, ROW_NUMBER() OVER
+                            (PARTITION BY isbn ORDER BY title IS NULL, id) AS rn
+                        FROM books)
+                    WHERE rn > 1)""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS books_isbn ON books (isbn)")
+    conn.execute("CREATE INDEX IF NOT EXISTS books_path ON books (path)")
+
+
+def _migrate_scan_state(conn: sqlite3.Connection) -> None:
+    #   Fingerprints of scanned files so unchanged files can be skipped
+    conn.execute('''CREATE TABLE IF NOT EXISTS scan_state
+                    (path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    hash TEXT,
+                    isbn TEXT,
+                    status TEXT NOT NULL,
+                    scanned_at REAL NOT NULL);''')
+    conn.execute("CREATE INDEX IF NOT EXISTS scan_state_hash ON scan_state (hash)")
+
 
-    # Create the table if it doesn't exist
-    c.execute('''CREATE TABLE IF NOT EXISTS books
+def _migrate_meta_cache(conn: sqlite3.Connection) -> None:
+    #   Raw metadata provider responses. A NULL response means the provider
+    #   didn't know the ISBN.
+    conn.execute('''CREATE TABLE IF NOT EXISTS meta_cache
+                    (isbn TEXT PRIMARY KEY,
+                    response TEXT,
+                    fetched_at REAL NOT NULL);''')
+
+
+def _migrate_books_fts(conn: sqlite3.Connection) -> None:
+    #   Full-text index over the books table. It's an external content index
+    #   so the text isn't stored twice, and triggers keep it in sync.
+    try:
+        conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5
+                        (title, publishers, path,
+                        content='books', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2', prefix='2 3');''')
+    except sqlite3.OperationalError:
+        #   sqlite was built without FTS5, search falls back to LIKE
+        return
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+                        INSERT INTO books_fts (rowid, title, publishers, path)
+                        VALUES (new.id, new.title, new.publishers, new.path);
+                    END;''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+                        INSERT INTO books_fts (books_fts, rowid, title, publishers, path)
+                        VALUES ('delete', old.id, old.title, old.publishers, old.path);
+                    END;''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS books_fts_update
+                    AFTER UPDATE OF title, publishers, path ON books BEGIN
+                        INSERT INTO books_fts (books_fts, rowid, title, publishers, path)
+                        VALUES ('delete', old.id, old.title, old.publishers, old.path);
+                        INSERT INTO books_fts (rowid, title, publishers, path)
+                        VALUES (new.id, new.title, new.publishers, new.path);
+                    END;''')
+    #   Index the books that are already stored
+    conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+
+
+def _migrate_scan_jobs(conn: sqlite3.Connection) -> None:
+    #   Work queue of files to parse so an interrupted scan can be resumed
+    conn.execute('''CREATE TABLE IF NOT EXISTS scan_jobs
                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    isbn TEXT NOT NULL,
-                    path TEXT NOT NULL,
-                    title TEXT,
-                    publishers TEXT,
-                    pubDate TEXT);''')
-
-    # Commit the changes and close the connection
-    conn.commit()
-    conn.close()
-        
+                    path TEXT NOT NULL UNIQUE,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    claimed_at REAL,
+                    isbn TEXT,
+                    error TEXT,
+                    updated_at REAL NOT NULL);''')
+    conn.execute("CREATE INDEX IF NOT EXISTS scan_jobs_state ON scan_jobs (state, id)")
+
+
+#   Schema migrations in order. Migration n brings the database from
+#   user_version n - 1 to n. Only ever append to this list.
+migrations: [Callable[[sqlite3.Connection], None]] = [
+    _migrate_books_indexes,
+    _migrate_scan_state,
+    _migrate_meta_cache,
+    _migrate_books_fts,
+    _migrate_scan_jobs,
+]
+
+
+def schema_version() -> int:
+    """
+        Returns the schema version stored in the database.
+    """
+    with connection() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(log: Logger = None) -> int:
+    """
+        Applies every migration newer than the database's user_version. Each
+        migration runs in its own transaction together with the version bump.
+
+    Args:
+        log (Logger, optional): Log to write applied migrations to. Defaults to None.
+
+    Returns:
+        int: Schema version after migrating.
+    """
+    version = schema_version()
+    while version < len(migrations):
+        with transaction(immediate=True) as conn:
+            #   Another process may have migrated while we waited for the lock
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(migrations):
+                break
+            migrations[version](conn)
+            version += 1
+            conn.execute(f"PRAGMA user_version={version}")
+        if log != None:
+            log.info(f"Migrated database to schema version {version}")
+    return version
+
+
+def create_table(log: Logger = None) -> None:
+    """
+        Creates a sqlite3 database if none exists and brings its schema up
+        to date.
+    """
+    with transaction() as conn:
+        # Create the table if it doesn't exist
+        conn.execute('''CREATE TABLE IF NOT EXISTS books
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        isbn TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        title TEXT,
+                        publishers TEXT,
+                        pubDate TEXT);''')
+    migrate(log)
+
+
 def isbn_exists(isbn: str) -> bool:
     """Checks if an ISBN string exists in the database.
 
@@ -36,49 +320,117 @@ def isbn_exists(isbn: str) -> bool:
     Returns:
         bool: Whether or not the ISBN exists.
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(conn_string)
-    c = conn.cursor()
+    with connection() as conn:
+        result = conn.execute("SELECT 1 FROM books WHERE isbn=? LIMIT 1", (isbn,)).fetchone()
+    return result is not None
 
-    # Check if the ISBN exists in the database
-    c.execute("SELECT * FROM books WHERE isbn=?", (isbn,))
-    result = c.fetchone()
 
-    # Close the connection
-    conn.close()
+#   Index of the stored ISBNs and paths and the database it was loaded from
+_libraryIndex: tuple[str, LibraryIndex] | None = None
+_indexLock = threading.Lock()
 
-    return result is not None
 
-def store_book(isbn: str, filePath: str, title: str = None, publishers: str = None, 
-               publishDate: str = None, log: Logger = None):
+def library_index(bloom: bool = False) -> LibraryIndex:
     """
-        Store a book and its metadata (optional).
+        Returns the in-memory index of stored ISBNs and paths, loading it
+        from the database on the first call. Books stored by this process
+        are added to it as their transaction commits.
+
+    Args:
+        bloom (bool, optional): Put a Bloom filter in front of the ISBN
+        lookups when the index is loaded. Defaults to False.
+
+    Returns:
+        LibraryIndex: Index of the books in conn_string.
     """
+    global _libraryIndex
+    with _indexLock:
+        if _libraryIndex == None or _libraryIndex[0] != conn_string:
+            rows = stream_books(["isbn", "path"], pageSize=50000)
+            _libraryIndex = (conn_string, LibraryIndex(rows, bloom))
+        return _libraryIndex[1]
 
-    if(isbn_exists(isbn)):
-        return False
-    conn = sqlite3.connect(conn_string)
-    command = conn.cursor()
-    
-    command.execute(f"""INSERT 
-                    INTO books (isbn, path, title, publishers, pubDate) 
-                    VALUES ({isbn}, \"{filePath}\", \"{title}\", \"{publishers}\", \"{publishDate}\")""")
-    conn.commit()
-    conn.close()
-    return True
-
-def store_book(book: Book, log: Logger = None):
-    if(isbn_exists(book.isbn)):
+
+def _index_books(books: [Book]) -> None:
+    #   Adds committed books to the index if it's loaded. A book whose ISBN
+    #   is already indexed was ignored by the insert, so its path isn't added.
+    if _libraryIndex == None or _libraryIndex[0] != conn_string:
+        return
+    index = _libraryIndex[1]
+    with _indexLock:
+        for book in books:
+            if not index.has_isbn(book.isbn):
+                index.add(book.isbn, book.path)
+
+
+def is_catalogued(isbn: str) -> bool:
+    """
+        Checks the library index for an ISBN before any network or database
+        work. ISBNs stored by another process since the index was loaded
+        aren't seen, so stores after a miss should still ignore duplicates.
+
+    Args:
+        isbn (str): ISBN string to look for.
+
+    Returns:
+        bool: Whether or not the ISBN is catalogued.
+    """
+    known = library_index().has_isbn(isbn)
+    if known == None:
+        #   Not an ISBN the index can pack
+        return isbn_exists(isbn)
+    return known
+
+
+def store_book(book: Book, log: Logger = None) -> bool:
+    """
+        Store a book and its metadata.
+
+    Args:
+        book (Book): Book to store. Only the isbn and path are required.
+        log (Logger, optional): Log to write errors and exceptions to. Defaults to None.
+
+    Returns:
+        bool: Whether or not the book was stored. False if the ISBN already exists.
+    """
+    try:
+        with transaction() as conn:
+            cur = conn.execute(_insert_book, _book_row(book))
+            _after_commit(lambda: _index_books([book]))
+    except sqlite3.Error:
+        if log != None:
+            log.exception(f"Failed to store {book.path} in db with ISBN: {book.isbn}")
         return False
-    conn = sqlite3.connect(conn_string)
-    command = conn.cursor()
-    
-    command.execute(f"""INSERT 
-                    INTO books (isbn, path, title, publishers, pubDate) 
-                    VALUES ({book.isbn}, \"{book.path}\", \"{book.title}\", \"{book.publishers}\", \"{book.publish_date}\")""")
-    conn.commit()
-    conn.close()
-    return True
+    return cur.rowcount > 0
+
+
+def store_books(books: Iterable[Book], log: Logger = None) -> int:
+    """
+        Stores many books in a single transaction. Books whose ISBN is already
+        in the database are skipped. Errors are logged, or raised when called
+        inside another transaction so it rolls back.
+
+    Args:
+        books (Iterable[Book]): Books to store. Only the isbn and path are required.
+        log (Logger, optional): Log to write errors and exceptions to. Defaults to None.
+
+    Returns:
+        int: Number of books that were stored.
+    """
+    books = list(books)
+    try:
+        with transaction() as conn:
+            #   rowcount leaves out the rows the FTS triggers write
+            cur = conn.executemany(_insert_book, (_book_row(book) for book in books))
+            _after_commit(lambda: _index_books(books))
+            return cur.rowcount
+    except sqlite3.Error:
+        if _in_transaction():
+            raise
+        if log != None:
+            log.exception("Failed to store a batch of books in db.")
+        return 0
+
 
 def get_book(isbn: str, log: Logger = None) -> Book:
     """
@@ -87,80 +439,211 @@ def get_book(isbn: str, log: Logger = None) -> Book:
         isbn (str): ISBN-13 of the book.
 
     Returns:
-        [str]: List of ISBN, associated file name, title, publishers, and
-        publishing date in that order.
+        Book: The stored book or None if it doesn't exist.
     """
-    if not isbn_exists(isbn):
-        return None
     book: Book = None
-    conn = sqlite3.connect(conn_string)
-    c = conn.cursor()
     try:
-        c.execute(f"""SELECT * FROM books WHERE isbn={isbn}""")
-        res = c.fetchone()
-        book = Book(res[3], res[1], res[4], res[5], res[2])
-    except:
+        with connection() as conn:
+            res = conn.execute("SELECT * FROM books WHERE isbn=?", (isbn,)).fetchone()
+        if res is not None:
+            book = Book(res[3], res[1], res[4], res[5], res[2])
+    except sqlite3.Error:
         if not log == None:
             log.exception(f"Book not found in db: {isbn}")
-            
-    conn.close()
     return book
-    
+
+
 def get_all_books(log: Logger = None) -> [Book]:
-    conn = sqlite3.connect(conn_string)
-    c = conn.cursor()
-    
+    books: [Book] = []
     try:
-        c.execute(f"""SELECT * FROM books""")
-        res = c.fetchall()
-        books: [Book] = []
-        for b in res:
-            book = Book(b[3], b[1], b[4], b[5], b[2])
-            books.append(book)
-            
+        books = list(iter_books())
+
         print(f"{'ISBN':14s}{'Title':100s}")
         for book in books:
-            print(f"{book.isbn:14s}{book.title:100s}")
-            
+            print(f"{book.isbn:14s}{book.title or '':100s}")
+
         print()
     except:
         if not log == None:
             log.exception("Failed to request books from database.")
-            
-    conn.close()
+
     return books
-    
+
+
+def _book_filters(publisher: str = None, publishedAfter: int = None, publishedBefore: int = None,
+                  missingMetadata: bool = False) -> tuple[[str], list]:
+    #   WHERE clauses and their parameters for the listing filters
+    clauses: [str] = []
+    params: list = []
+    if publisher != None:
+        escaped = publisher.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        clauses.append("publishers LIKE ? ESCAPE '\\'")
+        params.append(f"%{escaped}%")
+    if publishedAfter != None:
+        clauses.append("pub_year(pubDate) >= ?")
+        params.append(publishedAfter)
+    if publishedBefore != None:
+        clauses.append("pub_year(pubDate) <= ?")
+        params.append(publishedBefore)
+    if missingMetadata:
+        clauses.append("title IS NULL")
+    return clauses, params
+
+
+def get_books_page(columns: [str] = None, after: int = 0, limit: int = 1000,
+                   publisher: str = None, publishedAfter: int = None, publishedBefore: int = None,
+                   missingMetadata: bool = False) -> tuple[[tuple], int | None]:
+    """
+        Fetches one page of books using keyset pagination, so every page costs
+        the same no matter how deep into the library it is.
+
+    Args:
+        columns ([str], optional): Columns to return, from book_columns.
+        Defaults to every column.
+        after (int, optional): Cursor returned with the previous page, 0 for
+        the first page. Defaults to 0.
+        limit (int, optional): Most books on the page. Defaults to 1000.
+        publisher (str, optional): Only books with a publisher containing this,
+        ignoring case. Defaults to None.
+        publishedAfter (int, optional): Only books published in or after this year.
+        publishedBefore (int, optional): Only books published in or before this year.
+        missingMetadata (bool, optional): Only books without a title. Defaults to False.
+
+    Returns:
+        tuple[[tuple], int | None]: Rows with the selected columns and the
+        cursor of the next page, None if this was the last page.
+    """
+    columns = list(columns or book_columns)
+    unknown = [column for column in columns if column not in book_columns]
+    if unknown:
+        raise ValueError(f"Unknown book columns: {', '.join(unknown)}")
+    clauses, params = _book_filters(publisher, publishedAfter, publishedBefore, missingMetadata)
+    with connection() as conn:
+        rows = conn.execute(f"""SELECT id, {", ".join(columns)} FROM books
+                                WHERE {" AND ".join(["id > ?"] + clauses)}
+                                ORDER BY id LIMIT ?""", [after] + params + [limit]).fetchall()
+    nextCursor = rows[-1][0] if len(rows) == limit else None
+    return [row[1:] for row in rows], nextCursor
+
+
+def stream_books(columns: [str] = None, pageSize: int = 1000, publisher: str = None,
+                 publishedAfter: int = None, publishedBefore: int = None,
+                 missingMetadata: bool = False) -> Iterator[tuple]:
+    """
+        Streams books a page at a time. Only one page is held in memory and
+        no read transaction is held open between pages, so the library can be
+        written to while it's being exported.
+
+    Args:
+        columns ([str], optional): Columns to return, from book_columns.
+        Defaults to every column.
+        pageSize (int, optional): Books fetched per query. Defaults to 1000.
+        The filters are the same as get_books_page.
+
+    Returns:
+        Iterator[tuple]: Rows with the selected columns in the order they were stored.
+    """
+    after = 0
+    while after != None:
+        rows, after = get_books_page(columns, after, pageSize, publisher, publishedAfter,
+                                     publishedBefore, missingMetadata)
+        yield from rows
+
+
+def iter_books(**filters) -> Iterator[Book]:
+    """
+        Streams stored books so the whole library is never held in memory.
+
+    Args:
+        filters: Any of the stream_books filters.
+
+    Returns:
+        Iterator[Book]: Books in the order they were stored.
+    """
+    for row in stream_books(["title", "isbn", "publishers", "pubDate", "path"], **filters):
+        yield Book(*row)
+
+
+def get_isbns_missing_metadata() -> [str]:
+    """
+        Returns the ISBNs of stored books that have no title, e.g. books whose
+        metadata lookup failed or that were stored offline.
+    """
+    return [row[0] for row in stream_books(["isbn"], missingMetadata=True)]
+
+
+#   Words in a search query
+_searchTokenRegex = re.compile(r"\w+")
+#   Relative weight of a match in the title, publishers and path columns
+search_weights: tuple = (10.0, 3.0, 1.0)
+
+
+def search(query: str, limit: int = 20) -> [Book]:
+    """
+        Finds books whose title, publishers or path contain every word of the
+        query. The last word also matches as a prefix, so results can be shown
+        while typing, and earlier words match whole words or prefixes ending
+        in "*". Every match is ranked by bm25 with title matches counting
+        most, so a word that's in most books of a large library takes a few
+        hundred milliseconds.
+
+    Args:
+        query (str): Words to look for, e.g. "python crash".
+        limit (int, optional): Most books returned. Defaults to 20.
+
+    Returns:
+        [Book]: Matching books, best match first.
+    """
+    words = _searchTokenRegex.findall(query)
+    if not words:
+        return []
+    with connection() as conn:
+        hasFts = conn.execute("SELECT 1 FROM sqlite_master WHERE name='books_fts'").fetchone() != None
+        if hasFts:
+            #   Quoting every word keeps FTS5 syntax in the query from being run
+            terms: [str] = []
+            for i, word in enumerate(words):
+                prefix = i == len(words) - 1 or f"{word}*" in query
+                terms.append(f'"{word}"*' if prefix else f'"{word}"')
+            rows = conn.execute(f"""SELECT b.title, b.isbn, b.publishers, b.pubDate, b.path
+                                    FROM (SELECT rowid, bm25(books_fts, {", ".join(map(str, search_weights))}) AS score
+                                          FROM books_fts WHERE books_fts MATCH ? ORDER BY score LIMIT ?) f
+                                    JOIN books b ON b.id = f.rowid
+                                    ORDER BY f.score""",
+                                (" ".join(terms), limit)).fetchall()
+        else:
+            clauses = ["(title LIKE ? OR publishers LIKE ? OR path LIKE ?)"] * len(words)
+            params = [f"%{word}%" for word in words for _ in range(3)]
+            rows = conn.execute(f"""SELECT title, isbn, publishers, pubDate, path FROM books
+                                    WHERE {" AND ".join(clauses)} ORDER BY id LIMIT ?""",
+                                params + [limit]).fetchall()
+    return [Book(*row) for row in rows]
+
+
 def update_meta_data(isbn: str,
                    title: str, publishers: str,
-                   publishDate: str, log: Logger = None):
-    
+                   publishDate: str, log: Logger = None) -> bool:
     """
         Update a books metadata.
     """
-    
-    if isbn_exists(isbn):
-        conn = sqlite3.connect(conn_string)
-        c = conn.cursor()
-        try:
-            c.execute(f"""UPDATE books SET 
-                      title=\"{title}\",
-                      publishers=\"{publishers}\",
-                      pubDate=\"{publishDate}\"
-                      WHERE isbn={isbn};
-                      """)
-            conn.commit()
-        except:
-            if(log != None):
-                log.exception(f"Failed to update book with isbn:{isbn}")
-            return False
-        conn.close()
-        return True
-    else:
+    try:
+        with transaction() as conn:
+            cur = conn.execute("""UPDATE books SET
+                                  title=?,
+                                  publishers=?,
+                                  pubDate=?
+                                  WHERE isbn=?""",
+                               (title, publishers, publishDate, isbn))
+    except sqlite3.Error:
+        if (log != None):
+            log.exception(f"Failed to update book with isbn:{isbn}")
         return False
+    return cur.rowcount > 0
 
-def store_isbn(isbn: str, filePath: str, logger:Logger=None) -> bool:
+
+def store_isbn(isbn: str, filePath: str, logger: Logger = None) -> bool:
     """
-    
+        Stores an ISBN and the file it was found in without any metadata.
 
     Args:
         isbn (str): ISBN string for the book.
@@ -170,22 +653,250 @@ def store_isbn(isbn: str, filePath: str, logger:Logger=None) -> bool:
     Returns:
         bool: Whether or not the book was stored sucessfully.
     """
-    # Check if the ISBN already exists in the database
-    if isbn_exists(isbn):
-        return False
-    # Connect to the SQLite database
-    conn = sqlite3.connect(conn_string)
-    c = conn.cursor()
-    #   Try to store the information in the db. Otherwise log the info. 
+    return store_book(Book(None, isbn, None, None, filePath), logger)
+
+
+def get_scan_states() -> dict[str, tuple]:
+    """
+        Loads the fingerprint of every previously scanned file.
+
+    Returns:
+        dict[str, tuple]: (size, mtime_ns, hash, isbn, status) keyed by path.
+    """
+    with connection() as conn:
+        rows = conn.execute("SELECT path, size, mtime_ns, hash, isbn, status FROM scan_state")
+        return {row[0]: row[1:] for row in rows}
+
+
+def store_scan_states(states: Iterable[tuple], log: Logger = None) -> int:
+    """
+        Inserts or replaces file fingerprints in a single transaction. Errors
+        are logged, or raised when called inside another transaction.
+
+    Args:
+        states (Iterable[tuple]): (path, size, mtime_ns, hash, isbn, status) tuples.
+        log (Logger, optional): Log to write errors and exceptions to. Defaults to None.
+
+    Returns:
+        int: Number of fingerprints written.
+    """
+    now = time.time()
     try:
-        # Insert the ISBN into the database
-        c.execute(f"INSERT INTO books (isbn, path) VALUES ({isbn}, \"{filePath}\")")
+        with transaction() as conn:
+            cur = conn.executemany("""INSERT INTO scan_state
+                                      (path, size, mtime_ns, hash, isbn, status, scanned_at)
+                                      VALUES (?, ?, ?, ?, ?, ?, ?)
+                                      ON CONFLICT (path) DO UPDATE SET
+                                      size=excluded.size, mtime_ns=excluded.mtime_ns,
+                                      hash=excluded.hash, isbn=excluded.isbn,
+                                      status=excluded.status, scanned_at=excluded.scanned_at""",
+                                   (state + (now,) for state in states))
+            return cur.rowcount
+    except sqlite3.Error:
+        if _in_transaction():
+            raise
+        if log != None:
+            log.exception("Failed to store scan state in db.")
+        return 0
 
-        # Commit the changes and close the connection
-        conn.commit()
-    except:
-        if logger != None:
-            logger.exception(f"Failed to store {filePath} in db with ISBN: {isbn}")
-    conn.close()
 
-    return True
\ No newline at end of file
+#   States of a file in the scan queue
+JOB_PENDING: str = "pending"
+JOB_RUNNING: str = "running"
+JOB_DONE: str = "done"
+JOB_FAILED: str = "failed"
+
+
+def enqueue_scan_jobs(files: Iterable[tuple], retryFailed: bool = False, log: Logger = None) -> int:
+    """
+        Adds files to the scan queue in a single transaction. A file that's
+        already queued is only queued again if it's done or has changed since,
+        files that are running are left alone.
+
+    Args:
+        files (Iterable[tuple]): (path, size, mtime_ns) tuples.
+        retryFailed (bool, optional): Queue files that ran out of attempts
+        again with none used. Defaults to False.
+        log (Logger, optional): Log to write errors and exceptions to. Defaults to None.
+
+    Returns:
+        int: Number of files queued.
+    """
+    now = time.time()
+    try:
+        with transaction() as conn:
+            cur = conn.executemany("""INSERT INTO scan_jobs (path, size, mtime_ns, state, updated_at)
+                                      VALUES (?, ?, ?, 'pending', ?)
+                                      ON CONFLICT (path) DO UPDATE SET
+                                      size=excluded.size, mtime_ns=excluded.mtime_ns, state='pending',
+                                      attempts=0, owner=NULL, error=NULL, updated_at=excluded.updated_at
+                                      WHERE scan_jobs.state != 'running'
+                                      AND (scan_jobs.state = 'done' OR scan_jobs.size IS NOT excluded.size
+                                           OR scan_jobs.mtime_ns IS NOT excluded.mtime_ns
+                                           OR (? AND scan_jobs.state = 'failed'))""",
+                                   (file + (now, retryFailed) for file in files))
+            return cur.rowcount
+    except sqlite3.Error:
+        if log != None:
+            log.exception("Failed to queue files for scanning.")
+        return 0
+
+
+def claim_scan_jobs(owner: str, limit: int, maxAttempts: int = 3) -> [str]:
+    """
+        Marks up to limit queued files as running for owner. Pending files
+        come first in the order they were queued, then failed files that have
+        attempts left. The write lock is taken before reading, so processes
+        sharing the queue never claim the same file.
+
+    Args:
+        owner (str): Name of the claiming scan, e.g. "host:pid".
+        limit (int): Most files claimed.
+        maxAttempts (int, optional): Files that have been claimed this many
+        times aren't claimed again. Defaults to 3.
+
+    Returns:
+        [str]: Paths of the claimed files.
+    """
+    with transaction(immediate=True) as conn:
+        rows = conn.execute("""SELECT id, path FROM scan_jobs WHERE state='pending'
+                               ORDER BY id LIMIT ?""", (limit,)).fetchall()
+        if len(rows) < limit:
+            rows += conn.execute("""SELECT id, path FROM scan_jobs WHERE state='failed' AND attempts < ?
+                                    ORDER BY id LIMIT ?""", (maxAttempts, limit - len(rows))).fetchall()
+        now = time.time()
+        conn.executemany("""UPDATE scan_jobs SET state='running', owner=?, claimed_at=?,
+                            attempts=attempts + 1, updated_at=? WHERE id=?""",
+                         [(owner, now, now, row[0]) for row in rows])
+    return [row[1] for row in rows]
+
+
+def finish_scan_jobs(results: Iterable[tuple], log: Logger = None) -> None:
+    """
+        Records the outcome of claimed files in a single transaction. Errors
+        are logged, or raised when called inside another transaction.
+
+    Args:
+        results (Iterable[tuple]): (path, state, isbn, error) tuples where
+        state is JOB_DONE or JOB_FAILED.
+        log (Logger, optional): Log to write errors and exceptions to. Defaults to None.
+    """
+    now = time.time()
+    try:
+        with transaction() as conn:
+            conn.executemany("""UPDATE scan_jobs SET state=?, isbn=?, error=?, owner=NULL, updated_at=?
+                                WHERE path=?""",
+                             ((state, isbn, error, now, path) for path, state, isbn, error in results))
+    except sqlite3.Error:
+        if _in_transaction():
+            raise
+        if log != None:
+            log.exception("Failed to store scan job results in db.")
+
+
+def get_running_scan_jobs() -> dict[str, tuple]:
+    """
+        Loads the owner and claim time of every running file.
+
+    Returns:
+        dict[str, tuple]: (owner, claimed_at) keyed by path.
+    """
+    with connection() as conn:
+        rows = conn.execute("SELECT path, owner, claimed_at FROM scan_jobs WHERE state='running'")
+        return {row[0]: row[1:] for row in rows}
+
+
+def release_scan_jobs(paths: Iterable[str], countAttempt: bool = True) -> int:
+    """
+        Puts running files back in the queue, e.g. after the scan working on
+        them died.
+
+    Args:
+        paths (Iterable[str]): Files to release.
+        countAttempt (bool, optional): Whether the attempt they were claimed
+        with still counts. Defaults to True.
+
+    Returns:
+        int: Number of files released.
+    """
+    with transaction() as conn:
+        cur = conn.executemany("""UPDATE scan_jobs SET state='pending', owner=NULL, updated_at=?,
+                                  attempts=attempts - ? WHERE path=? AND state='running'""",
+                               ((time.time(), 0 if countAttempt else 1, path) for path in paths))
+        return cur.rowcount
+
+
+def scan_job_counts(maxAttempts: int = 3) -> dict[str, int]:
+    """
+        Counts the files in the scan queue by state. Failed files with
+        attempts left are counted as "retry".
+
+    Args:
+        maxAttempts (int, optional): Attempts a file gets. Defaults to 3.
+
+    Returns:
+        dict[str, int]: Number of files keyed by state.
+    """
+    with connection() as conn:
+        return dict(conn.execute("""SELECT CASE WHEN state='failed' AND attempts < ? THEN 'retry'
+                                    ELSE state END, count(*) FROM scan_jobs GROUP BY 1""", (maxAttempts,)))
+
+
+def _index_path(path: str) -> None:
+    if _libraryIndex != None and _libraryIndex[0] == conn_string:
+        with _indexLock:
+            _libraryIndex[1].add(None, path)
+
+
+def move_path(oldPath: str, newPath: str) -> None:
+    """
+        Points books and the scan state of a moved or renamed file at its new path.
+
+    Args:
+        oldPath (str): Path the file used to be at.
+        newPath (str): Path the file is at now.
+    """
+    with transaction() as conn:
+        conn.execute("UPDATE books SET path=? WHERE path=?", (newPath, oldPath))
+        conn.execute("DELETE FROM scan_state WHERE path=?", (oldPath,))
+        _after_commit(lambda: _index_path(newPath))
+
+
+def get_cached_responses(isbns: [str]) -> dict[str, tuple]:
+    """
+        Looks up cached metadata provider responses.
+
+    Args:
+        isbns ([str]): ISBNs to look up.
+
+    Returns:
+        dict[str, tuple]: (response, fetched_at) keyed by ISBN for every cached
+        ISBN. response is None for ISBNs the provider didn't know.
+    """
+    cached: dict[str, tuple] = {}
+    with connection() as conn:
+        #   Stay well under sqlite's limit on bound parameters
+        for i in range(0, len(isbns), 500):
+            chunk = isbns[i:i + 500]
+            rows = conn.execute(f"""SELECT isbn, response, fetched_at FROM meta_cache
+                                    WHERE isbn IN ({",".join("?" * len(chunk))})""", chunk)
+            for row in rows:
+                cached[row[0]] = row[1:]
+    return cached
+
+
+def store_cached_responses(responses: Iterable[tuple], log: Logger = None) -> None:
+    """
+        Inserts or replaces cached metadata provider responses.
+
+    Args:
+        responses (Iterable[tuple]): (isbn, response, fetched_at) tuples.
+        log (Logger, optional): Log to write errors and exceptions to. Defaults to None.
+    """
+    try:
+        with transaction() as conn:
+            conn.executemany("""INSERT OR REPLACE INTO meta_cache (isbn, response, fetched_at)
+                                VALUES (?, ?, ?)""", responses)
+    except sqlite3.Error:
+        if log != None:
+            log.exception("Failed to store metadata responses in db.")
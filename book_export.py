@@ -0,0 +1,125 @@
+#   Exporting the library to files
+#
+#   Every exporter takes rows from book_db.stream_books and writes them as
+#   they arrive, so exports use the same memory no matter how big the
+#   library is.
+import csv
+import json
+from itertools import islice
+from typing import BinaryIO, Iterable, TextIO
+
+#   Formats books can be exported in
+export_formats = ("table", "csv", "jsonl", "parquet")
+#   Formats written to binary files
+binary_formats = ("parquet",)
+#   Columns listed when none are chosen
+default_columns = ("isbn", "title", "publishers", "pubDate", "path")
+#   Widths of each column in the table format, the last column isn't padded
+table_widths = {"id": 8, "isbn": 14, "title": 60, "publishers": 30, "pubDate": 14, "path": 0}
+table_headers = {"id": "Id", "isbn": "ISBN", "title": "Title", "publishers": "Publishers",
+                 "pubDate": "Published", "path": "Path"}
+
+
+def export_table(rows: Iterable[tuple], columns: [str], out: TextIO) -> int:
+    """
+        Writes rows as fixed width text for reading in a terminal. Long values
+        are cut off and missing ones are left blank.
+
+    Args:
+        rows (Iterable[tuple]): Rows to write, e.g. from book_db.stream_books.
+        columns ([str]): Names of the columns in each row.
+        out (TextIO): File to write to.
+
+    Returns:
+        int: Number of rows written.
+    """
+    def line(values) -> str:
+        cells = []
+        for i, (column, value) in enumerate(zip(columns, values)):
+            text = "" if value == None else str(value)
+            width = table_widths[column]
+            if width > 0 and i < len(columns) - 1:
+                text = text[:width - 1].ljust(width)
+            cells.append(text)
+        return "".join(cells).rstrip() + "\n"
+
+    out.write(line([table_headers[column] for column in columns]))
+    count = 0
+    for row in rows:
+        out.write(line(row))
+        count += 1
+    return count
+
+
+def export_csv(rows: Iterable[tuple], columns: [str], out: TextIO) -> int:
+    """
+        Writes rows as csv with a header row.
+
+    Args:
+        rows (Iterable[tuple]): Rows to write, e.g. from book_db.stream_books.
+        columns ([str]): Names of the columns in each row.
+        out (TextIO): File opened with newline="".
+
+    Returns:
+        int: Number of rows written.
+    """
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def export_jsonl(rows: Iterable[tuple], columns: [str], out: TextIO) -> int:
+    """
+        Writes rows as JSON Lines, one object per line.
+
+    Args:
+        rows (Iterable[tuple]): Rows to write, e.g. from book_db.stream_books.
+        columns ([str]): Names of the columns in each row.
+        out (TextIO): File to write to.
+
+    Returns:
+        int: Number of rows written.
+    """
+    count = 0
+    for row in rows:
+        out.write(json.dumps(dict(zip(columns, row))) + "\n")
+        count += 1
+    return count
+
+
+def export_parquet(rows: Iterable[tuple], columns: [str], out: BinaryIO | str, rowGroupSize: int = 50000) -> int:
+    """
+        Writes rows as a Parquet file. Rows are collected into columns one row
+        group at a time, so memory is bounded by rowGroupSize. Needs pyarrow.
+
+    Args:
+        rows (Iterable[tuple]): Rows to write, e.g. from book_db.stream_books.
+        columns ([str]): Names of the columns in each row.
+        out (BinaryIO | str): Path or file opened in binary mode.
+        rowGroupSize (int, optional): Rows per Parquet row group. Defaults to 50000.
+
+    Returns:
+        int: Number of rows written.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Exporting to parquet needs pyarrow, install it with: pip install pyarrow")
+    schema = pyarrow.schema([(column, pyarrow.int64() if column == "id" else pyarrow.string())
+                             for column in columns])
+    rows = iter(rows)
+    count = 0
+    with pyarrow.parquet.ParquetWriter(out, schema) as writer:
+        while group := list(islice(rows, rowGroupSize)):
+            arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*group), schema)]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            count += len(group)
+    return count
+
+
+exporters = {"table": export_table, "csv": export_csv, "jsonl": export_jsonl, "parquet": export_parquet}
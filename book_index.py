@@ -0,0 +1,201 @@
+#   In-memory index of the ISBNs and paths already in the library
+#
+#   ISBNs are packed into integers and paths are hashed to 64 bits, both
+#   kept in sorted arrays, so a million books take about 16 MB and a lookup
+#   is a binary search instead of a database query.
+import hashlib
+from array import array
+from bisect import bisect_left
+from itertools import chain
+from typing import Iterable
+
+
+def pack_isbn(isbn: str) -> int | None:
+    """
+        Packs an ISBN into an integer. The digits, the length and a trailing
+        "X" check digit are all kept, so different strings never share a key.
+
+    Args:
+        isbn (str): ISBN-10 or ISBN-13 without hyphens.
+
+    Returns:
+        int | None: The packed ISBN, or None if it isn't 10 or 13 digits long.
+    """
+    #   Longer strings, like raw barcode digits, wouldn't fit in 64 bits
+    if not isbn or len(isbn) not in (10, 13):
+        return None
+    check = isbn[-1:]
+    x = check == "X" or check == "x"
+    digits = isbn[:-1] if x else isbn
+    if not digits.isdigit() or not digits.isascii():
+        return None
+    return (int(digits) << 6) | (len(isbn) << 1) | x
+
+
+def pack_path(path: str) -> int:
+    """
+        Hashes a path to a signed 64 bit integer. Two paths sharing a hash is
+        possible but won't happen in practice, one in 2^64 per pair.
+    """
+    digest = hashlib.blake2b(path.encode("utf-8", "surrogatepass"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+class SortedKeys:
+    """
+        Set of 64 bit integers in a sorted array. Added keys go into a small
+        set that is merged into the array once it grows, so adding stays cheap
+        and the array is only rebuilt now and then.
+    """
+    keys: array
+    added: set[int]
+
+    def __init__(self, keys: Iterable[int] = ()):
+        self.keys = array("q", sorted(keys))
+        self.added = set()
+
+    def __len__(self) -> int:
+        return len(self.keys) + len(self.added)
+
+    def __contains__(self, key: int) -> bool:
+        if key in self.added:
+            return True
+        keys = self.keys
+        i = bisect_left(keys, key)
+        return i < len(keys) and keys[i] == key
+
+    def add(self, key: int) -> None:
+        if key in self:
+            return
+        self.added.add(key)
+        if len(self.added) > max(4096, len(self.keys) // 8):
+            #   Both runs are sorted, so this is a linear merge
+            self.keys = array("q", sorted(chain(self.keys, sorted(self.added))))
+            self.added.clear()
+
+
+class BloomFilter:
+    """
+        Bloom filter over integer keys. A miss means the key was never added,
+        a hit means it probably was.
+    """
+    bits: bytearray
+    numBits: int
+    numHashes: int
+
+    def __init__(self, capacity: int, bitsPerKey: int = 10, numHashes: int = 5):
+        """
+        Args:
+            capacity (int): Number of keys expected. The false positive rate
+            rises past it.
+            bitsPerKey (int, optional): Bits per expected key, 10 gives about
+            1% false positives at capacity. Defaults to 10.
+            numHashes (int, optional): Bits set per key. Defaults to 5.
+        """
+        self.numBits = max(64, capacity * bitsPerKey)
+        self.numHashes = numHashes
+        self.bits = bytearray((self.numBits + 7) // 8)
+
+    def _hashes(self, key: int) -> tuple[int, int]:
+        #   Two multiplicative hashes of the key, combined as h1 + i * h2
+        h1 = ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 7
+        h2 = ((key * 0xC2B2AE3D27D4EB4F) & 0xFFFFFFFFFFFFFFFF) >> 7 | 1
+        return h1, h2
+
+    def add(self, key: int) -> None:
+        h1, h2 = self._hashes(key)
+        for i in range(self.numHashes):
+            pos = (h1 + i * h2) % self.numBits
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: int) -> bool:
+        h1, h2 = self._hashes(key)
+        bits = self.bits
+        numBits = self.numBits
+        for i in range(self.numHashes):
+            pos = (h1 + i * h2) % numBits
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class LibraryIndex:
+    """
+        Which ISBNs and paths are already catalogued, checked before a found
+        book is looked up online or written to the database.
+
+        An ISBN in the index is certainly stored. An ISBN that isn't might
+        still have been stored by another process since the index was loaded,
+        so misses should still be written with INSERT OR IGNORE. ISBNs that
+        can't be packed aren't indexed and have to be checked in the database.
+
+        Usage:
+            index = LibraryIndex(book_db.stream_books(["isbn", "path"]))
+            if not index.has_isbn(isbn):
+                fetch_and_store(isbn)
+                index.add(isbn, path)
+    """
+    isbns: SortedKeys
+    paths: SortedKeys
+    bloom: BloomFilter | None
+
+    def __init__(self, rows: Iterable[tuple[str, str]] = (), bloom: bool = False):
+        """
+        Args:
+            rows (Iterable[tuple[str, str]], optional): (isbn, path) of every
+            stored book.
+            bloom (bool, optional): Put a Bloom filter in front of the ISBN
+            lookups. Only worth it when most lookups miss. Defaults to False.
+        """
+        isbnKeys = array("q")
+        pathKeys = array("q")
+        for isbn, path in rows:
+            key = pack_isbn(isbn)
+            if key != None:
+                isbnKeys.append(key)
+            if path:
+                pathKeys.append(pack_path(path))
+        self.isbns = SortedKeys(isbnKeys)
+        self.paths = SortedKeys(pathKeys)
+        self.bloom = None
+        if bloom:
+            #   Room for the library to double before it fills up
+            self.bloom = BloomFilter(2 * len(self.isbns) + 1024)
+            for key in self.isbns.keys:
+                self.bloom.add(key)
+
+    def __len__(self) -> int:
+        return len(self.isbns)
+
+    def has_isbn(self, isbn: str) -> bool | None:
+        """
+            Checks whether an ISBN is catalogued.
+
+        Returns:
+            bool | None: Whether the ISBN is stored, None if it can't be
+            packed and has to be looked up in the database.
+        """
+        key = pack_isbn(isbn)
+        if key == None:
+            return None
+        if self.bloom != None and key not in self.bloom:
+            return False
+        return key in self.isbns
+
+    def has_path(self, path: str) -> bool:
+        """
+            Checks whether a book with this path is catalogued.
+        """
+        return pack_path(path) in self.paths
+
+    def add(self, isbn: str, path: str = None) -> None:
+        """
+            Records a stored book.
+        """
+        key = pack_isbn(isbn)
+        if key != None:
+            self.isbns.add(key)
+            if self.bloom != None:
+                self.bloom.add(key)
+        if path:
+            self.paths.add(pack_path(path))
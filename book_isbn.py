@@ -0,0 +1,138 @@
+#   Finding and validating ISBNs in text
+import re
+
+#   Variables
+isbnPattern = r"(\b978(?:-?\d){10}\b)|(\b978(?:-?\d){9}(?:-?X|x))|(\b(?:-?\d){10})\b|(\b(?:-?\d){9}(?:-?X|x)\b)"
+
+#   A single pass pattern for every ISBN-10 and ISBN-13 candidate. Digits may
+#   be split by hyphens or single spaces, which OCR often produces, and an
+#   optional "ISBN" label in front of the number is captured so labelled
+#   numbers can be preferred.
+candidateRegex = re.compile(r"""
+    (?:
+        (?P<label>\bISBN(?:[-\s]?1[03])?\s*(?:\([^)\n]{0,20}\)\s*)?[:#-]?\s*)
+        |(?<![\dXx-])
+    )
+    (?P<number>
+        97[89](?:[-\s]?\d){10}
+        |\d(?:[-\s]?\d){8}[-\s]?[\dXx]
+    )
+    (?![\dXx])
+    """, re.IGNORECASE | re.VERBOSE)
+separatorRegex = re.compile(r"[-\s]")
+
+
+class IsbnCandidate:
+    """
+        A checksum-valid ISBN found in text.
+    """
+    isbn: str
+    start: int
+    labelled: bool
+
+    def __init__(self, isbn: str, start: int, labelled: bool):
+        self.isbn = isbn
+        self.start = start
+        self.labelled = labelled
+
+    def __repr__(self) -> str:
+        return f"IsbnCandidate({self.isbn!r}, {self.start}, labelled={self.labelled})"
+
+
+def is_isbn10_checksum(digits: str) -> bool:
+    """
+        Checks the mod 11 checksum of an ISBN-10 without separators.
+    """
+    total = 0
+    for i, c in enumerate(digits):
+        value = 10 if c in "Xx" else ord(c) - 48
+        total += (10 - i) * value
+    return total % 11 == 0
+
+
+def is_isbn13_checksum(digits: str) -> bool:
+    """
+        Checks the mod 10 checksum of an ISBN-13 without separators.
+    """
+    total = 0
+    for i, c in enumerate(digits):
+        total += (ord(c) - 48) * (3 if i % 2 else 1)
+    return total % 10 == 0
+
+
+def isbn_candidates(text: str, labelledOnly: bool = False) -> [IsbnCandidate]:
+    """
+        Finds every checksum-valid ISBN in text in a single pass. Numbers that
+        fail their checksum, like phone numbers, are dropped without calling
+        isbnlib.
+
+    Args:
+        text (str): Text to search.
+        labelledOnly (bool, optional): Only keep numbers labelled "ISBN". Defaults to False.
+
+    Returns:
+        [IsbnCandidate]: Unique candidates as ISBN-13s, ranked with labelled
+        numbers first, then by position in the text.
+    """
+    candidates: dict[str, IsbnCandidate] = {}
+    for match in candidateRegex.finditer(text):
+        labelled = match.group("label") != None
+        if labelledOnly and not labelled:
+            continue
+        digits = separatorRegex.sub("", match.group("number"))
+        if len(digits) == 13:
+            if not digits.isdigit() or not is_isbn13_checksum(digits):
+                continue
+            isbn = digits
+        else:
+            if not is_isbn10_checksum(digits):
+                continue
+            import isbnlib
+            isbn = isbnlib.to_isbn13(digits.upper())
+            if not isbn:
+                continue
+        if isbn not in candidates:
+            candidates[isbn] = IsbnCandidate(isbn, match.start("number"), labelled)
+        elif labelled:
+            candidates[isbn].labelled = True
+    return sorted(candidates.values(), key=lambda c: (not c.labelled, c.start))
+
+
+def validate_and_convert(isbn: str) -> str | None:
+    """
+        Sanitizes then validates an isbn using isbnlib. If its isbn10 it is then converted
+        to isbn13 and returned.
+
+        Args:
+            isbn (str): Isbn to be validated as a string.
+
+        Returns:
+            str | None: The valid isbn as an ISBN-13 or None if invalid.
+    """
+    #   isbnlib takes a while to import and the DB-only commands never need it
+    import isbnlib
+    isbn = isbn.replace("-", "").replace(" ", "")
+    if isbnlib.is_isbn10(isbn):
+        return isbnlib.to_isbn13(isbn)
+    if isbnlib.is_isbn13(isbn):
+        return isbn
+    return None
+
+
+#   Uses regex to find an isbn in text
+#   Returns the best result or None
+def find_isbn_in_text(text: str) -> str | None:
+    """
+        Uses Regex to parse text for a valid isbn string. Every candidate in
+        the text is considered so an invalid number doesn't hide a real ISBN.
+
+    Args:
+        text (str): Text string to be parsed for a valid isbn.
+
+    Returns:
+        str | None: Either a valid isbn or None.
+    """
+    candidates = isbn_candidates(text)
+    if candidates:
+        return candidates[0].isbn
+    return None
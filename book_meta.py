@@ -1,11 +1,155 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
+import queue
+import threading
+import time
+from logging import Logger
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from book import Book
+import book_db
+
+
+class MetadataCache:
+    """
+        Caches raw provider responses in the meta_cache table with a small
+        in-memory LRU in front of it. ISBNs the provider didn't know are
+        cached too, with a shorter TTL, so they aren't queried on every scan.
+    """
+    #   Seconds before a cached response is fetched again
+    ttl: float
+    #   Seconds before an ISBN the provider didn't know is tried again
+    negativeTtl: float
+    lruSize: int
+    lru: OrderedDict
+    log: Logger
+
+    def __init__(self, ttl: float = 30 * 86400, negativeTtl: float = 86400,
+                 lruSize: int = 4096, log: Logger = None):
+        """
+        Args:
+            ttl (float, optional): Seconds a response stays valid. Defaults to 30 days.
+            negativeTtl (float, optional): Seconds a not-found result stays valid. Defaults to 1 day.
+            lruSize (int, optional): Responses kept in memory. Defaults to 4096.
+            log (Logger, optional): Log to write errors and exceptions to. Defaults to None.
+        """
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.lruSize = lruSize
+        self.log = log
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _fresh(self, entry: dict | None, fetchedAt: float, now: float) -> bool:
+        ttl = self.ttl if entry != None else self.negativeTtl
+        return now - fetchedAt < ttl
+
+    def _remember(self, isbn: str, entry: dict | None, fetchedAt: float) -> None:
+        with self.lock:
+            self.lru[isbn] = (entry, fetchedAt)
+            self.lru.move_to_end(isbn)
+            while len(self.lru) > self.lruSize:
+                self.lru.popitem(last=False)
+
+    def get_many(self, isbns: [str], allowStale: bool = False) -> dict[str, dict | None]:
+        """
+            Looks up cached responses.
+
+        Args:
+            isbns ([str]): ISBNs to look up.
+            allowStale (bool, optional): Also return expired responses. Defaults to False.
+
+        Returns:
+            dict[str, dict | None]: Response entries keyed by ISBN for every
+            ISBN with a usable cached response. The entry is None for ISBNs the
+            provider didn't know.
+        """
+        now = time.time()
+        found: dict[str, dict | None] = {}
+        lookup: [str] = []
+        with self.lock:
+            for isbn in isbns:
+                item = self.lru.get(isbn)
+                if item != None and (allowStale or self._fresh(item[0], item[1], now)):
+                    self.lru.move_to_end(isbn)
+                    found[isbn] = item[0]
+                else:
+                    lookup.append(isbn)
+        if lookup:
+            for isbn, (response, fetchedAt) in book_db.get_cached_responses(lookup).items():
+                entry = json.loads(response) if response != None else None
+                if allowStale or self._fresh(entry, fetchedAt, now):
+                    found[isbn] = entry
+                    self._remember(isbn, entry, fetchedAt)
+        return found
+
+    def put_many(self, entries: dict[str, dict | None]) -> None:
+        """
+            Caches responses.
+
+        Args:
+            entries (dict[str, dict | None]): Response entries keyed by ISBN,
+            None for ISBNs the provider didn't know.
+        """
+        now = time.time()
+        book_db.store_cached_responses(
+            [(isbn, json.dumps(entry) if entry != None else None, now) for isbn, entry in entries.items()],
+            self.log)
+        for isbn, entry in entries.items():
+            self._remember(isbn, entry, now)
+
 
 class OpenLibraryProvider:
     baseUrl: str = "https://openlibrary.org"
-    
+    #   Seconds to wait for a connection and for a response
+    timeout: float = 10
+    #   Number of ISBNs sent as bibkeys in one request
+    batchSize: int = 50
+    #   Number of requests allowed in flight at once
+    maxConcurrency: int = 4
+    session: requests.Session
+    cache: MetadataCache
+    #   Only answer from the cache and never touch the network
+    offline: bool = False
+    log: Logger
+
+    def __init__(self, baseUrl: str = None, timeout: float = 10, retries: int = 3,
+                 backoff: float = 0.5, batchSize: int = 50, maxConcurrency: int = 4,
+                 cache: MetadataCache = None, offline: bool = False, log: Logger = None):
+        """
+        Args:
+            baseUrl (str, optional): Api root, useful for pointing at a local
+            stub server. Defaults to https://openlibrary.org.
+            timeout (float, optional): Seconds before a request times out. Defaults to 10.
+            retries (int, optional): Retries for connection errors and 429/5xx responses. Defaults to 3.
+            backoff (float, optional): Backoff factor between retries in seconds. Defaults to 0.5.
+            batchSize (int, optional): ISBNs per request. Defaults to 50.
+            maxConcurrency (int, optional): Requests in flight at once. Defaults to 4.
+            cache (MetadataCache, optional): Cache for responses. Defaults to None.
+            offline (bool, optional): Only use cached responses, including
+            expired ones. Defaults to False.
+            log (Logger, optional): Log to write failed requests to. Defaults to None.
+        """
+        if baseUrl != None:
+            self.baseUrl = baseUrl.rstrip("/")
+        self.timeout = timeout
+        self.batchSize = batchSize
+        self.maxConcurrency = maxConcurrency
+        self.cache = cache
+        self.offline = offline
+        self.log = log
+        #   One pooled session so connections are kept alive between requests
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=("GET",))
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=maxConcurrency,
+                              pool_maxsize=maxConcurrency)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     def fetch_book(self, isbn: str) -> Book:
         """
             Fetches a book from OpenLibrary's api.
@@ -13,23 +157,77 @@ class OpenLibraryProvider:
             isbn (str): Book's isbn as a string.
 
         Returns:
-            [str]: List containing title, publishers, and publish date.
-        """
-        request_url = self.baseUrl + f"/api/books?bibkeys=ISBN:{isbn}&format=json&jscmd=data"
-        response = requests.get(request_url)
-        if response.ok:
-            data = response.json()
-            root = ""
-            for key in data:
-                #print(key, ":", data[key])
-                root = key
-            pubData = self.merge_pub_data(data[root]["publishers"])
-            b = Book(data[root]["title"], isbn, pubData, data[root]["publish_date"])
-            return b
-        return None
-    
+            Book: Book with its title, publishers, and publish date or None
+            if OpenLibrary doesn't know the ISBN.
+        """
+        return self.fetch_books([isbn]).get(isbn)
+
+    def fetch_books(self, isbns: [str]) -> dict[str, Book]:
+        """
+            Fetches many books from OpenLibrary's api. Cached responses are used
+            first, the rest are sent batchSize at a time as bibkeys with up to
+            maxConcurrency requests running at once.
+
+        Args:
+            isbns ([str]): ISBNs to look up.
+
+        Returns:
+            dict[str, Book]: Books keyed by ISBN. ISBNs OpenLibrary doesn't know
+            or whose request failed are left out.
+        """
+        isbns = list(OrderedDict.fromkeys(isbns))
+        entries: dict[str, dict | None] = {}
+        if self.cache != None:
+            entries = self.cache.get_many(isbns, allowStale=self.offline)
+        missing = [isbn for isbn in isbns if isbn not in entries]
+        if missing and not self.offline:
+            fetched = self._fetch_entries(missing)
+            if self.cache != None and fetched:
+                self.cache.put_many(fetched)
+            entries.update(fetched)
+        return {isbn: self.book_from_data(isbn, entry) for isbn, entry in entries.items() if entry != None}
+
+    def _fetch_entries(self, isbns: [str]) -> dict[str, dict | None]:
+        #   Raw entries keyed by ISBN, None for ISBNs OpenLibrary doesn't know.
+        #   ISBNs whose request failed are left out so they aren't cached.
+        batches = [isbns[i:i + self.batchSize] for i in range(0, len(isbns), self.batchSize)]
+        if len(batches) == 1:
+            results = [self._fetch_batch(batches[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=self.maxConcurrency) as pool:
+                results = list(pool.map(self._fetch_batch, batches))
+        entries: dict[str, dict | None] = {}
+        for batch, data in zip(batches, results):
+            if data == None:
+                continue
+            for isbn in batch:
+                entries[isbn] = data.get(f"ISBN:{isbn}")
+        return entries
+
+    def _fetch_batch(self, isbns: [str]) -> dict | None:
+        bibkeys = ",".join(f"ISBN:{isbn}" for isbn in isbns)
+        request_url = self.baseUrl + f"/api/books?bibkeys={bibkeys}&format=json&jscmd=data"
+        try:
+            response = self.session.get(request_url, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, json.JSONDecodeError):
+            if self.log != None:
+                self.log.exception(f"Failed to fetch metadata for {len(isbns)} ISBNs")
+            return None
+
+    @staticmethod
+    def book_from_data(isbn: str, entry: dict) -> Book:
+        """
+            Builds a book from one entry of an /api/books response.
+        """
+        pubData = OpenLibraryProvider.merge_pub_data(entry.get("publishers", []))
+        return Book(entry.get("title"), isbn, pubData, entry.get("publish_date"))
+
+    @staticmethod
     def merge_pub_data(data) -> str:
-        """_summary_
+        """
+            Joins publisher names into one string.
 
         Args:
             data : Publisher data as returned by the OpenLibrary api call.
@@ -40,4 +238,119 @@ class OpenLibraryProvider:
         retStr = ""
         for item in data:
             retStr += (item["name"] + ";")
-        return retStr
\ No newline at end of file
+        return retStr
+
+
+class MetadataFetcher:
+    """
+        Pipeline stage that looks up metadata on a background thread so file
+        parsing doesn't wait on the network. ISBNs submitted close together are
+        grouped into one batched request.
+
+        Usage:
+            fetcher = MetadataFetcher(OpenLibraryProvider())
+            fetcher.submit(isbn, path)
+            books = fetcher.ready()     # finished books, doesn't block
+            books += fetcher.close()    # waits for the rest
+    """
+    _stop = object()
+
+    def __init__(self, provider: OpenLibraryProvider, batchSize: int = 50, maxWait: float = 0.5,
+                 metrics=None):
+        """
+        Args:
+            provider (OpenLibraryProvider): Provider used for lookups.
+            batchSize (int, optional): Most ISBNs looked up at once. Defaults to 50.
+            maxWait (float, optional): Seconds to wait for a batch to fill up. Defaults to 0.5.
+            metrics (ScanMetrics, optional): Records the time of each lookup
+            as the "fetch" stage. Defaults to None.
+        """
+        self.provider = provider
+        self.metrics = metrics
+        self.batchSize = batchSize
+        self.maxWait = maxWait
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="metadata-fetcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, isbn: str, path: str) -> None:
+        """
+            Queues an ISBN for lookup. The finished book will have its path set
+            to path and no metadata if none was found.
+        """
+        self.requests.put((isbn, path))
+
+    def ready(self) -> [Book]:
+        """
+            Returns every book that has finished since the last call without blocking.
+        """
+        books: [Book] = []
+        while True:
+            try:
+                books.append(self.results.get_nowait())
+            except queue.Empty:
+                return books
+
+    def close(self) -> [Book]:
+        """
+            Waits for all queued lookups to finish and returns the remaining books.
+        """
+        self.requests.put(self._stop)
+        self.thread.join()
+        return self.ready()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.maxWait
+            while len(batch) < self.batchSize and batch[-1] is not self._stop:
+                try:
+                    batch.append(self.requests.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is self._stop:
+                stopping = True
+                batch.pop()
+            if not batch:
+                continue
+            start = time.perf_counter()
+            try:
+                metas = self.provider.fetch_books([isbn for isbn, _ in batch])
+            except Exception:
+                metas = {}
+            if self.metrics != None:
+                self.metrics.record("fetch", time.perf_counter() - start)
+            for isbn, path in batch:
+                meta = metas.get(isbn)
+                if meta == None:
+                    book = Book(None, isbn, None, None, path)
+                else:
+                    book = Book(meta.title, isbn, meta.publishers, meta.publish_date, path)
+                self.results.put(book)
+
+
+def enrich_books(provider: OpenLibraryProvider, log: Logger = None) -> int:
+    """
+        Looks up metadata for every stored book that doesn't have any yet.
+        Lookups are made a few batches at a time so each group can use the
+        provider's concurrency and is written in one transaction.
+
+    Args:
+        provider (OpenLibraryProvider): Provider used for lookups.
+        log (Logger, optional): Log to write errors and exceptions to. Defaults to None.
+
+    Returns:
+        int: Number of books that were updated.
+    """
+    isbns = book_db.get_isbns_missing_metadata()
+    step = provider.batchSize * provider.maxConcurrency
+    updated = 0
+    for i in range(0, len(isbns), step):
+        books = provider.fetch_books(isbns[i:i + step])
+        with book_db.transaction():
+            for isbn, book in books.items():
+                updated += book_db.update_meta_data(isbn, book.title, book.publishers,
+                                                    book.publish_date, log)
+    return updated
@@ -0,0 +1,366 @@
+#   Timing, progress and reports for directory scans
+import cProfile
+import csv
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+#   Stages timed inside parse_file, in the order they usually run. Each OCR
+#   pass is timed as "ocr_<pass name>".
+file_stages = ("metadata", "text", "render", "ocr_fast", "ocr_crop", "ocr_full", "epub", "regex")
+#   Stages timed in the scanning process
+scan_stages = ("walk", "fingerprint", "fetch", "db")
+
+#   Timings of the file being parsed by the calling thread
+_local = threading.local()
+
+
+@contextmanager
+def collect_timings():
+    """
+        Context manager that collects the time spent in each timed stage by
+        the calling thread. Stages that are entered more than once add up.
+
+        Usage:
+            with collect_timings() as timings:
+                parse(...)
+            timings["render"]
+    """
+    previous = getattr(_local, "timings", None)
+    timings: dict[str, float] = {}
+    _local.timings = timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+@contextmanager
+def timed(stage: str):
+    """
+        Context manager that adds the time spent in its body to stage. Does
+        nothing outside collect_timings.
+    """
+    timings = getattr(_local, "timings", None)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def _summarise(samples: [float]) -> dict:
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        "count": len(ordered),
+        "seconds": total,
+        "mean_ms": total / len(ordered) * 1000 if ordered else 0.0,
+        "p50_ms": ordered[len(ordered) // 2] * 1000 if ordered else 0.0,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000 if ordered else 0.0,
+        "max_ms": ordered[-1] * 1000 if ordered else 0.0,
+    }
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class ScanMetrics:
+    """
+        Collects per-file and per-stage timings of a directory scan, shows
+        live progress with an ETA and writes a report when the scan is done.
+
+        Stages timed in worker processes come back on each ParseResult, the
+        walk, fetch and db stages are timed in the scanning process and are
+        only reported in total.
+
+        The total used for the ETA can be given up front or counted with
+        discover while the files are still being found.
+
+        Usage:
+            metrics = ScanMetrics()
+            metrics.start(len(files))
+            for res in scan_files(files):
+                metrics.add_result(res)
+            with metrics.timed("db"):
+                store_books(...)
+            metrics.finish()
+            metrics.write_report("scan.json")
+    """
+    progress: bool
+    interval: float
+    total: int | None
+    files: [dict]
+    stages: dict[str, list]
+    counts: dict[str, int]
+
+    def __init__(self, progress: bool = True, interval: float = None, stream=None):
+        """
+        Args:
+            progress (bool, optional): Show progress while scanning. Defaults to True.
+            interval (float, optional): Seconds between progress updates. Defaults
+            to 0.5 on a terminal and 10 otherwise.
+            stream (optional): Where progress is written. Defaults to stdout.
+        """
+        self.stream = stream or sys.stdout
+        self.progress = progress
+        self.tty = self.stream.isatty()
+        self.interval = interval if interval != None else (0.5 if self.tty else 10)
+        self.total = None
+        self.walking = False
+        self.skipped = 0
+        self.files = []
+        self.stages = {stage: [] for stage in file_stages + scan_stages}
+        self.counts = {"found": 0, "missing": 0, "error": 0}
+        self.lock = threading.Lock()
+        self.started = None
+        self.elapsed = 0.0
+        self.lastReport = 0.0
+
+    def start(self, total: int = None) -> None:
+        """
+            Starts the scan clock.
+
+        Args:
+            total (int, optional): Number of files that will be scanned, used
+            for the ETA. Leave out to count them with discover.
+        """
+        self.total = total
+        self.walking = total == None
+        self.started = time.time()
+        self.startClock = time.perf_counter()
+
+    def discover(self, *args) -> None:
+        """
+            Counts a file found by the directory walk towards the total. Safe
+            to call from any thread.
+        """
+        with self.lock:
+            self.total = (self.total or 0) + 1
+
+    def end_walk(self) -> None:
+        """
+            Marks the total as final once the directory walk is done.
+        """
+        self.walking = False
+
+    def skip(self) -> None:
+        """
+            Counts a discovered file that didn't need parsing.
+        """
+        with self.lock:
+            self.skipped += 1
+        self.show_progress()
+
+    def record(self, stage: str, seconds: float) -> None:
+        """
+            Adds a timing to a stage. Safe to call from any thread.
+        """
+        with self.lock:
+            self.stages.setdefault(stage, []).append(seconds)
+
+    @contextmanager
+    def timed(self, stage: str):
+        """
+            Context manager that records the time spent in its body to stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def add_result(self, res) -> None:
+        """
+            Records a finished file and updates the progress line.
+
+        Args:
+            res (ParseResult): Result of parsing the file.
+        """
+        status = "error" if res.error != None else ("found" if res.isbn != None else "missing")
+        with self.lock:
+            self.counts[status] += 1
+            for stage, seconds in res.timings.items():
+                self.stages.setdefault(stage, []).append(seconds)
+            self.files.append({"path": res.filePath, "kind": res.kind, "status": status,
+                               "tier": res.tier, "isbn": res.isbn, "seconds": res.seconds,
+                               "error": res.error, **res.timings})
+        self.show_progress()
+
+    @property
+    def done(self) -> int:
+        return len(self.files)
+
+    def show_progress(self, force: bool = False) -> None:
+        """
+            Writes the progress line if the update interval has passed.
+        """
+        if not self.progress or self.started == None:
+            return
+        now = time.perf_counter()
+        if not force and now - self.lastReport < self.interval:
+            return
+        self.lastReport = now
+        elapsed = now - self.startClock
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        finished = self.done + self.skipped
+        line = f"{finished}"
+        if self.total:
+            line += f"/{self.total}{'+' if self.walking else ''} files {finished / self.total:6.1%}"
+        else:
+            line += " files"
+        line += f"  {rate:.2f} files/s"
+        if self.total and rate > 0:
+            line += f"  ETA {_format_duration((self.total - finished) / rate)}"
+        if self.skipped:
+            line += f"  {self.skipped} unchanged"
+        #   Where the time is going so far
+        totals = {stage: sum(samples) for stage, samples in self.stages.items() if samples}
+        busy = sum(totals.values())
+        if busy > 0:
+            top = sorted(totals.items(), key=lambda item: -item[1])[:3]
+            line += "  " + " ".join(f"{stage} {seconds / busy:.0%}" for stage, seconds in top)
+        if self.tty:
+            self.stream.write("\r" + line.ljust(100)[:100])
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def finish(self) -> None:
+        """
+            Stops the scan clock and ends the progress line.
+        """
+        if self.started != None:
+            self.elapsed = time.perf_counter() - self.startClock
+        if self.progress and self.started != None:
+            self.show_progress(force=True)
+            if self.tty:
+                self.stream.write("\n")
+
+    def summary(self) -> dict:
+        """
+            Summarises the scan.
+
+        Returns:
+            dict: File counts, throughput and the timing of every stage that ran.
+        """
+        with self.lock:
+            stages = {stage: _summarise(samples) for stage, samples in self.stages.items() if samples}
+            slowest = sorted(self.files, key=lambda f: -f["seconds"])[:10]
+            kinds: dict[str, int] = {}
+            tiers: dict[str, int] = {}
+            for f in self.files:
+                kinds[f["kind"]] = kinds.get(f["kind"], 0) + 1
+                if f["tier"] != None:
+                    tiers[f["tier"]] = tiers.get(f["tier"], 0) + 1
+            ocrPasses = self._ocr_passes()
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)) if self.started else None,
+            "seconds": self.elapsed,
+            "files": self.done,
+            "files_per_s": self.done / self.elapsed if self.elapsed > 0 else 0.0,
+            "skipped": self.skipped,
+            **self.counts,
+            "kinds": kinds,
+            "tiers": tiers,
+            "ocr_passes": ocrPasses,
+            "stages": stages,
+            "slowest": [{"path": f["path"], "seconds": f["seconds"]} for f in slowest],
+        }
+
+    def _ocr_passes(self) -> dict[str, dict]:
+        #   How often each OCR pass found an ISBN in the files it ran on. A
+        #   pass ran on a file if the file has a timing for it.
+        passes: dict[str, dict] = {}
+        for f in self.files:
+            for key, value in f.items():
+                if not key.startswith("ocr_"):
+                    continue
+                p = passes.setdefault(key, {"files": 0, "hits": 0, "seconds": 0.0})
+                p["files"] += 1
+                p["seconds"] += value
+                if f["tier"] == key:
+                    p["hits"] += 1
+        for p in passes.values():
+            p["hit_rate"] = p["hits"] / p["files"]
+            p["mean_s"] = p["seconds"] / p["files"]
+        return passes
+
+    def print_summary(self) -> None:
+        """
+            Prints the time spent in each stage and how well each OCR pass did.
+        """
+        summary = self.summary()
+        stages = summary["stages"]
+        busy = sum(s["seconds"] for s in stages.values())
+        if busy <= 0:
+            return
+        print(f"Scanned in {_format_duration(self.elapsed)}. Time by stage:")
+        for stage, s in sorted(stages.items(), key=lambda item: -item[1]["seconds"]):
+            print(f"  {stage:12s}{s['seconds']:10.1f}s {s['seconds'] / busy:6.1%}"
+                  f"  mean {s['mean_ms']:.1f}ms  p95 {s['p95_ms']:.1f}ms")
+        if summary["ocr_passes"]:
+            print("ISBNs found by each OCR pass:")
+            for name, p in summary["ocr_passes"].items():
+                print(f"  {name:12s}{p['hits']:6d} of {p['files']:<6d}{p['hit_rate']:6.1%}"
+                      f"  mean {p['mean_s']:.2f}s per file")
+
+    def write_report(self, path: str) -> None:
+        """
+            Writes the scan report. A .csv path gets one row per file with a
+            column for each stage, anything else gets the json summary
+            including every file.
+
+        Args:
+            path (str): File to write the report to.
+        """
+        if path.lower().endswith(".csv"):
+            #   Stages that aren't in file_stages, e.g. custom OCR passes, get
+            #   a column too
+            stages = [stage for stage in self.stages if stage not in scan_stages]
+            columns = ["path", "kind", "status", "tier", "isbn", "seconds", *stages, "error"]
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, columns, extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(self.files)
+            return
+        report = self.summary()
+        report["file_results"] = self.files
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+@contextmanager
+def profiled(path: str = None, top: int = 25):
+    """
+        Context manager that runs its body under cProfile. Only the calling
+        process is profiled, so scan with one worker to see the parsing code.
+
+    Args:
+        path (str, optional): File the raw stats are dumped to for pstats or
+        snakeviz. Nothing is profiled if None.
+        top (int, optional): Number of functions printed by cumulative time. Defaults to 25.
+    """
+    if path == None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(top)
+        print(out.getvalue())
+        print(f"Saved profile to {path}")
@@ -0,0 +1,471 @@
+#   OCR of rendered pdf pages
+#
+#   Pages are OCR'd in passes that get slower and more thorough. The first
+#   pass reads small, black and white renders looking only for the
+#   characters of a labelled ISBN, later passes render at a higher
+#   resolution and read everything. Most books stop at the first pass.
+#
+#   Tesseract is driven through an OcrBackend. The tesserocr backend keeps
+#   one engine loaded per process and hands it images in memory, pytesseract
+#   starts a tesseract process and writes a temporary file for every image.
+#   Pillow and the backends are only imported once a page is OCR'd.
+from __future__ import annotations
+
+import importlib.util
+import os
+from abc import ABC, abstractmethod
+import re
+import shlex
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+from book_isbn import isbn_candidates
+from book_metrics import timed
+
+#   Words that label an ISBN once OCR'd, including common misreads
+isbnLabelRegex = re.compile(r"^[I1l|]S[B8]N", re.IGNORECASE)
+#   Characters of a labelled ISBN
+isbn_whitelist = "0123456789-XISBN:"
+
+
+def otsu_threshold(image: Image.Image) -> int:
+    """
+        Picks the grey level that best splits a grayscale image into ink and
+        paper using Otsu's method on its histogram.
+    """
+    histogram = image.histogram()[:256]
+    total = sum(histogram)
+    weightedTotal = sum(i * count for i, count in enumerate(histogram))
+    background = 0
+    weightedBackground = 0.0
+    best = 0.0
+    threshold = 127
+    for level, count in enumerate(histogram):
+        background += count
+        if background == 0:
+            continue
+        foreground = total - background
+        if foreground == 0:
+            break
+        weightedBackground += level * count
+        meanBackground = weightedBackground / background
+        meanForeground = (weightedTotal - weightedBackground) / foreground
+        variance = background * foreground * (meanBackground - meanForeground) ** 2
+        if variance > best:
+            best = variance
+            threshold = level
+    return threshold
+
+
+def preprocess(image: Image.Image, mode: str) -> Image.Image:
+    """
+        Prepares a rendered page for OCR.
+
+    Args:
+        image (Image): Rendered page.
+        mode (str): "gray" for grayscale, "binary" for black and white split
+        at the Otsu threshold, anything else leaves the image as it is.
+
+    Returns:
+        Image: The prepared page.
+    """
+    if mode not in ("gray", "binary"):
+        return image
+    if image.mode != "L":
+        image = image.convert("L")
+    if mode == "binary":
+        threshold = otsu_threshold(image)
+        image = image.point([0 if level <= threshold else 255 for level in range(256)])
+    return image
+
+
+def isbn_regions(data: dict, height: int) -> [tuple[float, float, float, float]]:
+    """
+        Finds the lines of an OCR'd page that start with an ISBN label.
+
+    Args:
+        data (dict): Output of OcrBackend.image_to_data.
+        height (int): Height of the OCR'd image.
+
+    Returns:
+        [tuple]: (left, top, right, bottom) of each region as fractions of
+        the page, the full width of the page from a line above the label to
+        two lines below it.
+    """
+    regions = []
+    for i, word in enumerate(data["text"]):
+        if not isbnLabelRegex.match(word.strip()):
+            continue
+        top = data["top"][i]
+        lineHeight = max(data["height"][i], 1)
+        regions.append((0.0, max(0, top - lineHeight) / height,
+                        1.0, min(height, top + 3 * lineHeight) / height))
+    return regions
+
+
+def _data_text(data: dict) -> str:
+    #   Rebuilds the page text from image_to_data, one line per OCR line
+    lines: dict[tuple, list] = {}
+    for i, word in enumerate(data["text"]):
+        if word.strip():
+            key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            lines.setdefault(key, []).append(word)
+    return "\n".join(" ".join(words) for words in lines.values())
+
+
+def parse_config(config: str) -> tuple[int | None, dict[str, str]]:
+    """
+        Reads the page segmentation mode and "-c name=value" variables out of
+        tesseract command line arguments. Other arguments are ignored.
+
+    Returns:
+        tuple[int | None, dict[str, str]]: The mode, None if it isn't set, and
+        the variables.
+    """
+    psm = None
+    variables = {}
+    args = shlex.split(config)
+    for i, arg in enumerate(args[:-1]):
+        if arg == "--psm" and args[i + 1].isdigit():
+            psm = int(args[i + 1])
+        elif arg == "-c" and "=" in args[i + 1]:
+            name, _, value = args[i + 1].partition("=")
+            variables[name] = value
+    return psm, variables
+
+
+class OcrBackend(ABC):
+    """
+        Runs Tesseract on an image. config takes tesseract command line
+        arguments, like the --psm and -c settings of an OcrPass.
+    """
+    name: str = ""
+
+    @abstractmethod
+    def image_to_string(self, image: Image.Image, config: str = "") -> str:
+        """
+            OCRs an image to text.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def image_to_data(self, image: Image.Image, config: str = "") -> dict:
+        """
+            OCRs an image to words and where they are.
+
+        Returns:
+            dict: Lists of "text", "left", "top", "width", "height", "conf",
+            "block_num", "par_num" and "line_num" with an entry per word, as
+            pytesseract.image_to_data returns them.
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """
+            Frees the engine, if the backend keeps one.
+        """
+        pass
+
+
+class PytesseractBackend(OcrBackend):
+    """
+        Runs the tesseract command through pytesseract, a new process and a
+        temporary image file for every call. Works wherever tesseract is
+        installed.
+    """
+    name = "pytesseract"
+
+    def __init__(self):
+        import pytesseract
+        self.pytesseract = pytesseract
+
+    def image_to_string(self, image: Image.Image, config: str = "") -> str:
+        return self.pytesseract.image_to_string(image, config=config)
+
+    def image_to_data(self, image: Image.Image, config: str = "") -> dict:
+        return self.pytesseract.image_to_data(image, config=config,
+                                              output_type=self.pytesseract.Output.DICT)
+
+
+class TesserocrBackend(OcrBackend):
+    """
+        Keeps a Tesseract engine loaded through tesserocr and passes it images
+        in memory, so reading a page doesn't start a process, load the
+        language data or encode the image again.
+
+        The engine isn't thread safe, use one backend per process, see
+        get_backend.
+    """
+    name = "tesserocr"
+    #   Variables set by the last call and their default values
+    defaults: dict[str, str]
+
+    def __init__(self, lang: str = "eng"):
+        """
+        Args:
+            lang (str, optional): Tesseract language. Defaults to "eng".
+
+        Raises:
+            RuntimeError: tesserocr isn't installed or can't load the language data.
+        """
+        try:
+            import tesserocr
+        except ImportError:
+            raise RuntimeError("The tesserocr OCR backend needs tesserocr, install it with: pip install tesserocr")
+        self.tesserocr = tesserocr
+        #   The constructor raises RuntimeError when the language data is missing
+        self.api = tesserocr.PyTessBaseAPI(lang=lang)
+        self.defaults = {}
+
+    def _configure(self, image: Image.Image, config: str) -> None:
+        psm, variables = parse_config(config)
+        api = self.api
+        #   Settings of the previous call are undone, like a fresh tesseract process
+        for name in [name for name in self.defaults if name not in variables]:
+            api.SetVariable(name, self.defaults.pop(name))
+        for name, value in variables.items():
+            if name not in self.defaults:
+                self.defaults[name] = api.GetVariableAsString(name) or ""
+            api.SetVariable(name, value)
+        api.SetPageSegMode(psm if psm != None else self.tesserocr.PSM.AUTO)
+        api.SetImage(image)
+
+    def image_to_string(self, image: Image.Image, config: str = "") -> str:
+        self._configure(image, config)
+        return self.api.GetUTF8Text()
+
+    def image_to_data(self, image: Image.Image, config: str = "") -> dict:
+        RIL = self.tesserocr.RIL
+        self._configure(image, config)
+        self.api.Recognize()
+        data = {key: [] for key in ("text", "left", "top", "width", "height", "conf",
+                                    "block_num", "par_num", "line_num")}
+        block = par = line = 0
+        for word in self.tesserocr.iterate_level(self.api.GetIterator(), RIL.WORD):
+            box = word.BoundingBox(RIL.WORD)
+            if box == None:
+                continue
+            if word.IsAtBeginningOf(RIL.BLOCK):
+                block, par, line = block + 1, 0, 0
+            if word.IsAtBeginningOf(RIL.PARA):
+                par, line = par + 1, 0
+            if word.IsAtBeginningOf(RIL.TEXTLINE):
+                line += 1
+            left, top, right, bottom = box
+            data["text"].append(word.GetUTF8Text(RIL.WORD) or "")
+            data["left"].append(left)
+            data["top"].append(top)
+            data["width"].append(right - left)
+            data["height"].append(bottom - top)
+            data["conf"].append(word.Confidence(RIL.WORD))
+            data["block_num"].append(block)
+            data["par_num"].append(par)
+            data["line_num"].append(line)
+        return data
+
+    def close(self) -> None:
+        self.api.End()
+
+
+ocr_backends: dict[str, type] = {"tesserocr": TesserocrBackend, "pytesseract": PytesseractBackend}
+#   Backends already started, keyed by process so forked workers start their own
+_backends: dict[tuple[str, int], OcrBackend] = {}
+
+
+def backend_available(name: str) -> bool:
+    """
+        Checks whether a backend, or any backend for "auto", can be imported
+        without importing it.
+    """
+    if name == "auto":
+        return any(backend_available(name) for name in ocr_backends)
+    #   Each backend is named after the module it needs
+    return name in ocr_backends and importlib.util.find_spec(name) != None
+
+
+def get_backend(name: str = "auto") -> OcrBackend:
+    """
+        Returns this process's backend, starting it on first use so a worker
+        keeps one engine for every page it reads.
+
+    Args:
+        name (str, optional): "tesserocr", "pytesseract" or "auto" for
+        tesserocr if it can be started and pytesseract otherwise. Defaults to "auto".
+
+    Raises:
+        RuntimeError: The backend can't be started.
+    """
+    key = (name, os.getpid())
+    backend = _backends.get(key)
+    if backend == None:
+        if name == "auto":
+            try:
+                backend = TesserocrBackend()
+            except RuntimeError:
+                backend = PytesseractBackend()
+        elif name in ocr_backends:
+            backend = ocr_backends[name]()
+        else:
+            raise RuntimeError(f"Unknown OCR backend {name}, expected one of: auto, {', '.join(ocr_backends)}")
+        _backends[key] = backend
+    return backend
+
+
+class OcrPass:
+    """
+        One way of OCR'ing a page: the resolution it's rendered at, how it's
+        prepared and the Tesseract settings used to read it.
+    """
+    name: str
+    dpi: int
+    mode: str
+    config: str
+    labelledOnly: bool
+    cropped: bool
+
+    def __init__(self, name: str, dpi: int, mode: str = "gray", config: str = "",
+                 labelledOnly: bool = False, cropped: bool = False):
+        """
+        Args:
+            name (str): Name of the pass, the tier of books it finds is "ocr_<name>".
+            dpi (int): Resolution pages are rendered at.
+            mode (str, optional): How the page is prepared, see preprocess. Defaults to "gray".
+            config (str, optional): Extra Tesseract arguments. Defaults to "".
+            labelledOnly (bool, optional): Only accept numbers labelled
+            "ISBN", e.g. when a character whitelist turns other text into
+            digits. Defaults to False.
+            cropped (bool, optional): Only OCR the regions around ISBN labels
+            found by earlier passes. Defaults to False.
+        """
+        self.name = name
+        self.dpi = dpi
+        self.mode = mode
+        self.config = config
+        self.labelledOnly = labelledOnly
+        self.cropped = cropped
+
+    @property
+    def tier(self) -> str:
+        return "ocr_" + self.name
+
+
+def ocr_passes(fastDpi: int = 150, dpi: int = 300) -> [OcrPass]:
+    """
+        The standard passes in the order they're tried: a sparse text pass
+        over black and white pages looking for labelled ISBNs, a pass over
+        the lines around any ISBN labels it saw and a full page pass.
+
+    Args:
+        fastDpi (int, optional): Resolution of the first pass. Defaults to 150.
+        dpi (int, optional): Resolution of the later passes. Defaults to 300.
+
+    Returns:
+        [OcrPass]: The passes.
+    """
+    return [
+        OcrPass("fast", fastDpi, "binary", f"--psm 11 -c tessedit_char_whitelist={isbn_whitelist}",
+                labelledOnly=True),
+        OcrPass("crop", dpi, "gray", "--psm 6", cropped=True),
+        OcrPass("full", dpi, "gray", "--psm 3"),
+    ]
+
+
+default_passes: [OcrPass] = ocr_passes()
+
+
+class OcrStrategy:
+    """
+        Finds an ISBN on pdf pages by running each OcrPass over the pages in
+        turn, stopping at the first valid ISBN. Every page gets the cheap
+        passes before any page gets the expensive ones.
+
+        Pages where a pass read an "ISBN" label but no valid number are
+        remembered, and cropped passes only OCR the lines around those
+        labels. Pages with a label are also tried first by later passes.
+
+        The time spent in each pass is recorded as the "ocr_<name>" stage,
+        so ScanMetrics can report how often each pass finds an ISBN.
+    """
+    passes: [OcrPass]
+    crop: bool
+    backend: str
+
+    def __init__(self, passes: [OcrPass] = None, crop: bool = True, backend: str = "auto"):
+        """
+        Args:
+            passes ([OcrPass], optional): Passes in the order they're tried.
+            Defaults to default_passes.
+            crop (bool, optional): Look for ISBN labels and run cropped
+            passes. Defaults to True.
+            backend (str, optional): Name of the OcrBackend, see get_backend.
+            Only the name is kept so the strategy can be sent to worker
+            processes, each starts its own backend. Defaults to "auto".
+        """
+        self.passes = list(passes if passes != None else default_passes)
+        self.crop = crop
+        self.backend = backend
+
+    @property
+    def tiers(self) -> tuple:
+        return tuple(p.tier for p in self.passes if self.crop or not p.cropped)
+
+    def _read(self, image: Image.Image, ocrPass: OcrPass, findLabels: bool) -> tuple[str, list]:
+        #   OCRs an image, also returning where its ISBN labels are if asked
+        backend = get_backend(self.backend)
+        with timed(ocrPass.tier):
+            if not findLabels:
+                return backend.image_to_string(image, ocrPass.config), []
+            data = backend.image_to_data(image, ocrPass.config)
+        return _data_text(data), isbn_regions(data, image.height)
+
+    def _match(self, text: str, ocrPass: OcrPass) -> str | None:
+        with timed("regex"):
+            candidates = isbn_candidates(text, labelledOnly=ocrPass.labelledOnly)
+        return candidates[0].isbn if candidates else None
+
+    def find_isbn(self, render: Callable[[int, int, bool], Image.Image | None],
+                  pages: [int]) -> tuple[str | None, str | None]:
+        """
+            OCRs pages until a valid ISBN is found.
+
+        Args:
+            render (Callable): Renders a page given its number, the dpi and
+            whether grayscale is enough. Returns None if it can't.
+            pages ([int]): Page numbers in the order they should be tried.
+
+        Returns:
+            tuple[str | None, str | None]: The ISBN and the tier of the pass
+            that found it, or (None, None).
+        """
+        #   Regions around ISBN labels keyed by page
+        labelled: dict[int, list] = {}
+        passes = [p for p in self.passes if self.crop or not p.cropped]
+        for i, ocrPass in enumerate(passes):
+            #   Labels are only worth finding if a cropped pass comes later
+            findLabels = not ocrPass.cropped and any(p.cropped for p in passes[i + 1:])
+            order = [page for page in pages if page in labelled] + \
+                    [page for page in pages if page not in labelled]
+            for page in order:
+                if ocrPass.cropped and page not in labelled:
+                    continue
+                with timed("render"):
+                    image = render(page, ocrPass.dpi, ocrPass.mode in ("gray", "binary"))
+                if image == None:
+                    continue
+                image = preprocess(image, ocrPass.mode)
+                if ocrPass.cropped:
+                    crops = [image.crop((round(left * image.width), round(top * image.height),
+                                         round(right * image.width), round(bottom * image.height)))
+                             for left, top, right, bottom in labelled[page]]
+                else:
+                    crops = [image]
+                for crop in crops:
+                    text, regions = self._read(crop, ocrPass, findLabels)
+                    isbn = self._match(text, ocrPass)
+                    if isbn != None:
+                        return isbn, ocrPass.tier
+                    if regions:
+                        labelled.setdefault(page, []).extend(regions)
+        return None, None
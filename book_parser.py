@@ -1,118 +1,628 @@
+from __future__ import annotations
 import os
+import html
+import sqlite3
+import posixpath
+import subprocess
+import time
+import zipfile
+from itertools import islice
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import unquote
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import get_all_start_methods, get_context
 from logging import Logger
-from book_db import store_isbn, update_meta_data, store_book
-from book_meta import OpenLibraryProvider
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+from book import Book
+from book_db import store_books, transaction, library_index, is_catalogued
+from book_metrics import ScanMetrics, collect_timings, timed
+from book_scan_cache import ScanCache
+from book_scan_queue import ScanQueue
+from book_walk import walk_files, walk_ahead
+from book_ocr import OcrStrategy
 #   Libraries for finding and validating ISBNs
-import isbnlib
 import re
-#   Libraries for OCR Pdfs
-import pytesseract
-from pdf2image import convert_from_path
-from PIL import Image
-#   Library for Epub files
-import ebooklib
-from ebooklib import epub
-#   Library for CHTML and parsing Epub text
-from bs4 import BeautifulSoup
-#   Library for Djvu files
+from book_isbn import isbnPattern, isbn_candidates, validate_and_convert, find_isbn_in_text
+#   Libraries for rendering pdfs (pdf2image), reading epubs (ebooklib, bs4)
+#   and looking up metadata (book_meta) are imported by the functions that
+#   use them, so listing the library never loads them and a scan only loads
+#   the ones its files need
+if TYPE_CHECKING:
+    from PIL import Image
+    from book_meta import OpenLibraryProvider
 
 
 #   Variables
-isbnPattern = r"(\b978(?:-?\d){10}\b)|(\b978(?:-?\d){9}(?:-?X|x))|(\b(?:-?\d){10})\b|(\b(?:-?\d){9}(?:-?X|x)\b)"
+#   Page orders for scanning pdfs. "front_back" also tries the last few pages
+#   since the ISBN is often printed on the back cover.
+page_orders = ("front", "front_back")
+#   Ways an ISBN can be found in a pdf, cheapest first. OCR tiers are the
+#   passes of the default OcrStrategy.
+pdf_tiers = ("metadata", "text") + OcrStrategy().tiers
+#   Document info fields that may hold an ISBN
+pdf_info_fields = ("Title", "Subject", "Keywords")
+#   Ways an ISBN can be found in an epub, cheapest first
+epub_tiers = ("opf", "scan", "full")
+#   Epub documents that usually hold the copyright notice
+epubFrontMatterRegex = re.compile(r"copyright|colophon|imprint|legal|title|front|isbn", re.IGNORECASE)
+#   Number of documents checked at each end of the spine by the scan tier
+epubEdgeDocs = 5
+tagRegex = re.compile(r"<[^>]+>")
 
 
-def validate_and_convert(isbn: str) -> str | None:
+class ParseResult:
     """
-        Sanitizes then validates an isbn using isbnlib. If its isbn10 it is then converted
-        to isbn13 and returned.
-        
-        Args:
-            isbn (str): Isbn to be validated as a string.
-            
-        Returns:
-            str | None: The valid isbn as an ISBN-13 or None if invalid.
+        Outcome of parsing a single file. Returned from worker processes so it
+        only holds plain values.
     """
-    isbn = isbn.replace("-", "").replace(" ", "")
-    if (isbnlib.is_isbn10(isbn) | isbnlib.is_isbn13(isbn)):
-        if(isbnlib.is_isbn10):
-            isbn = isbnlib.to_isbn13(isbn)
-        return isbn
-    else:
-        return None
+    filePath: str
+    kind: str
+    isbn: str | None
+    tier: str | None
+    error: str | None
+    #   Seconds spent in each book_metrics.file_stages stage
+    timings: dict[str, float]
+    seconds: float
 
-#   Uses regex to find an isbn in text
-#   Returns the first result or None
-def find_isbn_in_text(text: str) -> str | None:
+    def __init__(self, filePath: str, isbn: str | None = None, error: str | None = None,
+                 tier: str | None = None):
+        self.filePath = filePath
+        self.kind = os.path.splitext(filePath)[1].lstrip(".").lower()
+        self.isbn = isbn
+        self.tier = tier
+        self.error = error
+        self.timings = {}
+        self.seconds = 0.0
+
+
+def pdf_page_order(numPages: int = 10, strategy: str = "front", backPages: int = 3) -> [int]:
     """
-        Uses Regex to parse text for a valid isbn string.
+        Generates the order pdf pages are scanned in. Negative numbers count
+        back from the last page, so -1 is the last page.
 
     Args:
-        text (str): Text string to be parsed for a valid isbn.
+        numPages (int, optional): Number of front pages to scan. Defaults to 10.
+        strategy (str, optional): One of page_orders. Defaults to "front".
+        backPages (int, optional): Number of back pages scanned by "front_back". Defaults to 3.
 
     Returns:
-        str | None: Either a valid isbn or None.
+        [int]: Page numbers in the order they should be scanned.
     """
-    isbn = None
-    match = re.search(isbnPattern, text)
-    if (match != None):
-        isbn = match.group()
-        isbn = validate_and_convert(isbn)
-    return isbn
+    pages = list(range(1, numPages + 1))
+    if strategy == "front_back":
+        pages += [-i for i in range(1, backPages + 1)]
+    elif strategy != "front":
+        raise ValueError(f"Unknown page order: {strategy}")
+    return pages
+
+
+def _resolve_pages(pages: [int], pageCount: int) -> [int]:
+    #   Turn negative page numbers into real ones and drop repeats and pages
+    #   past the end of the document.
+    resolved: [int] = []
+    for page in pages:
+        if page < 0:
+            page = pageCount + 1 + page
+        if 1 <= page <= pageCount and page not in resolved:
+            resolved.append(page)
+    return resolved
+
+
+def _run_poppler(args: [str]) -> str:
+    res = subprocess.run(args, capture_output=True, check=True)
+    return res.stdout.decode("utf-8", errors="ignore")
+
+
+def _page_ranges(pages: [int]) -> [tuple[int, int]]:
+    #   Group pages into contiguous (first, last) ranges
+    ranges: [tuple[int, int]] = []
+    for page in sorted(pages):
+        if ranges and page == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], page)
+        else:
+            ranges.append((page, page))
+    return ranges
+
+
+def pdf_page_texts(fileName: str, pages: [int]) -> dict[int, str]:
+    """
+        Extracts the embedded text layer of pdf pages with pdftotext.
+
+    Args:
+        fileName (str): Full filepath to the pdf.
+        pages ([int]): Page numbers to extract. Must be within the document.
 
+    Returns:
+        dict[int, str]: Text of each page keyed by page number.
+    """
+    texts: dict[int, str] = {}
+    for first, last in _page_ranges(pages):
+        with timed("text"):
+            out = _run_poppler(["pdftotext", "-f", str(first), "-l", str(last),
+                                "-enc", "UTF-8", fileName, "-"])
+        #   pdftotext ends every page with a form feed
+        for offset, text in enumerate(out.split("\f")[:last - first + 1]):
+            texts[first + offset] = text
+    return texts
+
+
+def find_isbn_in_pdf_metadata(fileName: str, info: dict = None) -> str | None:
+    """
+        Looks for an ISBN in the pdf's document info dictionary and XMP metadata.
+
+    Args:
+        fileName (str): Full filepath to the pdf.
+        info (dict, optional): Output of pdfinfo_from_path if already known.
 
-def parse_isbn_from_pdf(fileName: str, numPages: int = 10) -> str | None:
+    Returns:
+        str | None: Either a valid ISBN or None.
+    """
+    if info == None:
+        from pdf2image import pdfinfo_from_path
+        info = pdfinfo_from_path(fileName)
+    for field in pdf_info_fields:
+        if field in info:
+            isbn = find_isbn_in_text(str(info[field]))
+            if isbn != None:
+                return isbn
+    #   XMP packets are full of ids and dates so only "ISBN" labelled numbers count
+    xmp = _run_poppler(["pdfinfo", "-meta", fileName])
+    candidates = isbn_candidates(xmp, labelledOnly=True)
+    if candidates:
+        return candidates[0].isbn
+    return None
+
+
+def extract_isbn_from_pdf(fileName: str, numPages: int = 10, strategy: str = "front",
+                          pages: [int] = None, textLayer: bool = True,
+                          ocr: OcrStrategy = None) -> tuple[str | None, str | None]:
     """
-        Scans a pdf using OCR and regex for an ISBN.
+        Looks for an ISBN in a pdf using the cheapest method that works. The
+        metadata and the embedded text layer are checked first and pages are
+        only OCR'd when neither has an ISBN.
 
     Args:
         fileName (str): Full filepath to the pdf.
         numPages (int, optional): Number of pages to scan by default. Defaults to 10.
+        strategy (str, optional): Page order to scan in, one of page_orders. Defaults to "front".
+        pages ([int], optional): Explicit pages to scan instead of numPages and strategy.
+        textLayer (bool, optional): Check the metadata and text layer before
+        OCR. Defaults to True.
+        ocr (OcrStrategy, optional): How pages are OCR'd. Defaults to OcrStrategy().
+
+    Returns:
+        tuple[str | None, str | None]: The ISBN and the tier that found it,
+        one of pdf_tiers with the default OcrStrategy, or (None, None).
+    """
+    from pdf2image import convert_from_path, pdfinfo_from_path
+    if pages == None:
+        pages = pdf_page_order(numPages, strategy)
+    with timed("metadata"):
+        info = pdfinfo_from_path(fileName)
+    pageCount = info["Pages"]
+    resolved = _resolve_pages(pages, pageCount)
+
+    if textLayer:
+        #   A broken text layer shouldn't stop us from trying OCR
+        try:
+            with timed("metadata"):
+                isbn = find_isbn_in_pdf_metadata(fileName, info)
+            if isbn != None:
+                return isbn, "metadata"
+            texts = pdf_page_texts(fileName, resolved)
+            for page in resolved:
+                with timed("regex"):
+                    isbn = find_isbn_in_text(texts.get(page, ""))
+                if isbn != None:
+                    return isbn, "text"
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+    def render(page: int, dpi: int, grayscale: bool) -> Image.Image | None:
+        images = convert_from_path(fileName, dpi, first_page=page, last_page=page, grayscale=grayscale)
+        return images[0] if images else None
+
+    if ocr == None:
+        ocr = OcrStrategy()
+    return ocr.find_isbn(render, resolved)
+
+
+def parse_isbn_from_pdf(fileName: str, numPages: int = 10, strategy: str = "front",
+                        pages: [int] = None, textLayer: bool = True) -> str | None:
+    """
+        Scans a pdf for an ISBN using its metadata, its text layer and finally
+        OCR. Pages are rendered and OCR'd one at a time and scanning stops at
+        the first valid ISBN.
+
+    Args:
+        fileName (str): Full filepath to the pdf.
+        numPages (int, optional): Number of pages to scan by default. Defaults to 10.
+        strategy (str, optional): Page order to scan in, one of page_orders. Defaults to "front".
+        pages ([int], optional): Explicit pages to scan instead of numPages and strategy.
+        textLayer (bool, optional): Check the metadata and text layer before
+        OCR. Defaults to True.
 
     Returns:
         str | None: Either a valid ISBN or None.
     """
-    isbn = None
-    pdf_pages = convert_from_path(fileName, 200, last_page=numPages, thread_count=2)
-    for i in range(numPages):
-        page: Image = pdf_pages[i]
-        text: str = pytesseract.image_to_string(page)
-        isbn = find_isbn_in_text(text)
-        if (isbn != None):
-            break
-    return isbn
+    return extract_isbn_from_pdf(fileName, numPages, strategy, pages, textLayer)[0]
+
+
+def _local_name(tag: str) -> str:
+    #   Strip the xml namespace from an element's tag
+    return tag.rsplit("}", 1)[-1]
+
+
+def _read_opf(epubZip: zipfile.ZipFile) -> tuple[str, ElementTree.Element]:
+    #   container.xml points at the OPF package document
+    container = ElementTree.fromstring(epubZip.read("META-INF/container.xml"))
+    for element in container.iter():
+        if _local_name(element.tag) == "rootfile":
+            opfPath = element.get("full-path")
+            return opfPath, ElementTree.fromstring(epubZip.read(opfPath))
+    raise ValueError("Epub has no OPF rootfile")
+
+
+def find_isbn_in_opf(opf: ElementTree.Element) -> str | None:
+    """
+        Looks for an ISBN in the dc:identifier and dc:source metadata of an
+        epub's OPF package document.
+
+    Args:
+        opf (ElementTree.Element): Root of the OPF document.
+
+    Returns:
+        str | None: Either a valid isbn13 string or None.
+    """
+    for element in opf.iter():
+        if _local_name(element.tag) not in ("identifier", "source") or element.text == None:
+            continue
+        value = element.text.strip()
+        if value.lower().startswith("urn:isbn:"):
+            value = value[len("urn:isbn:"):]
+        isbn = validate_and_convert(value)
+        if isbn == None:
+            isbn = find_isbn_in_text(value)
+        if isbn != None:
+            return isbn
+    return None
+
+
+def _epub_candidate_docs(opfPath: str, opf: ElementTree.Element) -> [str]:
+    #   Zip paths of the documents most likely to hold the ISBN: ones named
+    #   like a copyright page first, then the front and back of the spine.
+    opfDir = posixpath.dirname(opfPath)
+    manifest: dict[str, str] = {}
+    spine: [str] = []
+    for element in opf.iter():
+        name = _local_name(element.tag)
+        if name == "item" and element.get("href") != None:
+            manifest[element.get("id")] = posixpath.join(opfDir, unquote(element.get("href")))
+        elif name == "itemref" and element.get("idref") in manifest:
+            spine.append(manifest[element.get("idref")])
+    named = [doc for doc in spine if epubFrontMatterRegex.search(posixpath.basename(doc))]
+    edges = spine[:epubEdgeDocs] + spine[-epubEdgeDocs:][::-1]
+    docs: [str] = []
+    for doc in named + edges:
+        if doc not in docs:
+            docs.append(doc)
+    return docs
+
+
+def _scan_epub(fileName: str) -> tuple[str | None, str | None]:
+    #   The opf and scan tiers, reading straight from the zip without
+    #   building the whole book.
+    with zipfile.ZipFile(fileName) as epubZip:
+        with timed("epub"):
+            opfPath, opf = _read_opf(epubZip)
+            isbn = find_isbn_in_opf(opf)
+        if isbn != None:
+            return isbn, "opf"
+        for doc in _epub_candidate_docs(opfPath, opf):
+            try:
+                with timed("epub"):
+                    raw = epubZip.read(doc).decode("utf-8", errors="ignore")
+                    text = html.unescape(tagRegex.sub(" ", raw))
+            except KeyError:
+                continue
+            with timed("regex"):
+                isbn = find_isbn_in_text(text)
+            if isbn != None:
+                return isbn, "scan"
+    return None, None
+
+
+def extract_isbn_from_epub(fileName: str, fullParse: bool = True) -> tuple[str | None, str | None]:
+    """
+        Looks for an ISBN in an epub using the cheapest method that works. The
+        OPF identifiers are checked first, then the copyright and edge
+        documents are scanned with a regex, and only then is the whole book
+        parsed.
+
+    Args:
+        fileName (str): Full filepath to the file to be read.
+        fullParse (bool, optional): Fall back to parsing every chapter. Defaults to True.
+
+    Returns:
+        tuple[str | None, str | None]: The ISBN and the epub_tiers entry that
+        found it, or (None, None).
+    """
+    try:
+        isbn, tier = _scan_epub(fileName)
+        if isbn != None:
+            return isbn, tier
+    except (zipfile.BadZipFile, ElementTree.ParseError, KeyError, ValueError):
+        #   Malformed epubs may still open with ebooklib
+        pass
+    if fullParse:
+        isbn = parse_isbn_from_epub_chapters(fileName)
+        if isbn != None:
+            return isbn, "full"
+    return None, None
 
 
 def parse_isbn_from_epub(fileName: str) -> str | None:
     """
-        Scans an epub using OCR and regex for an ISBN.
+        Scans an epub for an ISBN using its metadata, its copyright pages and
+        finally every chapter.
+    Args:
+        fileName (str): Full filepath to the file to be read.
+
+    Returns:
+        str | None: Either a valid isbn13 string or None.
+    """
+    return extract_isbn_from_epub(fileName)[0]
+
+
+def parse_isbn_from_epub_chapters(fileName: str) -> str | None:
+    """
+        Scans every chapter of an epub in spine order for an ISBN.
     Args:
         fileName (str): Full filepath to the file to be read.
 
     Returns:
         str | None: Either a valid isbn13 string or None.
     """
+    import ebooklib
+    from ebooklib import epub
+    from bs4 import BeautifulSoup
     isbn = None
-    book = epub.read_epub(fileName, {"ignore_ncx": True})
-    items = list(book.get_items_of_type(ebooklib.ITEM_DOCUMENT))
+    with timed("epub"):
+        book = epub.read_epub(fileName, {"ignore_ncx": True})
+        items = list(book.get_items_of_type(ebooklib.ITEM_DOCUMENT))
     text: [str] = []
     for chapter in items:
-        soup = BeautifulSoup(chapter.get_body_content(), 'html.parser')
-        #   Generate a list of paragraphs
-        text = [para.get_text() for para in soup.find_all('p')]
-        #   Join them into a single string
-        for para in text:
-            isbn = find_isbn_in_text(para)
-            if isbn != None:
-                return isbn
+        with timed("epub"):
+            soup = BeautifulSoup(chapter.get_body_content(), 'html.parser')
+            #   Generate a list of paragraphs
+            text = [para.get_text() for para in soup.find_all('p')]
+        #   Join them into a single string so the chapter is scanned in one pass
+        with timed("regex"):
+            isbn = find_isbn_in_text("\n".join(text))
+        if isbn != None:
+            return isbn
     return isbn
 
-def parse_directories(dirPath: [str], logger: Logger) -> [str]:
+
+def _extract_pdf(filePath: str, pages: [int], textLayer: bool,
+                 ocr: OcrStrategy) -> tuple[str | None, str | None]:
+    return extract_isbn_from_pdf(filePath, pages=pages, textLayer=textLayer, ocr=ocr)
+
+
+def _extract_epub(filePath: str, pages: [int], textLayer: bool,
+                  ocr: OcrStrategy) -> tuple[str | None, str | None]:
+    return extract_isbn_from_epub(filePath)
+
+
+#   Extractor for each supported extension. Each takes the file path, the
+#   pdf pages to scan, whether to use the text layer and the OcrStrategy and
+#   returns the ISBN and the tier that found it. Their libraries are only
+#   imported once a file of their format is parsed.
+extractors: dict[str, Callable[[str, list, bool, OcrStrategy], tuple]] = {
+    ".pdf": _extract_pdf,
+    ".epub": _extract_epub,
+}
+supported_extensions = tuple(extractors)
+
+
+def parse_file(filePath: str, pages: [int] = None, textLayer: bool = True,
+               ocr: OcrStrategy = None) -> ParseResult:
     """
-        Scan directories for valid eBooks and their ISBNs.
+        Parses a single eBook for its ISBN. Exceptions are caught and returned
+        in the result so one bad file can't stop a scan.
 
     Args:
-        dirPath (str]): Directories to scan for eBooks.
+        filePath (str): Full filepath to the eBook.
+        pages ([int], optional): Pdf pages to scan, see pdf_page_order. Defaults
+        to the first 10 pages.
+        textLayer (bool, optional): Check a pdf's metadata and text layer
+        before OCR. Defaults to True.
+        ocr (OcrStrategy, optional): How pdf pages are OCR'd. Defaults to OcrStrategy().
+
+    Returns:
+        ParseResult: The ISBN found or the error that occurred, with the time
+        spent in each stage.
+    """
+    start = time.perf_counter()
+    extractor = extractors.get(os.path.splitext(filePath)[1])
+    with collect_timings() as timings:
+        try:
+            if extractor != None:
+                isbn, tier = extractor(filePath, pages, textLayer, ocr)
+                res = ParseResult(filePath, isbn, tier=tier)
+            else:
+                res = ParseResult(filePath, error="Unsupported file type")
+        except Exception as e:
+            res = ParseResult(filePath, error=repr(e))
+    res.timings = timings
+    res.seconds = time.perf_counter() - start
+    return res
+
+
+def _plan_tasks(filePath: str, pageChunk: int, pages: [int], textLayer: bool,
+                ocr: OcrStrategy = None) -> [tuple]:
+    #   Split the pages of a pdf into chunks that can be OCR'd in parallel.
+    #   The metadata and text layer are checked once, by a first task over
+    #   every page that doesn't OCR, and the chunks only OCR.
+    if pageChunk > 0 and filePath.endswith(".pdf"):
+        tasks = [(filePath, pages, True, OcrStrategy([]))] if textLayer else []
+        return tasks + [(filePath, pages[i:i + pageChunk], False, ocr) for i in range(0, len(pages), pageChunk)]
+    return [(filePath, pages, textLayer, ocr)]
+
+
+def _merge_chunks(results: [ParseResult]) -> ParseResult:
+    #   The first task with an ISBN wins, the text layer task before the OCR
+    #   chunks and earlier pages before later ones. Otherwise report the first error.
+    #   Every chunk's time counts towards the file.
+    merged = next((res for res in results if res.isbn != None), None)
+    if merged == None:
+        merged = next((res for res in results if res.error != None), results[0])
+    timings: dict[str, float] = {}
+    for res in results:
+        for stage, seconds in res.timings.items():
+            timings[stage] = timings.get(stage, 0.0) + seconds
+    merged.timings = timings
+    merged.seconds = sum(res.seconds for res in results)
+    return merged
+
+
+def scan_files(files: Iterable[str], workers: int = 1, pageChunk: int = 0,
+               pageOrder: str = "front", textLayer: bool = True,
+               ocr: OcrStrategy = None) -> Iterator[ParseResult]:
+    """
+        Parses eBooks for their ISBNs, spreading the work across a pool of
+        processes. Results are yielded in the order files finish.
+
+    Args:
+        files (Iterable[str]): Filepaths to parse. Unsupported files are skipped.
+        workers (int, optional): Number of worker processes. 1 parses in this
+        process. Defaults to 1.
+        pageChunk (int, optional): If above 0 the pages of each pdf are split
+        into chunks of this many pages that are OCR'd by separate workers,
+        once its metadata and text layer turned up no ISBN. Chunks that
+        haven't started when one finds an ISBN are cancelled. Defaults to 0.
+        pageOrder (str, optional): Order pdf pages are scanned in, one of
+        page_orders. Defaults to "front".
+        textLayer (bool, optional): Check a pdf's metadata and text layer
+        before OCR. Defaults to True.
+        ocr (OcrStrategy, optional): How pdf pages are OCR'd. Defaults to OcrStrategy().
+
+    Returns:
+        Iterator[ParseResult]: One result per supported file.
+    """
+    files = (f for f in files if f.endswith(supported_extensions))
+    pages = pdf_page_order(strategy=pageOrder)
+    if workers <= 1:
+        for filePath in files:
+            yield parse_file(filePath, pages, textLayer, ocr)
+        return
+
+    #   Only keep a few tasks per worker queued so huge libraries aren't
+    #   submitted all at once.
+    maxInFlight = workers * 4
+    inFlight: dict = {}
+    chunks: dict = {}
+    #   OCR chunks of each pdf waiting for its text layer task to come up empty
+    deferred: dict = {}
+    #   Workers are started from a process already running threads (the walker,
+    #   the metadata fetcher), and forking one can deadlock the children on
+    #   locks held at the time, so they're started from a fresh process
+    method = "forkserver" if "forkserver" in get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context(method)) as pool:
+        def submit(filePath: str, i: int, task: tuple) -> None:
+            inFlight[pool.submit(parse_file, *task)] = (filePath, i)
+
+        def submit_next() -> bool:
+            filePath = next(files, None)
+            if filePath == None:
+                return False
+            tasks = _plan_tasks(filePath, pageChunk, pages, textLayer, ocr)
+            chunks[filePath] = [None] * len(tasks)
+            if len(tasks) > 1 and tasks[0][2]:
+                #   Only OCR if the metadata and text layer have no ISBN
+                submit(filePath, 0, tasks[0])
+                deferred[filePath] = list(enumerate(tasks))[1:]
+            else:
+                for i, task in enumerate(tasks):
+                    submit(filePath, i, task)
+            return True
+
+        while len(inFlight) < maxInFlight and submit_next():
+            pass
+        while inFlight:
+            done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+            for future in done:
+                filePath, i = inFlight.pop(future)
+                try:
+                    res = future.result()
+                except Exception as e:
+                    #   The worker itself died, e.g. a crash inside poppler
+                    res = ParseResult(filePath, error=repr(e))
+                results = chunks[filePath]
+                results[i] = res
+                waiting = deferred.pop(filePath, [])
+                if res.isbn != None:
+                    #   Chunks that haven't started aren't needed any more,
+                    #   running ones finish so an earlier page can still win
+                    for other, (path, _) in list(inFlight.items()):
+                        if path == filePath and other.cancel():
+                            del inFlight[other]
+                else:
+                    for j, task in waiting:
+                        submit(filePath, j, task)
+                if all(path != filePath for path, _ in inFlight.values()):
+                    del chunks[filePath]
+                    yield _merge_chunks([r for r in results if r != None])
+            while len(inFlight) < maxInFlight and submit_next():
+                pass
+
+
+def parse_directories(dirPath: [str], logger: Logger, batchSize: int = 100,
+                      workers: int = 1, pageChunk: int = 0, pageOrder: str = "front",
+                      textLayer: bool = True, incremental: bool = True, hashFiles: bool = False,
+                      retryFailed: bool = False, provider: OpenLibraryProvider = None,
+                      metrics: ScanMetrics = None, include: [str] = None,
+                      exclude: [str] = None, maxAttempts: int = 3,
+                      ocr: OcrStrategy = None) -> [str]:
+    """
+        Scan directory trees for valid eBooks and their ISBNs. Files found by
+        the directory walk go through a persistent ScanQueue into scan_files
+        while metadata lookups and database writes stay in this process.
+
+        Each file is marked done in the same transaction as its book, so an
+        interrupted scan is resumed by the next one, which also finishes the
+        files left in the queue. Pass no directories to only do that.
+
+    Args:
+        dirPath ([str]): Directories to scan for eBooks, including their subdirectories.
         logger (Logger): Log that is written to.
+        batchSize (int, optional): Number of books to buffer before writing them
+        to the database in one transaction. Defaults to 100.
+        workers (int, optional): Number of worker processes. Defaults to 1.
+        pageChunk (int, optional): Pdf pages per worker task, 0 to keep each
+        pdf in one task. Defaults to 0.
+        pageOrder (str, optional): Order pdf pages are scanned in, one of
+        page_orders. Defaults to "front".
+        textLayer (bool, optional): Check a pdf's metadata and text layer
+        before OCR. Defaults to True.
+        incremental (bool, optional): Skip files that haven't changed since
+        they were last scanned. Defaults to True.
+        hashFiles (bool, optional): Hash new and changed files to detect moved
+        or renamed ones. Defaults to False.
+        retryFailed (bool, optional): Parse unchanged files whose ISBN
+        couldn't be found last time again, and give files that failed
+        maxAttempts times another go. Defaults to False.
+        provider (OpenLibraryProvider, optional): Metadata provider. Defaults
+        to OpenLibrary.
+        metrics (ScanMetrics, optional): Collects stage timings and shows
+        progress. Defaults to a new ScanMetrics.
+        include ([str], optional): Glob patterns of file names to scan.
+        Defaults to every supported file.
+        exclude ([str], optional): Glob patterns of file and directory names
+        to skip. Defaults to None.
+        maxAttempts (int, optional): Times a file that fails to parse is tried
+        across scans. Defaults to 3.
+        ocr (OcrStrategy, optional): How pdf pages are OCR'd. Defaults to OcrStrategy().
 
     Returns:
         [str]: List of valid ISBNs found in the directories.
@@ -123,52 +633,175 @@ def parse_directories(dirPath: [str], logger: Logger) -> [str]:
     pdfCount: int = 0
     parsedPdfCount: int = 0
     valid_isbns: [str] = []
-    def_provider = OpenLibraryProvider
-    
-    for dir in dirPath:
-        files = os.listdir(dir)
-        for file in files:
-            filePath = dir + "/" + file
+    duplicateCount: int = 0
+    #   ISBNs found earlier in this scan that may not be stored yet
+    submitted: set[str] = set()
+    catalogued: int = 0
+    if ocr == None:
+        ocr = OcrStrategy()
+    pdfTiers = ("metadata", "text") + ocr.tiers
+    tierCounts: dict[str, int] = {tier: 0 for tier in pdfTiers + epub_tiers}
+    pending: [Book] = []
+    from book_meta import OpenLibraryProvider, MetadataFetcher
+    if provider == None:
+        provider = OpenLibraryProvider(log=logger)
+    if metrics == None:
+        metrics = ScanMetrics()
+    #   Metadata is looked up on a background thread while files are parsed
+    fetcher = MetadataFetcher(provider, metrics=metrics)
+    cache = ScanCache(hashFiles, retryFailed, logger) if incremental else None
+    queue = ScanQueue(maxAttempts, retryFailed=retryFailed, log=logger)
+    #   Files claimed from the queue at a time
+    claimSize = max(8, workers * 4)
+    #   Known ISBNs and paths are checked in memory before any parsing,
+    #   lookups or writes
+    with metrics.timed("db"):
+        index = library_index()
+        queue.recover()
+        leftover = queue.counts()
+
+    def flush() -> None:
+        #   Books, the fingerprints of their files and the finished jobs are
+        #   written together, or not at all
+        try:
+            with metrics.timed("db"), transaction():
+                store_books(pending, logger)
+                if cache != None:
+                    cache.flush(logger)
+                queue.flush(logger)
+        except sqlite3.Error:
+            #   The files go back in the queue when the scan ends and their
+            #   books are looked up again by the next scan
+            logger.exception(f"Failed to store {len(queue.pending)} scanned files in db.")
+            submitted.difference_update(book.isbn for book in pending)
+            if cache != None:
+                cache.discard()
+            queue.discard()
+        pending.clear()
+
+    def finish_file(filePath: str, isbn: str | None = None, error: str | None = None) -> None:
+        #   Only remember files that parsed cleanly, errors may be temporary
+        if cache != None and error == None:
+            cache.record(filePath, isbn)
+        queue.finish(filePath, isbn, error)
+        if len(queue.pending) >= batchSize:
+            flush()
+
+    def queue_books(books: [Book]) -> None:
+        #   Books without metadata are stored with just their ISBN and path
+        for book in books:
+            pending.append(book)
+            finish_file(book.path, book.isbn)
+
+    def list_files():
+        nonlocal catalogued
+        #   The walk runs ahead on its own thread so the progress line can
+        #   count files while the first ones are parsed
+        walkStart = time.perf_counter()
+
+        def walked():
+            metrics.record("walk", time.perf_counter() - walkStart)
+            metrics.end_walk()
+
+        patterns = include or ["*" + ext for ext in supported_extensions]
+        entries = walk_files(dirPath, patterns, exclude, log=logger)
+        for entry in walk_ahead(entries, metrics.discover, walked):
+            if not entry.name.endswith(supported_extensions):
+                metrics.skip()
+                continue
+            #   Books catalogued before their files had a fingerprint, e.g.
+            #   by an older version, aren't parsed again
+            if cache != None and not cache.knows(entry.path) and index.has_path(entry.path):
+                catalogued += 1
+                metrics.skip()
+                continue
             try:
-                if file.endswith(".pdf"):
-                    pdfCount += 1
-                    fileCount += 1
-                    isbn = parse_isbn_from_pdf(filePath)
-                    if (isbn != None):
-                        valid_isbns.append(isbn)
-                        parsedPdfCount += 1
-                        meta = def_provider.fetch_book(def_provider, isbn)
-                        if(meta != None):
-                            meta.path = filePath
-                            store_book(meta, logger)
-                            #print(meta)
-                        else:
-                            store_isbn(isbn, filePath, logger)
-                    else:
-                        logger.error(f"Failed to parse \"{file}\"")
-                        
-                elif file.endswith(".epub"):
-                    epubCount += 1
-                    fileCount += 1
-                    isbn = parse_isbn_from_epub(filePath)
-                    if (isbn != None):
-                        valid_isbns.append(isbn)
-                        parsedEpubCount += 1
-                        meta = def_provider.fetch_book(def_provider, isbn)
-                        if(meta != None):
-                            meta.path = filePath
-                            store_book(meta, logger)
-                            #print(meta)
-                        else:
-                            store_isbn(isbn, filePath, logger)
-                    else:
-                        logger.error(f"Failed to parse \"{file}\"")
-            
-            except:
-                logger.error(f"Failed to parse \"{file}\"")
+                stat = entry.stat()
+                if cache != None:
+                    with metrics.timed("fingerprint"):
+                        changed = cache.needs_scan(entry.path, stat)
+                    if not changed:
+                        metrics.skip()
+                        continue
+                yield entry.path, stat.st_size, stat.st_mtime_ns
+            except OSError:
+                #   Let the parser report unreadable files
+                yield entry.path, None, None
+
+    def claimed_files():
+        #   Found files are queued a batch at a time and claimed back, which
+        #   also picks up files left by an interrupted scan and shares the
+        #   work with other scans of the same queue
+        files = list_files()
+        while True:
+            batch = list(islice(files, claimSize))
+            with metrics.timed("db"):
+                if batch:
+                    queue.add(batch)
+                paths = queue.claim(claimSize)
+            if not paths and not batch:
+                return
+            yield from paths
+
+    metrics.start()
+    resumed = leftover.get("pending", 0) + leftover.get("retry", 0)
+    if resumed:
+        print(f"Resuming {resumed} files left in the scan queue.")
+        metrics.total = resumed
+    try:
+        for res in scan_files(claimed_files(), workers, pageChunk, pageOrder, textLayer, ocr):
+            metrics.add_result(res)
+            file = os.path.basename(res.filePath)
+            fileCount += 1
+            if res.kind == "pdf":
+                pdfCount += 1
+            else:
+                epubCount += 1
+            if res.isbn == None:
+                cause = res.error if res.error != None else "no ISBN found"
+                logger.error(f"Failed to parse \"{file}\" after {res.seconds:.2f}s: {cause}")
+                finish_file(res.filePath, error=res.error)
+                continue
+            if res.isbn in submitted or is_catalogued(res.isbn):
+                #   Already in the library, no need to look it up or store it
+                duplicateCount += 1
+                finish_file(res.filePath, res.isbn)
+            else:
+                submitted.add(res.isbn)
+                fetcher.submit(res.isbn, res.filePath)
+            queue_books(fetcher.ready())
+            valid_isbns.append(res.isbn)
+            if res.kind == "pdf":
+                parsedPdfCount += 1
+                tierCounts[res.tier] += 1
+            else:
+                parsedEpubCount += 1
+                tierCounts[res.tier] += 1
+
+        #   Wait for the last lookups
+        queue_books(fetcher.close())
+    finally:
+        #   Write whatever finished, even when interrupted, and put the files
+        #   that didn't back in the queue for the next scan
+        queue_books(fetcher.ready())
+        flush()
+        queue.release()
+    metrics.finish()
 
     print(f"Parsed Pdfs: {parsedPdfCount} out of {pdfCount}")
+    print("Pdf ISBNs found by: " + ", ".join(f"{tier} {tierCounts[tier]}" for tier in pdfTiers))
     print(f"Parsed Epubs: {parsedEpubCount} out of {epubCount}")
+    print("Epub ISBNs found by: " + ", ".join(f"{tier} {tierCounts[tier]}" for tier in epub_tiers))
     print(f"Successfully scanned {parsedPdfCount + parsedEpubCount} out of {fileCount} files in directory.")
+    if cache != None:
+        print(f"Skipped {cache.skipped} unchanged files, {cache.moved} moved files "
+              f"and {catalogued} files already in the library.")
+    if duplicateCount:
+        print(f"{duplicateCount} ISBNs were already in the library.")
+    counts = queue.counts()
+    if counts.get("failed") or counts.get("retry"):
+        print(f"{counts.get('retry', 0)} files failed and will be retried by the next scan, "
+              f"{counts.get('failed', 0)} failed {maxAttempts} times and won't be.")
+    metrics.print_summary()
 
     return valid_isbns
@@ -0,0 +1,154 @@
+import hashlib
+import os
+from logging import Logger
+
+import book_db
+
+#   Statuses stored in scan_state
+STATUS_FOUND: str = "found"
+STATUS_FAILED: str = "failed"
+
+
+def hash_file(filePath: str, chunkSize: int = 1 << 20) -> str:
+    """
+        Hashes a file's contents in chunks so large pdfs aren't read into memory.
+
+    Args:
+        filePath (str): Full filepath to the file.
+        chunkSize (int, optional): Bytes read at a time. Defaults to 1 MiB.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filePath, "rb") as f:
+        while chunk := f.read(chunkSize):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ScanCache:
+    """
+        Remembers the size, mtime and optionally the content hash of every
+        scanned file so later scans only parse new or changed files. Files
+        whose ISBN couldn't be found are remembered too so they aren't OCR'd
+        again on every run.
+
+        The fingerprints are loaded once and new ones are buffered until flush
+        is called, which lets the caller write them in the same transaction
+        as the books they belong to.
+    """
+    useHash: bool
+    retryFailed: bool
+    log: Logger
+    skipped: int
+    moved: int
+    entries: dict[str, tuple]
+    byHash: dict[str, str]
+    fingerprints: dict[str, tuple]
+    pending: [tuple]
+
+    def __init__(self, useHash: bool = False, retryFailed: bool = False, log: Logger = None):
+        """
+        Args:
+            useHash (bool, optional): Hash new and changed files to detect moved
+            or renamed files. Defaults to False.
+            retryFailed (bool, optional): Parse files whose ISBN couldn't be found
+            on an earlier scan again. Defaults to False.
+            log (Logger, optional): Log to write moved files to. Defaults to None.
+        """
+        self.useHash = useHash
+        self.retryFailed = retryFailed
+        self.log = log
+        self.skipped = 0
+        self.moved = 0
+        self.entries = book_db.get_scan_states()
+        self.byHash = {}
+        if useHash:
+            for path, (_, _, digest, _, _) in self.entries.items():
+                if digest != None:
+                    self.byHash[digest] = path
+        self.fingerprints = {}
+        self.pending = []
+
+    def knows(self, filePath: str) -> bool:
+        """
+            Checks whether a file has been scanned before, changed or not.
+        """
+        return filePath in self.entries
+
+    def needs_scan(self, filePath: str, stat: os.stat_result = None) -> bool:
+        """
+            Checks whether a file has to be parsed. Unchanged files and files
+            with the same contents as an already scanned file don't.
+
+        Args:
+            filePath (str): Full filepath to the file.
+            stat (os.stat_result, optional): The file's stat if already known,
+            e.g. from os.scandir.
+
+        Returns:
+            bool: Whether or not the file should be parsed.
+        """
+        if stat == None:
+            stat = os.stat(filePath)
+        entry = self.entries.get(filePath)
+        if (entry != None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns
+                and (entry[4] == STATUS_FOUND or not self.retryFailed)):
+            self.skipped += 1
+            return False
+
+        digest = hash_file(filePath) if self.useHash else None
+        self.fingerprints[filePath] = (stat.st_size, stat.st_mtime_ns, digest)
+        if digest == None or digest not in self.byHash:
+            return True
+
+        #   Same contents as a file we've already scanned
+        oldPath = self.byHash[digest]
+        oldEntry = self.entries.get(oldPath)
+        if oldPath == filePath or oldEntry == None:
+            return True
+        if oldEntry[4] == STATUS_FAILED and self.retryFailed:
+            return True
+        if not os.path.exists(oldPath):
+            book_db.move_path(oldPath, filePath)
+            del self.entries[oldPath]
+            self.moved += 1
+            if self.log != None:
+                self.log.info(f"Moved \"{oldPath}\" to \"{filePath}\"")
+        else:
+            self.skipped += 1
+        self.byHash[digest] = filePath
+        self.entries[filePath] = oldEntry[:2] + (digest,) + oldEntry[3:]
+        self.record(filePath, oldEntry[3])
+        return False
+
+    def record(self, filePath: str, isbn: str | None) -> None:
+        """
+            Buffers the outcome of scanning a file.
+
+        Args:
+            filePath (str): Full filepath to the file.
+            isbn (str | None): ISBN found in the file or None if there wasn't one.
+        """
+        fingerprint = self.fingerprints.pop(filePath, None)
+        if fingerprint == None:
+            stat = os.stat(filePath)
+            fingerprint = (stat.st_size, stat.st_mtime_ns, None)
+        status = STATUS_FAILED if isbn == None else STATUS_FOUND
+        self.pending.append((filePath,) + fingerprint + (isbn, status))
+
+    def flush(self, log: Logger = None) -> None:
+        """
+            Writes the buffered fingerprints to the database.
+        """
+        if self.pending:
+            book_db.store_scan_states(self.pending, log)
+            self.pending.clear()
+
+    def discard(self) -> None:
+        """
+            Drops the buffered fingerprints, e.g. when the transaction they
+            were written in rolled back, so their files are scanned again.
+        """
+        self.pending.clear()
@@ -0,0 +1,174 @@
+import os
+import socket
+import time
+from logging import Logger
+from typing import Iterable
+
+import book_db
+from book_db import JOB_DONE, JOB_FAILED
+
+
+def _process_alive(pid: int) -> bool:
+    #   os.kill(pid, 0) would end the process on Windows, so there a dead
+    #   scan is only noticed once its claims go stale
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ScanQueue:
+    """
+        Persistent queue of the files a scan has to parse, kept in the
+        scan_jobs table. Files are queued as the walk finds them, claimed in
+        small batches and marked done or failed in the same transaction as
+        the books found in them, so a scan that crashes or is interrupted
+        only loses the files it was working on. Those are put back in the
+        queue by the next scan.
+
+        Every claim is an attempt. Failed files are retried by later scans
+        until they've used maxAttempts, so a file that crashes the parser
+        can't stop every scan.
+
+        Several scans can share a queue, each claims different files.
+    """
+    owner: str
+    maxAttempts: int
+    staleAfter: float
+    retryFailed: bool
+    log: Logger
+    claimed: set[str]
+    pending: [tuple]
+    recovered: int
+
+    def __init__(self, maxAttempts: int = 3, staleAfter: float = 6 * 3600,
+                 retryFailed: bool = False, log: Logger = None):
+        """
+        Args:
+            maxAttempts (int, optional): Times a file is claimed before it's
+            given up on. Defaults to 3.
+            staleAfter (float, optional): Seconds after which a claimed file
+            is assumed to be abandoned, whichever scan claimed it. Claims of
+            scans on this machine are recovered sooner if their process is
+            gone. Defaults to 6 hours.
+            retryFailed (bool, optional): Give files that ran out of attempts
+            new ones when they're queued again. Defaults to False.
+            log (Logger, optional): Log to write recovered files to. Defaults to None.
+        """
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.maxAttempts = maxAttempts
+        self.staleAfter = staleAfter
+        self.retryFailed = retryFailed
+        self.log = log
+        self.claimed = set()
+        self.pending = []
+        self.recovered = 0
+
+    def recover(self) -> int:
+        """
+            Puts files claimed by scans that are no longer running back in
+            the queue.
+
+        Returns:
+            int: Number of files recovered.
+        """
+        host = socket.gethostname()
+        now = time.time()
+        abandoned: [str] = []
+        alive: dict[str, bool] = {}
+        for path, (owner, claimedAt) in book_db.get_running_scan_jobs().items():
+            #   Old claims are abandoned wherever they're from, after a reboot
+            #   their pid may belong to an unrelated process
+            if claimedAt == None or now - claimedAt > self.staleAfter:
+                abandoned.append(path)
+                continue
+            ownerHost, _, pid = (owner or "").rpartition(":")
+            if ownerHost == host and pid.isdigit():
+                if owner not in alive:
+                    alive[owner] = _process_alive(int(pid)) and int(pid) != os.getpid()
+                if not alive[owner]:
+                    abandoned.append(path)
+        if abandoned:
+            self.recovered += book_db.release_scan_jobs(abandoned)
+            if self.log != None:
+                self.log.info(f"Resuming {len(abandoned)} files left by an interrupted scan")
+        return len(abandoned)
+
+    def add(self, files: Iterable[tuple]) -> int:
+        """
+            Queues files to be parsed.
+
+        Args:
+            files (Iterable[tuple]): (path, size, mtime_ns) tuples.
+
+        Returns:
+            int: Number of files queued, files that are already queued and
+            unchanged aren't counted.
+        """
+        return book_db.enqueue_scan_jobs(files, self.retryFailed, self.log)
+
+    def claim(self, limit: int) -> [str]:
+        """
+            Claims up to limit queued files for this scan.
+
+        Returns:
+            [str]: Paths of the claimed files.
+        """
+        paths = book_db.claim_scan_jobs(self.owner, limit, self.maxAttempts)
+        self.claimed.update(paths)
+        return paths
+
+    def finish(self, filePath: str, isbn: str | None = None, error: str | None = None) -> None:
+        """
+            Buffers the outcome of parsing a claimed file until flush.
+
+        Args:
+            filePath (str): Full filepath to the file.
+            isbn (str | None, optional): ISBN found in the file. Defaults to None.
+            error (str | None, optional): Why parsing failed. A file that
+            parsed without an ISBN is done, not failed. Defaults to None.
+        """
+        self.claimed.discard(filePath)
+        self.pending.append((filePath, JOB_FAILED if error != None else JOB_DONE, isbn, error))
+
+    def flush(self, log: Logger = None) -> None:
+        """
+            Writes the buffered outcomes to the database.
+        """
+        if self.pending:
+            book_db.finish_scan_jobs(self.pending, log)
+            self.pending.clear()
+
+    def discard(self) -> None:
+        """
+            Drops the buffered outcomes, e.g. when the transaction they were
+            written in rolled back. Their files count as claimed again, so
+            release puts them back in the queue.
+        """
+        self.claimed.update(path for path, *_ in self.pending)
+        self.pending.clear()
+
+    def release(self) -> int:
+        """
+            Puts the files this scan claimed but didn't finish back in the
+            queue, e.g. when it's interrupted, without using up an attempt.
+
+        Returns:
+            int: Number of files released.
+        """
+        if not self.claimed:
+            return 0
+        released = book_db.release_scan_jobs(self.claimed, countAttempt=False)
+        self.claimed.clear()
+        return released
+
+    def counts(self) -> dict[str, int]:
+        """
+            Counts the files in the queue by state.
+        """
+        return book_db.scan_job_counts(self.maxAttempts)
@@ -0,0 +1,97 @@
+#   Streaming directory traversal
+import fnmatch
+import os
+import queue
+import threading
+from logging import Logger
+from typing import Callable, Iterable, Iterator
+
+
+def _matches(name: str, patterns: [str]) -> bool:
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def walk_files(roots: Iterable[str], include: [str] = None, exclude: [str] = None,
+               followLinks: bool = False, log: Logger = None) -> Iterator[os.DirEntry]:
+    """
+        Walks directory trees with os.scandir and yields matching files as
+        they're found, so a scan can start before the walk is done. Each
+        directory is listed once, even if it's reachable from several roots.
+
+    Args:
+        roots (Iterable[str]): Directories to walk.
+        include ([str], optional): Glob patterns a file name must match one
+        of. Defaults to every file.
+        exclude ([str], optional): Glob patterns of file and directory names
+        to skip. Defaults to None.
+        followLinks (bool, optional): Walk into symlinked directories. Defaults to False.
+        log (Logger, optional): Log to write unreadable directories to. Defaults to None.
+
+    Returns:
+        Iterator[os.DirEntry]: Matching files in sorted order within each directory.
+    """
+    seen: set[tuple[int, int]] = set()
+    for root in roots:
+        stack = [os.fspath(root)]
+        while stack:
+            directory = stack.pop()
+            try:
+                stat = os.stat(directory)
+                #   Skip directories we've already listed, e.g. a root that
+                #   is inside another root or a symlink loop
+                key = (stat.st_dev, stat.st_ino)
+                if key in seen:
+                    continue
+                seen.add(key)
+                with os.scandir(directory) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                if log != None:
+                    log.exception(f"Failed to list \"{directory}\"")
+                continue
+            subdirs: [str] = []
+            for entry in entries:
+                if exclude and _matches(entry.name, exclude):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=followLinks):
+                        subdirs.append(entry.path)
+                    elif entry.is_file() and (not include or _matches(entry.name, include)):
+                        yield entry
+                except OSError:
+                    continue
+            #   Reversed so subdirectories are walked in sorted order
+            stack.extend(reversed(subdirs))
+
+
+def walk_ahead(items: Iterable, onItem: Callable = None, onDone: Callable = None) -> Iterator:
+    """
+        Consumes an iterator on a background thread so it runs ahead of the
+        caller, e.g. to count files for a progress estimate while the first
+        ones are already being parsed.
+
+    Args:
+        items (Iterable): Items to read ahead.
+        onItem (Callable, optional): Called on the background thread with each item.
+        onDone (Callable, optional): Called on the background thread once items is exhausted.
+
+    Returns:
+        Iterator: The same items in the same order.
+    """
+    done = object()
+    buffer = queue.Queue()
+
+    def run():
+        try:
+            for item in items:
+                if onItem != None:
+                    onItem(item)
+                buffer.put(item)
+        finally:
+            if onDone != None:
+                onDone()
+            buffer.put(done)
+
+    threading.Thread(target=run, name="walk-ahead", daemon=True).start()
+    while (item := buffer.get()) is not done:
+        yield item
@@ -0,0 +1,115 @@
+import os
+import queue
+import tempfile
+import threading
+
+#   Formats captures can be saved in and the name of the OpenCV quality flag
+#   for each. OpenCV is only imported once a capture is encoded.
+capture_formats: dict[str, str | None] = {
+    "png": None,
+    "jpg": "IMWRITE_JPEG_QUALITY",
+    "webp": "IMWRITE_WEBP_QUALITY",
+}
+
+
+class CaptureWriter:
+    """
+        Encodes and saves barcode captures on a background thread so image
+        encoding never slows down the scan loop. Files are written to a
+        temporary name and renamed into place, so a capture is either complete
+        or missing, never half written.
+
+        Usage:
+            writer = CaptureWriter("captures", "jpg", 85)
+            path = writer.submit(frame, isbn)
+            writer.flush()  # wait for pending captures
+    """
+    directory: str
+    format: str
+    quality: int
+    crop: bool
+
+    def __init__(self, directory: str = "captures", format: str = "jpg", quality: int = 85,
+                 crop: bool = False, maxPending: int = 32):
+        """
+        Args:
+            directory (str, optional): Directory captures are saved in. Defaults to "captures".
+            format (str, optional): One of capture_formats. Defaults to "jpg".
+            quality (int, optional): JPEG/WebP quality from 1 to 100. Defaults to 85.
+            crop (bool, optional): Only save the barcode region when it's known. Defaults to False.
+            maxPending (int, optional): Captures queued before submit blocks. Defaults to 32.
+        """
+        if format not in capture_formats:
+            raise ValueError(f"Unknown capture format: {format}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.format = format
+        self.quality = quality
+        self.crop = crop
+        self.errors = 0
+        self.queue = queue.Queue(maxsize=maxPending)
+        self.thread = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+        self.thread.start()
+
+    def path_for(self, isbn: str) -> str:
+        """
+            Returns the path the capture of an ISBN is saved to.
+        """
+        return f"{self.directory}/barcode_{isbn}.{self.format}"
+
+    def submit(self, frame, isbn: str, region: tuple = None) -> str:
+        """
+            Queues a frame to be saved.
+
+        Args:
+            frame: Image frame containing the barcode.
+            isbn (str): ISBN used in the filename.
+            region (tuple, optional): (x0, y0, x1, y1) of the barcode, saved
+            instead of the whole frame when crop is set.
+
+        Returns:
+            str: Path the capture will be saved to.
+        """
+        if self.crop and region != None:
+            x0, y0, x1, y1 = region
+            frame = frame[y0:y1, x0:x1]
+        path = self.path_for(isbn)
+        self.queue.put((frame, path))
+        return path
+
+    def flush(self) -> None:
+        """
+            Waits until every queued capture has been written.
+        """
+        self.queue.join()
+
+    def _encode(self, frame) -> bytes:
+        import cv2
+        flag = capture_formats[self.format]
+        params = [getattr(cv2, flag), self.quality] if flag != None else []
+        ok, data = cv2.imencode("." + self.format, frame, params)
+        if not ok:
+            raise ValueError(f"Failed to encode capture as {self.format}")
+        return data.tobytes()
+
+    def _write(self, frame, path: str) -> None:
+        data = self._encode(frame)
+        fd, tmpPath = tempfile.mkstemp(dir=self.directory, prefix=".capture-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmpPath, path)
+        except BaseException:
+            os.unlink(tmpPath)
+            raise
+
+    def _run(self) -> None:
+        while True:
+            frame, path = self.queue.get()
+            try:
+                self._write(frame, path)
+            except Exception as e:
+                self.errors += 1
+                print(f"Failed to save capture {path}: {e}")
+            finally:
+                self.queue.task_done()
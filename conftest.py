@@ -0,0 +1,13 @@
+import pytest
+
+import book_db
+
+
+@pytest.fixture
+def db(tmp_path):
+    #   A fresh database for each test, on the calling thread's connection
+    book_db.close_connection()
+    book_db.conn_string = str(tmp_path / "books.db")
+    book_db.create_table()
+    yield book_db
+    book_db.close_connection()
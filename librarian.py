@@ -6,15 +6,81 @@ import sqlite3
 import os
 import isbnlib
 import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import book_db
+from book import Book
 from book_meta import OpenLibraryProvider
-from book_parser import validate_and_convert
+from book_isbn import validate_and_convert
+from capture_writer import CaptureWriter
+from barcode_decoder import BarcodeDecoder, decode_image_file, decode_video_segment, video_segments
+
+image_extensions = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+
+
+class FrameGrabber:
+    """
+    Reads frames from a capture device on its own thread at camera rate and
+    keeps only the most recent one, so slow consumers always work on a fresh
+    frame instead of a backlog of stale ones.
+    """
+    def __init__(self, cap):
+        """
+        :param cap: An opened cv2.VideoCapture.
+        """
+        self.cap = cap
+        self.frame = None
+        self.frame_id = 0
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="frame-grabber", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            ret, frame = self.cap.read()
+            with self.condition:
+                if not ret:
+                    # The camera was unplugged or the video ended:
+                    self.running = False
+                else:
+                    self.frame = frame
+                    self.frame_id += 1
+                self.condition.notify_all()
+
+    def latest(self, after_id=0, timeout=None):
+        """
+        Waits for a frame newer than after_id.
+
+        :param after_id: Id of the last frame the caller has seen.
+        :param timeout: Seconds to wait, or None to wait until a frame arrives.
+        :return: (frame_id, frame), or (after_id, None) if no newer frame
+        arrived in time or the grabber stopped.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame_id > after_id or not self.running, timeout)
+            if self.frame_id > after_id:
+                return self.frame_id, self.frame
+            return after_id, None
+
+    def stop(self):
+        """
+        Stops reading frames and waits for the grabber thread to finish.
+        """
+        self.running = False
+        self.thread.join()
+
 
 class BarcodeScanner:
     book_detected: bool = False
     isbn_stored: bool = False
     barcode_detected: bool = False
     last_valid_isbn: str = None
+    provider: OpenLibraryProvider = None
+    # Mean pixel difference (0-255) between downscaled grayscale frames that
+    # counts as a new book being slid under the camera:
+    diff_threshold: float = 12.0
     """
     This class represents a barcode scanner that captures ISBN barcodes from a
     webcam feed and stores them in a SQLite database.
@@ -23,55 +89,78 @@ class BarcodeScanner:
     can slide books one after another underneath the camera to rapidly
     catelogue barcodes.
     """
-    def __init__(self):
+    def __init__(self, provider: OpenLibraryProvider = None, diff_threshold: float = 12.0,
+                 decode_mode: str = "fast", capture_writer: CaptureWriter = None):
         """
         Initializes the BarcodeScanner instance with various flags and
         attributes.
+
+        :param provider: Metadata provider used for new ISBNs. Defaults to
+        OpenLibrary without a cache.
+        :param diff_threshold: Frame difference that re-arms decoding after a
+        book has been stored.
+        :param decode_mode: "fast" decodes grayscale, downscaled and tracked
+        regions with BarcodeDecoder, "full" decodes every full colour frame.
+        :param capture_writer: Background writer for barcode captures.
+        Defaults to JPEG captures in the 'captures' directory.
         """
+        self.capture_writer = capture_writer if capture_writer != None else CaptureWriter()
+        self.diff_threshold = diff_threshold
+        self.decode_mode = decode_mode
+        self.decoder = BarcodeDecoder()
+        self.scanning = False
         self.book_detected = False
         self.isbn_stored = False
         self.barcode_detected = False
         self.last_valid_isbn = None
+        self.provider = provider if provider != None else OpenLibraryProvider()
 
-    def store_isbn(self, isbn, frame):
+    def store_isbn(self, isbn, frame, region=None):
         """
         Stores a new ISBN in the database and saves the associated frame in the
         captures directory.
 
         :param isbn: The ISBN to store.
         :param frame: The image frame containing the barcode.
-        :return: True if the ISBN was stored successfully, False otherwise.
+        :param region: (x0, y0, x1, y1) of the barcode in the frame, if known.
+        :return: True if the ISBN was stored successfully, False if it was
+        already catalogued or couldn't be stored.
         """
-        def_provider = OpenLibraryProvider
-        framePath = f"captures/barcode_{isbn}.png"
+        #   Books already in the library are skipped before any lookup
+        if book_db.is_catalogued(isbn):
+            print(f"ISBN {isbn} is already in the library.")
+            return False
+
+        framePath = self.capture_writer.path_for(isbn)
         
         #   Fetch metadata for the newly found isbn.
-        meta = def_provider.fetch_book(def_provider, isbn)
+        meta = self.provider.fetch_book(isbn)
         if(meta != None):
             meta.path = framePath
-            book_db.store_book(meta)
+            stored = book_db.store_book(meta)
             #print(meta)
         else:
             #   If none is found just store the path to the image with the isbn
-            book_db.store_isbn(isbn, framePath)
+            stored = book_db.store_isbn(isbn, framePath)
         
         # Save the frame in the captures directory:
-        self.save_capture(frame, isbn)
+        self.save_capture(frame, isbn, region)
 
-        return True
+        return stored
 
-    def save_capture(self, frame, isbn):
+    def save_capture(self, frame, isbn, region=None):
         """
-        Saves an image frame to the 'captures' directory using the ISBN in the
-        filename.
+        Queues an image frame to be saved to the 'captures' directory using
+        the ISBN in the filename. Encoding and writing happen on the capture
+        writer's thread.
 
         :param frame: The image frame to save.
         :param isbn: The ISBN used as the filename.
+        :param region: (x0, y0, x1, y1) of the barcode, saved instead of the
+        whole frame if the writer crops.
+        :return: Path the capture is saved to.
         """
-
-        # Save the frame as an image with the ISBN as the filename:
-        filename = f"captures/barcode_{isbn}.png"
-        cv2.imwrite(filename, frame)
+        return self.capture_writer.submit(frame, isbn, region)
 
     def capture_single_barcode(self):
         """
@@ -84,14 +173,12 @@ class BarcodeScanner:
         cv2.imshow('Barcode Scanner', frame)
         
         if not self.book_detected and not self.isbn_stored:
-            barcodes = pyzbar.decode(frame)
-            
-            for barcode in barcodes:
-                barcode_data = barcode.data.decode('utf-8')
-                if validate_and_convert(barcode_data) != None:
-                    self.store_isbn(barcode_data, frame)
-                    self.barcode_detected = True
-                    self.last_valid_isbn = barcode_data
+            #   Same decoder and ISBN-13 conversion as the live scanner
+            isbn = self.decode_isbn(frame)
+            if isbn != None:
+                self.store_isbn(isbn, frame)
+                self.barcode_detected = True
+                self.last_valid_isbn = isbn
                     
             if self.barcode_detected == True:
                 self.book_detected = True
@@ -110,67 +197,145 @@ class BarcodeScanner:
             self.barcode_detected = False
             
             time.sleep(1)
+            self.capture_writer.flush()
             cap.release()
             cv2.destroyAllWindows()
 
-    def capture_barcode(self):
+    @staticmethod
+    def thumbnail(frame):
         """
-        Captures frames from the webcam, detects barcodes, and stores valid
-        ISBNs in the database.
+        Shrinks a frame to a small grayscale image for cheap comparisons.
         """
-        # Open the webcam:
-        cap = cv2.VideoCapture(0)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, (64, 48), interpolation=cv2.INTER_AREA)
 
-        while True:
-            # Read a frame from the webcam:
-            ret, frame = cap.read()
+    @staticmethod
+    def frame_difference(a, b):
+        """
+        Returns the mean absolute pixel difference between two thumbnails.
+        """
+        return float(cv2.mean(cv2.absdiff(a, b))[0])
 
-            # Pause for 1 second after the frame is read:
-            time.sleep(1)
+    def decode_isbn(self, frame):
+        """
+        Decodes the barcodes in a frame and returns the first valid ISBN.
 
-            # Display the frame:
-            cv2.imshow('Barcode Scanner', frame)
+        :param frame: The image frame to decode.
+        :return: The ISBN-13 or None if the frame has no valid ISBN barcode.
+        """
+        if self.decode_mode == "fast":
+            return self.decoder.decode(frame)
+        for barcode in pyzbar.decode(frame):
+            isbn = validate_and_convert(barcode.data.decode('utf-8'))
+            if isbn != None:
+                return isbn
+        return None
 
-            # Find and decode barcodes if a new book is detected and not yet
-            # stored:
-            if not self.book_detected and not self.isbn_stored:
-                barcodes = pyzbar.decode(frame)
+    def _decode_loop(self, grabber, store_queue):
+        """
+        Decodes the latest frame whenever decoding is armed. Once a book is
+        stored decoding pauses until the picture changes enough for a new
+        book to be under the camera.
+        """
+        frame_id = 0
+        reference = None
+        armed = True
+        while self.scanning and grabber.running:
+            frame_id, frame = grabber.latest(frame_id, timeout=0.5)
+            if frame is None:
+                continue
+            thumb = self.thumbnail(frame)
+            if not armed:
+                if self.frame_difference(thumb, reference) < self.diff_threshold:
+                    continue
+                armed = True
 
-                # If a barcode is detected, filter and store the ISBN:
-                for barcode in barcodes:
-                    barcode_data = barcode.data.decode('utf-8')
-                    if validate_and_convert(barcode_data) != None:
-                        self.store_isbn(barcode_data, frame)
-                        self.barcode_detected = True
-                        self.last_valid_isbn = barcode_data
-                        break
+            isbn = self.decode_isbn(frame)
+            if isbn == None:
+                continue
+            # Pause until the scene changes again, even for the same book:
+            armed = False
+            reference = thumb
+            if isbn != self.last_valid_isbn:
+                self.last_valid_isbn = isbn
+                region = self.decoder.roi if self.decode_mode == "fast" else None
+                store_queue.put((isbn, frame, region))
 
-            # Set the flags based on barcode detection:
-            if self.barcode_detected:
-                self.book_detected = True
-                self.isbn_stored = True
-            else:
-                self.book_detected = False
-                self.isbn_stored = False
-
-            # Show the confirmation message:
-            if self.barcode_detected:
+    def _store_loop(self, store_queue):
+        """
+        Looks up metadata and stores ISBNs off the capture and decode threads
+        so network calls never freeze the scanner.
+        """
+        while True:
+            item = store_queue.get()
+            if item is None:
+                break
+            isbn, frame, region = item
+            try:
+                self.store_isbn(isbn, frame, region)
                 print("Valid ISBN barcode detected.")
-                print("Last valid ISBN: ", self.last_valid_isbn)
-            else:
-                print("No valid ISBN barcode detected.")
+                print("Last valid ISBN: ", isbn)
+            except Exception as e:
+                print(f"Failed to store ISBN {isbn}: {e}")
 
-            # Reset the barcode detection flag:
-            self.barcode_detected = False
+    def capture_barcode(self):
+        """
+        Captures frames from the webcam, detects barcodes, and stores valid
+        ISBNs in the database.
+
+        Frames are captured, decoded and stored on separate threads. The
+        capture thread runs at camera rate, the decode thread only works on
+        the newest frame and the store thread handles metadata lookups and
+        database writes in the background.
+        """
+        # Open the webcam:
+        cap = cv2.VideoCapture(0)
+        grabber = FrameGrabber(cap)
+        store_queue = queue.Queue()
+        self.scanning = True
+        decoder = threading.Thread(target=self._decode_loop, args=(grabber, store_queue),
+                                   name="barcode-decoder", daemon=True)
+        storer = threading.Thread(target=self._store_loop, args=(store_queue,),
+                                  name="barcode-storer", daemon=True)
+        decoder.start()
+        storer.start()
+
+        shown_id = 0
+        while grabber.running:
+            # Display the newest frame:
+            shown_id, frame = grabber.latest(shown_id, timeout=0.1)
+            if frame is not None:
+                if self.decode_mode == "fast" and self.decoder.latencies:
+                    # Overlay the latest decode latency on a copy so the
+                    # decode thread's frame isn't touched:
+                    frame = frame.copy()
+                    latency = self.decoder.latencies[-1] * 1000
+                    cv2.putText(frame, f"decode {latency:.1f} ms ({self.decoder.last_pass})",
+                                (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+                cv2.imshow('Barcode Scanner', frame)
 
             # Check for 'q' or 'esc' key to exit:
             if cv2.waitKey(1) in (ord('q'), 27):
                 break
 
+        # Stop decoding and let the pending ISBNs finish storing:
+        self.scanning = False
+        decoder.join()
+        store_queue.put(None)
+        storer.join()
+        self.capture_writer.flush()
+
         # Release the webcam:
+        grabber.stop()
         cap.release()
         cv2.destroyAllWindows()
 
+        if self.decode_mode == "fast":
+            stats = self.decoder.stats()
+            if stats["frames"]:
+                print(f"Decoded {stats['frames']} frames: mean {stats['mean_ms']:.1f} ms, "
+                      f"p95 {stats['p95_ms']:.1f} ms, up to {stats['max_fps']:.0f} fps")
+
     def start_scanning(self):
         """
         Initiates the barcode scanning process and captures ISBN barcodes from
@@ -179,4 +344,127 @@ class BarcodeScanner:
         print("Barcode Scanner - Press 'q' or 'esc' to quit")
 
         # Capture barcodes and store ISBNs in the database:
-        self.capture_barcode(self)
+        self.capture_barcode()
+
+
+class Sighting:
+    """
+    A run of neighbouring frames or images that show the same ISBN.
+    """
+    def __init__(self, isbn, path, first, last):
+        self.isbn = isbn
+        self.path = path
+        self.first = first
+        self.last = last
+
+
+def collapse_sightings(hits, gap):
+    """
+    Merges hits of the same ISBN that are at most gap frames apart, so a book
+    held in view for many frames counts once.
+
+    :param hits: (index, isbn, path) tuples in index order.
+    :param gap: Largest index gap that still belongs to the same sighting.
+    :return: List of Sightings in the order they started.
+    """
+    sightings = []
+    open_sightings = {}
+    for index, isbn, path in hits:
+        sighting = open_sightings.get(isbn)
+        if sighting is not None and index - sighting.last <= gap:
+            sighting.last = index
+            continue
+        sighting = Sighting(isbn, path, index, index)
+        open_sightings[isbn] = sighting
+        sightings.append(sighting)
+    return sightings
+
+
+class BatchBarcodeScanner:
+    """
+    Catalogues barcodes from a directory of photos or a recorded video instead
+    of a live webcam. Frames are decoded across a pool of worker processes,
+    repeated sightings of a book in neighbouring frames are merged, and new
+    ISBNs are stored through book_db with metadata from the provider.
+    """
+    def __init__(self, provider: OpenLibraryProvider = None, workers=1, frame_step=1, gap=15):
+        """
+        :param provider: Metadata provider used for new ISBNs.
+        :param workers: Number of decode processes.
+        :param frame_step: Decode every frame_step-th video frame.
+        :param gap: Frames (or images) between two sightings of the same ISBN
+        that still count as one.
+        """
+        self.provider = provider if provider != None else OpenLibraryProvider()
+        self.workers = workers
+        self.frame_step = frame_step
+        self.gap = gap
+
+    def scan_images(self, directory):
+        """
+        Decodes every image in a directory, in file name order.
+
+        :param directory: Directory of photos.
+        :return: List of Sightings.
+        """
+        files = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                       if f.lower().endswith(image_extensions))
+        if self.workers <= 1:
+            results = map(decode_image_file, files)
+            return self._collapse_images(results)
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            return self._collapse_images(pool.map(decode_image_file, files, chunksize=8))
+
+    def _collapse_images(self, results):
+        hits = []
+        for index, (path, isbns) in enumerate(results):
+            for isbn in isbns:
+                hits.append((index, isbn, path))
+        return collapse_sightings(hits, self.gap)
+
+    def scan_video(self, path):
+        """
+        Decodes a video file, splitting its frames between the workers.
+
+        :param path: Video file.
+        :return: List of Sightings.
+        """
+        tasks = video_segments(path, self.workers, self.frame_step)
+        if self.workers <= 1:
+            segments = [decode_video_segment(*task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                segments = list(pool.map(decode_video_segment, *zip(*tasks)))
+        hits = [(index, isbn, f"{path}#frame={index}") for segment in segments for index, isbn in segment]
+        return collapse_sightings(hits, self.gap * self.frame_step)
+
+    def scan(self, path):
+        """
+        Decodes a directory of images or a video file.
+        """
+        if os.path.isdir(path):
+            return self.scan_images(path)
+        return self.scan_video(path)
+
+    def store(self, sightings, log=None):
+        """
+        Stores the ISBNs of sightings that aren't catalogued yet. Metadata for
+        all of them is fetched in one batched lookup.
+
+        :param sightings: Sightings from scan.
+        :param log: Log to write errors and exceptions to.
+        :return: Number of books stored.
+        """
+        first_paths = {}
+        for sighting in sightings:
+            if sighting.isbn not in first_paths and not book_db.is_catalogued(sighting.isbn):
+                first_paths[sighting.isbn] = sighting.path
+        metas = self.provider.fetch_books(list(first_paths))
+        books = []
+        for isbn, path in first_paths.items():
+            meta = metas.get(isbn)
+            if meta is None:
+                books.append(Book(None, isbn, None, None, path))
+            else:
+                books.append(Book(meta.title, isbn, meta.publishers, meta.publish_date, path))
+        return book_db.store_books(books, log)
@@ -1,12 +1,26 @@
+from __future__ import annotations
 import os
+import sys
 import platform
 import logging
+import argparse
 from logging import Logger
 from pathlib import Path
-from book_parser import parse_directories
-from book_db import create_table, get_all_books
-from book_meta import OpenLibraryProvider
-from librarian import BarcodeScanner
+from typing import TYPE_CHECKING
+import book_db
+from book_db import create_table, stream_books, book_columns, search
+from book_export import exporters, export_formats, binary_formats, default_columns, export_table
+#   Only the option lists of these are used at startup, their libraries are
+#   loaded when a file is parsed or a barcode decoded
+from book_parser import page_orders
+from book_ocr import backend_available, ocr_backends
+from barcode_decoder import decode_modes
+from capture_writer import capture_formats
+#   The scanners, OpenCV and the metadata provider (requests) are imported by
+#   the commands that use them, so listing or searching the library starts fast
+if TYPE_CHECKING:
+    from book_meta import OpenLibraryProvider
+    from librarian import BarcodeScanner
 
 #   Example of guards for output
 #   Gets the path for the books to be scanned
@@ -54,22 +68,198 @@ def print_menu():
 [3] Scan folder
 [4] Scan Folders
 [5] Output Library Contents
+[6] Scan barcodes from images or video
+[7] Search library
 [Any] Any other key""")
 
-def parse_selection(log: Logger):
+def add_common_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--db", default=book_db.conn_string,
+                        help=f"Path to the sqlite database. Default: {book_db.conn_string}.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used to parse files or decode images.")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Number of books written to the database per transaction.")
+
+def add_scan_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--page-chunk", type=int, default=0,
+                        help="Split each pdf into tasks of this many pages. 0 keeps a pdf in one task.")
+    parser.add_argument("--page-order", choices=page_orders, default="front",
+                        help="Order pdf pages are scanned in. front_back also tries the last pages.")
+    parser.add_argument("--no-text-layer", dest="text_layer", action="store_false",
+                        help="Always OCR pdfs instead of checking their metadata and text layer first.")
+    parser.add_argument("--full-rescan", dest="incremental", action="store_false",
+                        help="Parse every file instead of skipping files unchanged since the last scan.")
+    parser.add_argument("--hash-files", action="store_true",
+                        help="Hash new and changed files to detect moved or renamed books.")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Parse files whose ISBN couldn't be found on an earlier scan again, "
+                        "including files that ran out of attempts.")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="Times a file that fails to parse is tried across scans. Default: 3")
+    parser.add_argument("--ocr-fast-dpi", type=int, default=150,
+                        help="Resolution of the first OCR pass, which only looks for labelled ISBNs. Default: 150")
+    parser.add_argument("--ocr-dpi", type=int, default=300,
+                        help="Resolution of the later OCR passes, only used when the first finds nothing. Default: 300")
+    parser.add_argument("--no-ocr-crop", dest="ocr_crop", action="store_false",
+                        help="Don't OCR the lines around \"ISBN\" labels on their own before OCR'ing whole pages again.")
+    parser.add_argument("--ocr-backend", choices=["auto", *ocr_backends], default="auto",
+                        help="How Tesseract is run. tesserocr keeps an engine loaded in each worker, "
+                        "pytesseract starts tesseract for every page. Default: auto, tesserocr if it's installed.")
+    parser.add_argument("--include", action="append", metavar="GLOB",
+                        help="Only scan files whose name matches this glob. Can be repeated. Default: *.pdf and *.epub.")
+    parser.add_argument("--exclude", action="append", metavar="GLOB",
+                        help="Skip files and directories whose name matches this glob. Can be repeated.")
+    parser.add_argument("--no-progress", dest="progress", action="store_false",
+                        help="Don't show progress while scanning folders.")
+    parser.add_argument("--report",
+                        help="Write a report of each folder scan to this file, csv if it ends in .csv, otherwise json.")
+    parser.add_argument("--profile",
+                        help="Profile folder scans with cProfile and dump the stats to this file. Use --workers 1 to profile parsing.")
+
+def add_meta_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--offline", action="store_true",
+                        help="Only use cached metadata and never query OpenLibrary.")
+    parser.add_argument("--no-meta-cache", dest="meta_cache", action="store_false",
+                        help="Don't cache OpenLibrary responses.")
+    parser.add_argument("--cache-ttl", type=float, default=30,
+                        help="Days before cached metadata is fetched again.")
+    parser.add_argument("--negative-ttl", type=float, default=1,
+                        help="Days before an ISBN OpenLibrary didn't know is looked up again.")
+
+def add_barcode_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--decode-mode", choices=decode_modes, default="fast",
+                        help="fast decodes downscaled grayscale frames and tracks the barcode region.")
+    parser.add_argument("--capture-format", choices=list(capture_formats), default="jpg",
+                        help="Image format barcode captures are saved in.")
+    parser.add_argument("--capture-quality", type=int, default=85,
+                        help="JPEG/WebP quality of barcode captures from 1 to 100.")
+    parser.add_argument("--capture-crop", action="store_true",
+                        help="Only save the barcode region of captures when it's known.")
+
+def column_list(value: str) -> [str]:
+    columns = value.split(",")
+    unknown = [column for column in columns if column not in book_columns]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown columns: {', '.join(unknown)}")
+    return columns
+
+def add_listing_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--columns", type=column_list,
+                        help=f"Comma separated columns from {', '.join(book_columns)}.")
+    parser.add_argument("--publisher", help="Only books whose publishers contain this text.")
+    parser.add_argument("--published-after", type=int, metavar="YEAR",
+                        help="Only books published in or after this year.")
+    parser.add_argument("--published-before", type=int, metavar="YEAR",
+                        help="Only books published in or before this year.")
+    parser.add_argument("--missing-metadata", action="store_true",
+                        help="Only books without a title.")
+    parser.add_argument("--page-size", type=int, default=1000,
+                        help="Books read from the database per query.")
+
+def add_subcommand(subparsers, name: str, help: str, options: list) -> argparse.ArgumentParser:
+    sub = subparsers.add_parser(name, help=help, description=help)
+    for add_options in options:
+        add_options(sub)
+    #   Options given before the subcommand are parsed by the main parser, so
+    #   only overwrite them with options actually given after it
+    for action in sub._actions:
+        if action.option_strings and action.dest != "help":
+            action.default = argparse.SUPPRESS
+    return sub
+
+def parse_args(argv: [str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Catalogue eBooks and barcodes by ISBN. "
+                                     "Runs the interactive menu when no command is given.")
+    for add_options in (add_common_options, add_scan_options, add_meta_options, add_barcode_options):
+        add_options(parser)
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+
+    sub = add_subcommand(subparsers, "scan", "Scan folders and their subfolders for eBooks.",
+                         [add_common_options, add_scan_options, add_meta_options])
+    sub.add_argument("paths", nargs="*", help="Folders to scan.")
+    sub.add_argument("--resume", action="store_true",
+                     help="Only finish the files left in the queue by an interrupted scan.")
+
+    sub = add_subcommand(subparsers, "barcode", "Scan barcodes with the webcam, or from images or a video.",
+                         [add_common_options, add_meta_options, add_barcode_options])
+    sub.add_argument("path", nargs="?",
+                     help="Directory of images or a video file to decode instead of the webcam.")
+    sub.add_argument("--once", action="store_true", help="Stop after the first webcam barcode.")
+
+    sub = add_subcommand(subparsers, "list", "Print the library contents.", [add_common_options])
+    add_listing_options(sub)
+
+    add_subcommand(subparsers, "enrich", "Look up metadata for books that don't have any.",
+                   [add_common_options, add_meta_options])
+
+    sub = add_subcommand(subparsers, "search", "Search titles, publishers and paths.", [add_common_options])
+    sub.add_argument("query", nargs="+", help="Words to look for, the last one also matches as a prefix.")
+    sub.add_argument("--limit", type=int, default=20, help="Most books printed. Default: 20")
+
+    sub = add_subcommand(subparsers, "export", "Export the library.", [add_common_options])
+    add_listing_options(sub)
+    sub.add_argument("--format", choices=export_formats, default="csv",
+                     help="Default: csv. parquet needs pyarrow and --output.")
+    sub.add_argument("--output", "-o", help="File to write to. Default: stdout.")
+    return parser.parse_args(argv)
+
+def make_provider(args: argparse.Namespace, log: Logger) -> OpenLibraryProvider:
+    from book_meta import OpenLibraryProvider, MetadataCache
+    cache = None
+    if args.meta_cache or args.offline:
+        cache = MetadataCache(args.cache_ttl * 86400, args.negative_ttl * 86400, log=log)
+    return OpenLibraryProvider(cache=cache, offline=args.offline, log=log)
+
+#   Made by the first command that looks up metadata
+_provider: OpenLibraryProvider = None
+
+def get_provider(args: argparse.Namespace, log: Logger) -> OpenLibraryProvider:
+    global _provider
+    if _provider == None:
+        _provider = make_provider(args, log)
+    return _provider
+
+def make_scanner(args: argparse.Namespace, log: Logger) -> BarcodeScanner:
+    from librarian import BarcodeScanner
+    from capture_writer import CaptureWriter
+    provider = get_provider(args, log)
+    writer = CaptureWriter("captures", args.capture_format, args.capture_quality, args.capture_crop)
+    return BarcodeScanner(provider, decode_mode=args.decode_mode, capture_writer=writer)
+
+def scan_options(args: argparse.Namespace) -> dict:
+    #   Keyword arguments for parse_directories
+    from book_ocr import OcrStrategy, ocr_passes
+    return {"batchSize": args.batch_size, "workers": args.workers, "pageChunk": args.page_chunk,
+            "pageOrder": args.page_order, "textLayer": args.text_layer,
+            "incremental": args.incremental, "hashFiles": args.hash_files,
+            "retryFailed": args.retry_failed, "include": args.include, "exclude": args.exclude,
+            "maxAttempts": args.max_attempts,
+            "ocr": OcrStrategy(ocr_passes(args.ocr_fast_dpi, args.ocr_dpi), args.ocr_crop, args.ocr_backend)}
+
+def run_scan(dirs: [str], log: Logger, args: argparse.Namespace) -> None:
+    from book_parser import parse_directories
+    from book_metrics import ScanMetrics, profiled
+    metrics = ScanMetrics(progress=args.progress)
+    with profiled(args.profile):
+        parse_directories(dirs, log, provider=get_provider(args, log), metrics=metrics, **scan_options(args))
+    if args.report != None:
+        metrics.write_report(args.report)
+        print(f"Saved scan report to {args.report}")
+
+def parse_selection(log: Logger, args: argparse.Namespace):
     sel = input()
     clear()
     if sel == "1":
-        scanner = BarcodeScanner
-        scanner.capture_single_barcode(scanner)
+        scanner = make_scanner(args, log)
+        scanner.capture_single_barcode()
         
     elif sel == "2":
-        scanner = BarcodeScanner
-        scanner.start_scanning(self=scanner)
+        scanner = make_scanner(args, log)
+        scanner.start_scanning()
         
     elif sel == "3":
         bookDir = get_books_dir()
-        parse_directories([x[0] for x in os.walk(bookDir)], log)
+        run_scan([bookDir], log, args)
         print()
         
     elif sel == "4":
@@ -90,37 +280,131 @@ def parse_selection(log: Logger):
             else:
                 print("Invalid directory entered. Please try a valid one.")
                 
-        all_dirs = []
         if dirs.__len__() == 0:
             dirs.append(booksDir)
-            
-        for d in dirs:
-            sub_dirs = [x[0] for x in os.walk(d)]
-            for sd in sub_dirs:
-                all_dirs.append(sd)
                 
-        parse_directories(all_dirs, log)
+        run_scan(dirs, log, args)
         print()
         
     elif sel == "5":
-        # Comment
-        get_all_books()
+        #   Streamed a page at a time so huge libraries print in constant memory
+        export_table(stream_books(["isbn", "title"]), ["isbn", "title"], sys.stdout)
+        print()
         
+    elif sel == "6":
+        path = input("Path to a directory of images or a video file: ")
+        if not os.path.exists(path):
+            print("Invalid path entered.")
+            return
+        run_batch_barcodes(path, log, args)
+        print()
+
+    elif sel == "7":
+        print_search_results(input("Search: "))
+        print()
+
     else:
         quit()
 
+def run_batch_barcodes(path: str, log: Logger, args: argparse.Namespace) -> None:
+    from librarian import BatchBarcodeScanner
+    batch = BatchBarcodeScanner(get_provider(args, log), workers=args.workers)
+    sightings = batch.scan(path)
+    stored = batch.store(sightings, log)
+    print(f"Found {len(sightings)} barcode sightings of {len({s.isbn for s in sightings})} ISBNs.")
+    print(f"Stored {stored} new books.")
+
+def print_search_results(query: str, limit: int = 20) -> int:
+    columns = ["isbn", "title", "publishers", "path"]
+    rows = ((book.isbn, book.title, book.publishers, book.path) for book in search(query, limit))
+    return export_table(rows, columns, sys.stdout)
+
+def listing_filters(args: argparse.Namespace) -> dict:
+    #   Keyword arguments for stream_books
+    return {"pageSize": args.page_size, "publisher": args.publisher,
+            "publishedAfter": args.published_after, "publishedBefore": args.published_before,
+            "missingMetadata": args.missing_metadata}
+
+def run_command(log: Logger, args: argparse.Namespace) -> int:
+    #   Runs a subcommand and returns the exit code
+    if args.command == "scan":
+        if not args.paths and not args.resume:
+            print("Give folders to scan, or --resume to finish an interrupted scan.", file=sys.stderr)
+            return 2
+        missing = [path for path in args.paths if not os.path.isdir(path)]
+        if missing:
+            print(f"Not a directory: {', '.join(missing)}", file=sys.stderr)
+            return 2
+        if args.ocr_backend != "auto" and not backend_available(args.ocr_backend):
+            print(f"The {args.ocr_backend} OCR backend isn't installed, install it with: "
+                  f"pip install {args.ocr_backend}", file=sys.stderr)
+            return 2
+        run_scan(args.paths, log, args)
+
+    elif args.command == "barcode":
+        if args.path != None:
+            if not os.path.exists(args.path):
+                print(f"No such file or directory: {args.path}", file=sys.stderr)
+                return 2
+            run_batch_barcodes(args.path, log, args)
+        elif args.once:
+            make_scanner(args, log).capture_single_barcode()
+        else:
+            make_scanner(args, log).start_scanning()
+
+    elif args.command == "list":
+        columns = args.columns or ["isbn", "title"]
+        export_table(stream_books(columns, **listing_filters(args)), columns, sys.stdout)
+
+    elif args.command == "search":
+        if print_search_results(" ".join(args.query), args.limit) == 0:
+            print("No books found.", file=sys.stderr)
+            return 1
+
+    elif args.command == "enrich":
+        from book_meta import enrich_books
+        updated = enrich_books(get_provider(args, log), log)
+        print(f"Updated metadata of {updated} books.")
+
+    elif args.command == "export":
+        export = exporters[args.format]
+        columns = args.columns or list(default_columns)
+        rows = stream_books(columns, **listing_filters(args))
+        if args.output == None:
+            if args.format in binary_formats:
+                print(f"{args.format} exports need --output.", file=sys.stderr)
+                return 2
+            count = export(rows, columns, sys.stdout)
+        elif args.format in binary_formats:
+            try:
+                count = export(rows, columns, args.output)
+            except RuntimeError as e:
+                print(e, file=sys.stderr)
+                return 1
+        else:
+            with open(args.output, "w", newline="", encoding="utf-8") as f:
+                count = export(rows, columns, f)
+        print(f"Exported {count} books.", file=sys.stderr)
+    return 0
+
 def main():
+    args = parse_args()
     init_folders()
+    book_db.conn_string = args.db
+    if os.path.dirname(args.db):
+        os.makedirs(os.path.dirname(args.db), exist_ok=True)
     #   Create the database for isbns and books
     create_table()
     #   Initialize the log for all files
     log = init_logs()
+    if args.command != None:
+        sys.exit(run_command(log, args))
     
     while True:
         #   Print the selections
         print_menu()
         #   Get the user input
-        parse_selection(log)
+        parse_selection(log, args)
     #get_book("9781801077361")
         
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+import sqlite3
+
+import pytest
+
+import book_db
+from book import Book
+
+
+def test_transaction_recovers_from_failed_commit(db):
+    conn = db.get_connection()
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE child (parent INTEGER REFERENCES parent(id) DEFERRABLE INITIALLY DEFERRED)")
+    #   The deferred foreign key is only checked, and fails, on COMMIT
+    with pytest.raises(sqlite3.IntegrityError):
+        with db.transaction() as conn:
+            conn.execute("INSERT INTO child VALUES (1)")
+    assert not conn.in_transaction
+    with db.transaction() as conn:
+        conn.execute("INSERT INTO parent VALUES (1)")
+        conn.execute("INSERT INTO child VALUES (1)")
+    assert conn.execute("SELECT COUNT(*) FROM child").fetchone()[0] == 1
+
+
+def test_store_books_counts_only_new_books(db):
+    books = [Book(f"Title {i}", f"978000000{i:04d}", "Press;", "2001", f"/books/{i}.pdf") for i in range(3)]
+    assert db.store_books(books[:1]) == 1
+    #   One already stored and one repeated within the batch
+    assert db.store_books(books + books[2:]) == 2
+    assert db.store_books(books) == 0
+    assert db.get_connection().execute("SELECT COUNT(*) FROM books").fetchone()[0] == 3
+
+
+def test_search_ranks_every_match(db):
+    #   More path matches than a search used to rank, added before the title match
+    books = [Book(f"Cooking {i}", f"978{i:010d}", "Press;", "2001", f"/books/python/{i}.pdf")
+             for i in range(6000)]
+    books.append(Book("Python Crash Course", "9781593279288", "No Starch Press;", "2019", "/books/crash.pdf"))
+    db.store_books(books)
+    assert db.search("python", 5)[0].title == "Python Crash Course"
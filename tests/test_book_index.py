@@ -0,0 +1,19 @@
+from book_index import LibraryIndex, pack_isbn
+
+
+def test_pack_isbn_keeps_isbns_apart():
+    keys = {pack_isbn(isbn) for isbn in ("9780306406157", "0306406152", "080442957X", "080442957x")}
+    assert len(keys) == 3 and None not in keys
+
+
+def test_pack_isbn_rejects_other_lengths():
+    for isbn in ("", None, "12345", "978030640615712345", "9" * 40):
+        assert pack_isbn(isbn) == None
+
+
+def test_index_handles_over_long_digits():
+    index = LibraryIndex([("9780306406157", "/books/a.pdf")])
+    assert index.has_isbn("9780306406157")
+    assert index.has_isbn("978030640615712345") == None
+    index.add("978030640615712345", "/books/b.pdf")
+    assert index.has_path("/books/b.pdf")
@@ -0,0 +1,18 @@
+import pytest
+
+from book_ocr import OcrBackend, parse_config
+
+
+def test_backend_missing_a_method_fails_when_created():
+    class TextOnly(OcrBackend):
+        def image_to_string(self, image, config=""):
+            return ""
+
+    with pytest.raises(TypeError):
+        TextOnly()
+
+
+def test_parse_config():
+    assert parse_config("--psm 11 -c tessedit_char_whitelist=0123456789X") == \
+        (11, {"tessedit_char_whitelist": "0123456789X"})
+    assert parse_config("") == (None, {})
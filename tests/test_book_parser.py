@@ -0,0 +1,58 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import book_parser
+from book_ocr import OcrStrategy
+from book_parser import ParseResult, _plan_tasks, pdf_page_order, scan_files
+
+
+def test_page_chunks_check_text_layer_once():
+    pages = pdf_page_order(10)
+    ocr = OcrStrategy()
+    tasks = _plan_tasks("book.pdf", 4, pages, True, ocr)
+    #   One task checks the metadata and text layer of every page without OCR
+    path, textPages, textLayer, textOcr = tasks[0]
+    assert (textPages, textLayer, textOcr.tiers) == (pages, True, ())
+    #   The chunks only OCR
+    assert [task[1] for task in tasks[1:]] == [pages[0:4], pages[4:8], pages[8:10]]
+    assert all(task[2] == False and task[3] is ocr for task in tasks[1:])
+
+
+def test_page_chunks_without_text_layer():
+    pages = pdf_page_order(10)
+    tasks = _plan_tasks("book.pdf", 5, pages, False, None)
+    assert [(task[1], task[2]) for task in tasks] == [(pages[0:5], False), (pages[5:10], False)]
+
+
+def test_epubs_are_not_chunked():
+    assert _plan_tasks("book.epub", 4, [1, 2], True, None) == [("book.epub", [1, 2], True, None)]
+
+
+def fake_parse_file(calls, hits):
+    #   Finds an ISBN in the text layer of "digital.pdf" and on page 1 of
+    #   the OCR'd pages of any other pdf
+    def parse_file(filePath, pages, textLayer, ocr):
+        calls.append((filePath, tuple(pages), textLayer))
+        if textLayer:
+            isbn = "9780306406157" if filePath in hits else None
+        else:
+            if 1 not in pages:
+                time.sleep(0.2)
+            isbn = "9780306406157" if 1 in pages else None
+        return ParseResult(filePath, isbn, tier="text" if textLayer else "ocr_fast")
+    return parse_file
+
+
+def test_page_chunks_only_ocr_without_text_layer_hit(monkeypatch):
+    calls = []
+    monkeypatch.setattr(book_parser, "parse_file", fake_parse_file(calls, {"digital.pdf"}))
+    #   One thread, so later chunks are still queued when the first finds an ISBN
+    monkeypatch.setattr(book_parser, "ProcessPoolExecutor", lambda max_workers, mp_context: ThreadPoolExecutor(1))
+    results = {res.filePath: res for res in scan_files(["digital.pdf", "scan.pdf"], workers=2, pageChunk=2)}
+    assert results["digital.pdf"].tier == "text"
+    assert results["scan.pdf"].tier == "ocr_fast"
+    assert [call for call in calls if call[0] == "digital.pdf"] == [("digital.pdf", tuple(pdf_page_order(10)), True)]
+    scanCalls = [call for call in calls if call[0] == "scan.pdf"]
+    #   The text layer first, then the chunk with page 1, the last chunks never run
+    assert scanCalls[0][2] == True and scanCalls[1][1] == (1, 2)
+    assert all(9 not in pages for _, pages, textLayer in scanCalls[1:])
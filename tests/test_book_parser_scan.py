@@ -0,0 +1,32 @@
+import logging
+import random
+
+from benchmark import write_epub
+from book_meta import OpenLibraryProvider
+from book_parser import parse_directories
+
+isbn = "9780306406157"
+
+
+def scan(directory):
+    parse_directories([str(directory)], logging.getLogger("test"), workers=1,
+                      provider=OpenLibraryProvider(offline=True))
+
+
+def test_failed_batch_is_scanned_again(db, tmp_path):
+    books = tmp_path / "books"
+    books.mkdir()
+    write_epub(str(books / "book.epub"), random.Random(1), isbn)
+    conn = db.get_connection()
+    conn.execute("""CREATE TRIGGER fail_books BEFORE INSERT ON books
+                    BEGIN SELECT RAISE(ABORT, 'disk full'); END""")
+    scan(books)
+    #   Nothing of the batch was written, so the file isn't remembered as done
+    assert db.get_book(isbn) == None
+    assert conn.execute("SELECT COUNT(*) FROM scan_state").fetchone()[0] == 0
+    assert conn.execute("SELECT state FROM scan_jobs").fetchall() == [("pending",)]
+
+    conn.execute("DROP TRIGGER fail_books")
+    scan(books)
+    assert db.get_book(isbn) != None
+    assert conn.execute("SELECT state FROM scan_jobs").fetchall() == [("done",)]
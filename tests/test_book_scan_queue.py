@@ -0,0 +1,24 @@
+import os
+import socket
+import time
+
+from book_scan_queue import ScanQueue
+
+
+def claim_as(db, owner, claimedAt):
+    db.enqueue_scan_jobs([("/books/a.pdf", 1, 1)])
+    db.claim_scan_jobs(owner, 1)
+    db.get_connection().execute("UPDATE scan_jobs SET claimed_at=?", (claimedAt,))
+
+
+def test_recover_old_claim_of_a_live_pid(db):
+    #   After a reboot the pid of a dead scan can belong to a live process
+    claim_as(db, f"{socket.gethostname()}:1", time.time() - 3 * 86400)
+    assert ScanQueue().recover() == 1
+    assert db.scan_job_counts()["pending"] == 1
+
+
+def test_keep_recent_claim_of_a_live_scan(db):
+    claim_as(db, f"{socket.gethostname()}:{os.getppid()}", time.time())
+    assert ScanQueue().recover() == 0
+    assert db.scan_job_counts()["running"] == 1
@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from book import Book
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+#   Libraries only scans and barcode commands need
+heavy_modules = ("cv2", "pyzbar", "pdf2image", "PIL", "ebooklib", "bs4", "pytesseract",
+                 "tesserocr", "isbnlib", "requests")
+#   Prints the heavy modules loaded once main.py exits
+probe = ("import atexit, runpy, sys\n"
+         f"atexit.register(lambda: print('loaded:', *(m for m in {heavy_modules!r} if m in sys.modules), file=sys.stderr))\n"
+         f"runpy.run_path({os.path.join(here, 'main.py')!r}, run_name='__main__')\n")
+
+
+@pytest.mark.parametrize("command", [["list"], ["search", "python"], ["export", "--format", "jsonl"]])
+def test_db_commands_load_no_heavy_modules(db, tmp_path, command):
+    db.store_books([Book("Python Crash Course", "9781593279288", "No Starch Press;", "2019", "/books/crash.pdf")])
+    res = subprocess.run([sys.executable, "-c", probe, "--db", db.conn_string, *command],
+                         cwd=tmp_path, env=dict(os.environ, PYTHONPATH=here), capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr
+    assert res.stderr.rpartition("loaded:")[2].split() == []